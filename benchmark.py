@@ -0,0 +1,196 @@
+# this script benchmarks the parsing (and optionally loading) stages against a synthetic data set from
+# `synthetic_data.py`, and writes a JSON report of the throughput, peak memory, and wall time of each stage.
+# Reports from different versions may be compared with `compare_reports` to catch regressions.
+# Usage: python benchmark.py <data_dir> --lines 1m --report bench_1m.json [--baseline old.json] [--config aws.cfg]
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import parse_data
+import synthetic_data
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux; the children cover the worker processes of the parallel parser
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(self_rss, child_rss) / 1024, 1)
+
+def _stage_honeypot_json_to_df(paths):
+    return len(parse_data.honeypot_json_to_df(paths['honeypot']))
+
+def _stage_honeypot_parallel(paths):
+    return len(parse_data.honeypot_json_to_df(paths['honeypot'], n_jobs=None))
+
+def _stage_iter_honeypot_chunks(paths):
+    return sum(len(df) for df in parse_data.iter_honeypot_chunks(paths['honeypot']))
+
+def _stage_reputation_raw_to_df(paths):
+    return len(parse_data.reputation_raw_to_df(paths['reputation']))
+
+def _stage_ip_geo_to_df(paths):
+    return len(parse_data.ip_geo_to_df(paths['ip_geo']))
+
+# the benchmark stages, the input file each one reads, and the function that runs it and returns a row count
+STAGES = {
+    'honeypot_json_to_df': ('honeypot', _stage_honeypot_json_to_df),
+    'honeypot_json_to_df_parallel': ('honeypot', _stage_honeypot_parallel),
+    'iter_honeypot_chunks': ('honeypot', _stage_iter_honeypot_chunks),
+    'reputation_raw_to_df': ('reputation', _stage_reputation_raw_to_df),
+    'ip_geo_to_df': ('ip_geo', _stage_ip_geo_to_df)
+}
+
+
+def _run_stage(stage, paths):
+    # runs in a fresh process, so the peak memory is the stage's own
+    start = time.perf_counter()
+    rows = STAGES[stage][1](paths)
+    return rows, time.perf_counter() - start, _peak_rss_mb()
+
+def _run_sql_stages(config_file):
+    from honeypot_redshift import honeypot_redshift
+
+    hrs = honeypot_redshift(config_file=config_file)
+    hrs.db_connect()
+    results = []
+    for step, method in (('sql_copy', hrs.copy_into_tables), ('sql_insert', hrs.insert_into_tables)):
+        start = time.perf_counter()
+        method(tables='all')
+        results.append({'stage': step, 'wall_time_s': round(time.perf_counter() - start, 3)})
+    return results
+
+def _git_version():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(paths, stages=None, config_file=None):
+    """ Run the benchmark stages against a data set and return a report. Each stage runs in its own
+    process, so that its peak RSS is not inflated by earlier stages.
+
+    Parameters
+    ----------
+    paths: dict
+      Paths of the "honeypot", "reputation", and "ip_geo" files, as returned by `synthetic_data.generate_dataset`.
+    stages: list or None, default None
+      Names of the `STAGES` to run. None runs them all.
+    config_file: str or None, default None
+      If given, the warehouse COPY and INSERT steps are also timed, using `honeypot_redshift` with this
+      config file. The config's S3 paths should hold the same data set.
+
+    Returns
+    -------
+    dict
+      The report: run metadata, the input file sizes, and for each stage its `rows`, `wall_time_s`,
+      `rows_per_s`, `mb_per_s`, and `peak_rss_mb`.
+    """
+
+    stages = stages or list(STAGES)
+    report = {
+        'run_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'version': _git_version(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'cpus': os.cpu_count(),
+        'inputs': {name: {'path': path, 'mb': round(os.path.getsize(path) / 1e6, 2)} for name, path in paths.items()},
+        'stages': []
+    }
+
+    ctx = multiprocessing.get_context('spawn')
+    for stage in stages:
+        input_name = STAGES[stage][0]
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            rows, wall, rss = pool.submit(_run_stage, stage, paths).result()
+        result = {
+            'stage': stage,
+            'rows': rows,
+            'wall_time_s': round(wall, 3),
+            'rows_per_s': round(rows / wall, 1) if wall else None,
+            'mb_per_s': round(report['inputs'][input_name]['mb'] / wall, 2) if wall else None,
+            'peak_rss_mb': rss
+        }
+        print('{}: {} rows in {}s, peak RSS {} MB'.format(stage, rows, result['wall_time_s'], rss))
+        report['stages'].append(result)
+
+    if config_file is not None:
+        report['stages'].extend(_run_sql_stages(config_file))
+
+    return report
+
+def compare_reports(baseline, report, tolerance=0.10):
+    """ Compare a benchmark report against a baseline report and list the regressions: stages whose wall
+    time or peak RSS grew by more than `tolerance` (a fraction).
+
+    Parameters
+    ----------
+    baseline: dict
+      Report from an earlier run (e.g. loaded from its JSON file).
+    report: dict
+      Report from the current run.
+    tolerance: float, default 0.10
+      Allowed relative increase before a change counts as a regression.
+
+    Returns
+    -------
+    list of dicts, one per regression, with the `stage`, `metric`, `baseline` and `current` values.
+    """
+
+    base_stages = {s['stage']: s for s in baseline['stages']}
+    regressions = []
+    for stage in report['stages']:
+        base = base_stages.get(stage['stage'])
+        if base is None:
+            continue
+        for metric in ('wall_time_s', 'peak_rss_mb'):
+            if base.get(metric) and stage.get(metric) and stage[metric] > base[metric] * (1 + tolerance):
+                regressions.append({'stage': stage['stage'], 'metric': metric,
+                                    'baseline': base[metric], 'current': stage[metric]})
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the honeypot parsing stages on synthetic data.')
+    parser.add_argument('data_dir', help='directory for the synthetic data; generated if the files are missing')
+    parser.add_argument('--lines', default='10k', help='number of honeypot lines, or one of {}'.format(list(synthetic_data.SIZES)))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='*', choices=list(STAGES))
+    parser.add_argument('--report', default='bench_report.json')
+    parser.add_argument('--baseline', help='earlier report to compare against')
+    parser.add_argument('--config', help='config file, to also time the warehouse loads')
+    args = parser.parse_args()
+
+    n_lines = synthetic_data.SIZES.get(args.lines.lower()) or int(args.lines)
+    paths = {
+        'honeypot': os.path.join(args.data_dir, 'honeypot_{}.json'.format(n_lines)),
+        'reputation': os.path.join(args.data_dir, 'reputation_{}.data'.format(n_lines)),
+        'ip_geo': os.path.join(args.data_dir, 'ip_geos_{}.csv'.format(n_lines))
+    }
+    if not all(os.path.exists(p) for p in paths.values()):
+        print('Generating {} line synthetic data set in {}'.format(n_lines, args.data_dir))
+        paths = synthetic_data.generate_dataset(args.data_dir, n_lines, seed=args.seed)
+
+    report = run_benchmarks(paths, stages=args.stages, config_file=args.config)
+    with open(args.report, 'w') as rf:
+        json.dump(report, rf, indent=2)
+    print('Wrote report to {}'.format(args.report))
+
+    if args.baseline:
+        with open(args.baseline) as bf:
+            regressions = compare_reports(json.load(bf), report)
+        for r in regressions:
+            print('REGRESSION {stage} {metric}: {baseline} -> {current}'.format(**r))
+        if not regressions:
+            print('No regressions against {}'.format(args.baseline))
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,9 @@
 # this script builds the tables for the cluster. The cluster must have been
-# previously built using the `cluster_setup.py` script or other means.
+# previously built using the `cluster_setup.py` script or other means. With `--local`, the tables are built
+# in the local DuckDB database from the `LOCAL` section of the config instead (see `honeypot_local.py`).
+import argparse
 from honeypot_redshift import honeypot_redshift
+from honeypot_local import honeypot_local
 CONFIG_FILENAME = './aws.cfg'  # note: not included in GH repo for privacy. See `aws_example.cfg` for example
 
 def main():
@@ -8,23 +11,38 @@ def main():
     is up, then it will delete old tables and create new ones. If not...it won't. 
 
     """
+    parser = argparse.ArgumentParser(description='Build the honeypot data warehouse tables.')
+    parser.add_argument('--local', action='store_true', help='build the tables in the local DuckDB database')
+    args = parser.parse_args()
+
+    if args.local:
+        with honeypot_local(config_file=CONFIG_FILENAME) as hl:
+            hl.db_connect()
+            hl.delete_tables(tables='all')
+            hl.create_tables(tables='all')
+        return
+
     hrs = honeypot_redshift(config_file=CONFIG_FILENAME)
-    # make sure the endpoint information is attached
-    info = hrs.get_cluster_info()
+    # the cluster is only looked up if the endpoint isn't in the config; a stale configured endpoint is
+    # looked up again by `db_connect`
+    info = None
+    if not (hrs.DWH_ENDPOINT and hrs.IAM_ROLE):
+        info = hrs.get_cluster_info()
 
     # if endpoint isn't attached, nothing we can do, except notify the user
-    can_build_tables = False
-    if info['ClusterStatus'] == 'available' and 'Endpoint' in info:
-        if isinstance(info['Endpoint'], dict) and 'Address' in info['Endpoint']:
-            print('Connecting to Database.')
-            hrs.db_connect()
-            print('Deleting all tables.')
-            hrs.delete_tables(tables='all')
-            print('Creating new tables.')
-            hrs.create_tables(tables='all')
-            can_build_tables = True
+    can_build_tables = info is None
+    if info is not None and info['ClusterStatus'] == 'available' and 'Endpoint' in info:
+        can_build_tables = isinstance(info['Endpoint'], dict) and 'Address' in info['Endpoint']
 
-    if not can_build_tables:
+    if can_build_tables:
+        print('Connecting to Database.')
+        hrs.db_connect()
+        print('Deleting all tables.')
+        hrs.delete_tables(tables='all')
+        print('Creating new tables.')
+        hrs.create_tables(tables='all')
+        hrs.close()
+    else:
         print('Cannot connect to database at this time. Please check redshift database status: \n{}'.\
             format(info))
 
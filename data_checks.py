@@ -1,5 +1,8 @@
-# this script runs unit tests on the honeypot redshift tables after they have been created and populated
+# this script runs unit tests on the honeypot redshift tables after they have been created and populated.
+# With `--local`, the tests run on the local DuckDB database instead (see `honeypot_local.py`).
+import argparse
 from honeypot_redshift import honeypot_redshift
+from honeypot_local import honeypot_local
 from sql_queries import data_quality_checks
 CONFIG_FILENAME = './aws.cfg'  # note: not included in GH repo for privacy. See `aws_example.cfg` for example
 
@@ -16,13 +19,12 @@ def test_tables_populated(hrs):
     """
 
     print('Testing Tables are Populated')
-    cur = hrs.conn.cursor()
-
-    all_tables = data_quality_checks.all_tables
-    for tbl in all_tables:
-        query = data_quality_checks.count_rows.format(tbl)
-        cur.execute(query)
-        assert cur.fetchone()[0] > 0
+    with hrs.cursor() as cur:
+        all_tables = data_quality_checks.all_tables
+        for tbl in all_tables:
+            query = data_quality_checks.count_rows.format(tbl)
+            hrs.execute(cur, query)
+            assert cur.fetchone()[0] > 0
 
 def test_reputation_fact(hrs):
     """ Tests reputation data made it into the fact table. 
@@ -36,11 +38,10 @@ def test_reputation_fact(hrs):
     None
     """
     print('Testing reputation information successfully joined to fact table. ')
-    cur = hrs.conn.cursor()
-
-    query = data_quality_checks.reputation_joined
-    cur.execute(query)
-    assert cur.fetchone()[0] > 0
+    with hrs.cursor() as cur:
+        query = data_quality_checks.reputation_joined
+        hrs.execute(cur, query)
+        assert cur.fetchone()[0] > 0
 
 def test_more_total_fact_reputation(hrs):
     """ Tests reputation data made it into the fact table BUT that there are fewer rows there 
@@ -55,31 +56,35 @@ def test_more_total_fact_reputation(hrs):
     None
     """
     print('Testing not all the rows will have reputation information.')
-    cur = hrs.conn.cursor()
+    with hrs.cursor() as cur:
+        query = data_quality_checks.reputation_joined
+        hrs.execute(cur, query)
+        rep_rows = cur.fetchone()[0]
 
-    query = data_quality_checks.reputation_joined
-    cur.execute(query)
-    rep_rows = cur.fetchone()[0]
-
-    query2 = data_quality_checks.total_rows_fact
-    cur.execute(query2)
-    fact_rows = cur.fetchone()[0]
+        query2 = data_quality_checks.total_rows_fact
+        hrs.execute(cur, query2)
+        fact_rows = cur.fetchone()[0]
 
     assert rep_rows < fact_rows
 
 def main():
-
-    hrs = honeypot_redshift(config_file=CONFIG_FILENAME)
-    # make sure the endpoint information is attached
-    info = hrs.get_cluster_info()
-
-    # connect to database
-    hrs.db_connect()
-
-    # run tests
-    test_tables_populated(hrs)
-    test_reputation_fact(hrs)
-    test_more_total_fact_reputation(hrs)
+    parser = argparse.ArgumentParser(description='Run the data quality checks on the honeypot tables.')
+    parser.add_argument('--local', action='store_true', help='check the local DuckDB database instead of redshift')
+    parser.add_argument('--metrics', metavar='PATH', help='write per-query metrics of the checks to a JSON or CSV file')
+    args = parser.parse_args()
+
+    # connect to database; the endpoint is only looked up if it isn't in the config
+    backend = honeypot_local if args.local else honeypot_redshift
+    with backend(config_file=CONFIG_FILENAME) as hrs:
+        hrs.db_connect()
+
+        # run tests
+        test_tables_populated(hrs)
+        test_reputation_fact(hrs)
+        test_more_total_fact_reputation(hrs)
+
+        if args.metrics:
+            hrs.write_load_metrics(args.metrics)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,25 +1,53 @@
-# this script populates the tables once they have been built
+# this script populates the tables once they have been built. With `--incremental`, only the new
+# staging data is loaded and merged into the existing tables (see `honeypot_redshift.incremental_load`). With
+# `--rebuild`, the tables are rebuilt as shadow tables and swapped in (see `honeypot_redshift.rebuild`). With
+# `--local`, the local DuckDB database from the `LOCAL` section of the config is loaded (see `honeypot_local.py`).
+# With `--metrics <path>`, the time, rows, and bytes scanned of every statement are written to a JSON or CSV report.
+import argparse
 from honeypot_redshift import honeypot_redshift
+from honeypot_local import honeypot_local
 import data_checks
 CONFIG_FILENAME = './aws.cfg'  # note: not included in GH repo for privacy. See `aws_example.cfg` for example
 
-def populate_tables(hrs):
+def populate_tables(hrs, incremental=False, rebuild=False, metrics_path=None):
     """ This function populates the redshift tables, first by copying into the staging tables, then
-    inserting into the dim and fact tables.
+    inserting into the dim and fact tables, loading independent tables at the same time. The watermark of the load is recorded, so later loads
+    can be incremental.
 
     Parameters
     ----------
     hrs: honeypot_redshift object
+    incremental: bool, default False
+      Only load the new staging data, and merge it into the existing dim and fact tables.
+    rebuild: bool, default False
+      Rebuild all the tables in shadow tables and swap them in, so the current tables stay readable
+      until the new ones are loaded. The tables don't need to be created first.
+    metrics_path: str or None, default None
+      Write the metrics of the load's statements to this JSON or CSV file (see
+      `honeypot_redshift.write_load_metrics`), even if the load fails.
 
     Returns
     -------
     None
     """
 
-    print('Copying into staging tables.')
-    hrs.copy_into_tables(tables='all')
-    print('Inserting into dim and fact tables.')
-    hrs.insert_into_tables(tables='all')
+    if incremental and rebuild:
+        raise ValueError('`incremental` and `rebuild` cannot both be True.')
+    try:
+        if incremental:
+            print('Loading new data incrementally.')
+            hrs.incremental_load()
+        elif rebuild:
+            print('Rebuilding tables.')
+            hrs.rebuild(tables='all')
+            hrs.record_watermark()
+        else:
+            print('Copying into staging tables and inserting into dim and fact tables.')
+            hrs.parallel_load(tables='all')
+            hrs.record_watermark()
+    finally:
+        if metrics_path:
+            hrs.write_load_metrics(metrics_path)
 
 def data_quality_checks(hrs):
     """ Run the data quality checks.
@@ -43,21 +71,46 @@ def main():
     is up, then it will connect to the database and call the `populate_tables` function.
     """
 
+    parser = argparse.ArgumentParser(description='Populate the honeypot data warehouse tables.')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--incremental', action='store_true', help='only load and merge the new staging data')
+    mode.add_argument('--rebuild', action='store_true', help='rebuild the tables in shadow tables and swap them in')
+    parser.add_argument('--local', action='store_true', help='load the local DuckDB database instead of redshift')
+    parser.add_argument('--metrics', metavar='PATH', help='write per-statement load metrics to a JSON or CSV file')
+    args = parser.parse_args()
+
+    if args.local:
+        with honeypot_local(config_file=CONFIG_FILENAME) as hl:
+            hl.db_connect()
+            populate_tables(hl, incremental=args.incremental, rebuild=args.rebuild, metrics_path=args.metrics)
+            data_quality_checks(hl)
+            if args.metrics:
+                # again, with the queries of the checks
+                hl.write_load_metrics(args.metrics)
+        return
+
     hrs = honeypot_redshift(config_file=CONFIG_FILENAME)
-    # make sure the endpoint information is attached
-    info = hrs.get_cluster_info()
+    # the cluster is only looked up if the endpoint isn't in the config; a stale configured endpoint is
+    # looked up again by `db_connect`
+    info = None
+    if not (hrs.DWH_ENDPOINT and hrs.IAM_ROLE):
+        info = hrs.get_cluster_info()
 
     # if endpoint isn't attached, nothing we can do, except notify the user
-    can_connect = False
-    if info['ClusterStatus'] == 'available' and 'Endpoint' in info:
-        if isinstance(info['Endpoint'], dict) and 'Address' in info['Endpoint']:
-            print('Connecting to Database.')
-            hrs.db_connect()
-            populate_tables(hrs)
-            data_quality_checks(hrs)
-            can_connect = True
-
-    if not can_connect:
+    can_connect = info is None
+    if info is not None and info['ClusterStatus'] == 'available' and 'Endpoint' in info:
+        can_connect = isinstance(info['Endpoint'], dict) and 'Address' in info['Endpoint']
+
+    if can_connect:
+        print('Connecting to Database.')
+        hrs.db_connect()
+        populate_tables(hrs, incremental=args.incremental, rebuild=args.rebuild, metrics_path=args.metrics)
+        data_quality_checks(hrs)
+        if args.metrics:
+            # again, with the queries of the checks
+            hrs.write_load_metrics(args.metrics)
+        hrs.close()
+    else:
         print('Cannot connect to database at this time. Please check redshift database status: \n{}'.\
             format(info))
 
@@ -0,0 +1,195 @@
+import collections
+import os
+import sqlite3
+import time
+
+import ip_utils
+
+
+class GeoCache(object):
+    """ An on-disk cache of IP geolocations, stored in SQLite and keyed by the normalized IP address
+    (see `ip_utils.canonical_ip`), so lookups no longer need to scan the `geo_ips` output CSV. Each entry
+    records when it was fetched, and entries older than `ttl_days` are treated as missing, since geolocation
+    data drifts over time. An in-process LRU cache sits in front of the database, so repeated lookups during
+    the ETL never touch disk.
+
+    The cached value is the freegeoip.app CSV response for the IP, without the trailing newline.
+
+    Parameters
+    ----------
+    db_path: str
+      Path to the SQLite database file. Created if it does not exist.
+    ttl_days: float or None, default 90
+      Number of days an entry stays valid. None keeps entries forever.
+    lru_size: int, default 100000
+      Number of entries held in the in-process LRU cache.
+    """
+
+    def __init__(self, db_path, ttl_days=90, lru_size=100000):
+        self.db_path = db_path
+        self.ttl = None if ttl_days is None else ttl_days * 86400
+        self.lru_size = lru_size
+        self._lru = collections.OrderedDict() # key -> (geo, fetched_at)
+
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS ip_geos (
+                ip          TEXT PRIMARY KEY,
+                geo         TEXT NOT NULL,
+                fetched_at  REAL NOT NULL
+            )''')
+        self.conn.commit()
+
+    @staticmethod
+    def _key(ip):
+        key = ip_utils.canonical_ip(ip)
+        return ip.strip() if key is None else key
+
+    def _fresh(self, fetched_at, now):
+        return self.ttl is None or now - fetched_at < self.ttl
+
+    def _remember(self, key, geo, fetched_at):
+        self._lru[key] = (geo, fetched_at)
+        self._lru.move_to_end(key)
+        if len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def get(self, ip):
+        """ Return the cached geolocation for `ip`, or None if it is missing or expired. """
+
+        return self.get_many([ip]).get(ip)
+
+    def get_many(self, ips, batch_size=500):
+        """ Look up many IPs at once.
+
+        Parameters
+        ----------
+        ips: iterable of str
+          IP addresses to look up.
+        batch_size: int, default 500
+          Number of IPs per database query.
+
+        Returns
+        -------
+        dict of IP (as passed in) to geolocation, for the IPs with a fresh cache entry.
+        """
+
+        now = time.time()
+        found = {}
+        missing = {}
+        for ip in ips:
+            key = self._key(ip)
+            hit = self._lru.get(key)
+            if hit is not None and self._fresh(hit[1], now):
+                self._lru.move_to_end(key)
+                found[ip] = hit[0]
+            else:
+                missing.setdefault(key, []).append(ip)
+
+        keys = list(missing)
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            rows = self.conn.execute(
+                'SELECT ip, geo, fetched_at FROM ip_geos WHERE ip IN ({})'.format(','.join('?' * len(batch))), batch)
+            for key, geo, fetched_at in rows:
+                if self._fresh(fetched_at, now):
+                    self._remember(key, geo, fetched_at)
+                    for ip in missing[key]:
+                        found[ip] = geo
+
+        return found
+
+    def expired(self, ips, batch_size=500):
+        """ Return the set of IPs (as passed in) whose cache entry has expired. IPs with a fresh entry, or
+        with no entry at all, are not included.
+        """
+
+        if self.ttl is None:
+            return set()
+        now = time.time()
+        keys = {}
+        for ip in ips:
+            keys.setdefault(self._key(ip), []).append(ip)
+
+        stale = set()
+        key_list = list(keys)
+        for i in range(0, len(key_list), batch_size):
+            batch = key_list[i:i + batch_size]
+            rows = self.conn.execute(
+                'SELECT ip, fetched_at FROM ip_geos WHERE ip IN ({})'.format(','.join('?' * len(batch))), batch)
+            for key, fetched_at in rows:
+                if not self._fresh(fetched_at, now):
+                    stale.update(keys[key])
+
+        return stale
+
+    def put(self, ip, geo, fetched_at=None):
+        """ Cache the geolocation `geo` (the API's CSV response) for `ip`. """
+
+        self.put_many([(ip, geo)], fetched_at=fetched_at)
+
+    def put_many(self, items, fetched_at=None):
+        """ Cache many geolocations in one transaction.
+
+        Parameters
+        ----------
+        items: iterable of (ip, geo) tuples
+          IP addresses and their API CSV responses.
+        fetched_at: float or None, default None
+          Unix time the geolocations were fetched. Defaults to now.
+
+        Returns
+        -------
+        None
+        """
+
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        rows = []
+        for ip, geo in items:
+            key, geo = self._key(ip), geo.rstrip('\r\n')
+            self._remember(key, geo, fetched_at)
+            rows.append((key, geo, fetched_at))
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO ip_geos (ip, geo, fetched_at) VALUES (?, ?, ?)', rows)
+
+    def evict_expired(self):
+        """ Delete the expired entries from the database. Returns the number of entries deleted. """
+
+        if self.ttl is None:
+            return 0
+        cutoff = time.time() - self.ttl
+        self._lru = collections.OrderedDict((k, v) for k, v in self._lru.items() if v[1] >= cutoff)
+        with self.conn:
+            return self.conn.execute('DELETE FROM ip_geos WHERE fetched_at < ?', (cutoff,)).rowcount
+
+    def import_csv(self, path, fetched_at=None):
+        """ Load an existing `geo_ips` output CSV into the cache. Entries get the file's modification time
+        as their fetch time, unless `fetched_at` is given. Returns the number of entries imported.
+        """
+
+        fetched_at = os.path.getmtime(path) if fetched_at is None else fetched_at
+        with open(path) as geod:
+            items = [tuple(line.split(',', 1)) for line in geod if ',' in line]
+        self.put_many(items, fetched_at=fetched_at)
+        return len(items)
+
+    def export_csv(self, path):
+        """ Write all fresh entries to a CSV in the `geo_ips` output format, for `parse_data.ip_geo_to_df`.
+        Returns the number of entries written.
+        """
+
+        now = time.time()
+        count = 0
+        with open(path, 'w') as out:
+            for ip, geo, fetched_at in self.conn.execute('SELECT ip, geo, fetched_at FROM ip_geos ORDER BY ip'):
+                if self._fresh(fetched_at, now):
+                    out.write('{},{}\n'.format(ip, geo))
+                    count += 1
+        return count
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM ip_geos').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
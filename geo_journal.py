@@ -0,0 +1,220 @@
+import os
+import struct
+import zlib
+
+# write-ahead record: magic, size of the output file before the batch, payload length, payload crc32
+_WAL_HEADER = struct.Struct('<4sQQI')
+_WAL_MAGIC = b'GWL1'
+# sidecar index: magic, bytes of the output file covered, crc32 of the last covered block, number of IPs
+_IDX_HEADER = struct.Struct('<4sQII')
+_IDX_MAGIC = b'GIX1'
+_CHECK_BYTES = 4096
+
+
+def _fsync_dir(path):
+    # make a rename or delete in the directory durable; not possible on every platform
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _tail_crc(f, end):
+    f.seek(max(0, end - _CHECK_BYTES))
+    return zlib.crc32(f.read(min(end, _CHECK_BYTES)))
+
+
+class GeoJournal(object):
+    """ A crash-safe writer for the `geo_ips` output CSV. Geolocations are committed in batches: each
+    batch is first written and fsync'd to a write-ahead log (`<output>.wal`), then appended to the CSV and
+    fsync'd, and only then is the log removed. If the process dies part way, opening the journal again
+    redoes or discards the interrupted batch, and drops any torn (incomplete) line at the end of the CSV,
+    so the file always parses with `parse_data.ip_geo_to_df`.
+
+    The journal also keeps a compact sidecar index (`<output>.idx`) of the IPs already in the CSV: a small
+    header and the zlib-compressed list of IPs. When resuming, only the part of the CSV written after the
+    index was saved has to be read.
+
+    Parameters
+    ----------
+    output_path: str
+      Path of the geolocation CSV. Created if it does not exist.
+    index_interval: int, default 10
+      Save the sidecar index every `index_interval` commits (and on `close`).
+
+    Example
+    -------
+    journal = GeoJournal('data/ip_geos.csv')
+    need = ip_set - journal.gathered
+    journal.commit(['185.40.4.65,185.40.4.65,NL,Netherlands,...\\r\\n'])
+    journal.close()
+    """
+
+    def __init__(self, output_path, index_interval=10):
+        self.output_path = output_path
+        self.wal_path = output_path + '.wal'
+        self.index_path = output_path + '.idx'
+        self.index_interval = index_interval
+        self.n_commits = 0
+        self.recovered = None # what `recover` found: None, 'redone', 'discarded', or 'truncated'
+
+        if not os.path.exists(output_path):
+            open(output_path, 'a').close()
+        self.recover()
+        self._out = open(output_path, 'ab')
+        self.gathered = self._load_gathered()
+
+    def recover(self):
+        """ Bring the CSV to a consistent state after a crash: redo the batch in a complete write-ahead
+        record, or discard an incomplete one, then drop any torn line at the end of the CSV.
+
+        Returns
+        -------
+        str or None
+          "redone", "discarded", or "truncated" if something had to be repaired, otherwise None.
+        """
+
+        if os.path.exists(self.wal_path):
+            with open(self.wal_path, 'rb') as wal:
+                record = wal.read()
+            payload = record[_WAL_HEADER.size:]
+            if len(record) >= _WAL_HEADER.size:
+                magic, size_before, n_bytes, crc = _WAL_HEADER.unpack_from(record)
+            if len(record) >= _WAL_HEADER.size and magic == _WAL_MAGIC and len(payload) == n_bytes \
+                    and zlib.crc32(payload) == crc:
+                # the batch may or may not have reached the CSV; rewriting it from the old end is idempotent
+                with open(self.output_path, 'r+b') as out:
+                    out.truncate(size_before)
+                    out.seek(size_before)
+                    out.write(payload)
+                    out.flush()
+                    os.fsync(out.fileno())
+                self.recovered = 'redone'
+            else:
+                # the log itself was torn, so the CSV was never touched
+                self.recovered = 'discarded'
+            os.remove(self.wal_path)
+            _fsync_dir(self.wal_path)
+
+        with open(self.output_path, 'r+b') as out:
+            size = out.seek(0, os.SEEK_END)
+            good = self._last_complete_line_end(out, size)
+            if good < size:
+                out.truncate(good)
+                out.flush()
+                os.fsync(out.fileno())
+                self.recovered = self.recovered or 'truncated'
+
+        if self.recovered:
+            print('Recovered geolocation journal for {}: {}.'.format(self.output_path, self.recovered))
+        return self.recovered
+
+    @staticmethod
+    def _last_complete_line_end(f, size):
+        # offset just past the last newline; a final line without one was cut off mid-write
+        pos = size
+        while pos > 0:
+            start = max(0, pos - 65536)
+            f.seek(start)
+            block = f.read(pos - start)
+            nl = block.rfind(b'\n')
+            if nl >= 0:
+                return start + nl + 1
+            pos = start
+        return 0
+
+    def _scan_ips(self, start):
+        with open(self.output_path, 'rb') as f:
+            f.seek(start)
+            return set(line.split(b',', 1)[0].decode() for line in f if b',' in line)
+
+    def _load_gathered(self):
+        """ Return the set of IPs already in the CSV, from the sidecar index plus a scan of the CSV after it. """
+
+        size = os.path.getsize(self.output_path)
+        covered, ips = 0, set()
+        try:
+            with open(self.index_path, 'rb') as idx:
+                data = idx.read()
+            magic, covered, crc, n_ips = _IDX_HEADER.unpack_from(data)
+            with open(self.output_path, 'rb') as f:
+                valid = magic == _IDX_MAGIC and covered <= size and _tail_crc(f, covered) == crc
+            if valid:
+                body = zlib.decompress(data[_IDX_HEADER.size:]).decode()
+                ips = set(body.split('\n')) if body else set()
+                valid = len(ips) == n_ips
+            if not valid:
+                covered, ips = 0, set()
+        except (OSError, struct.error, zlib.error, UnicodeDecodeError):
+            covered, ips = 0, set()
+
+        ips.update(self._scan_ips(covered))
+        self._indexed_bytes = covered
+        return ips
+
+    def save_index(self):
+        """ Write the sidecar index of the gathered IPs, atomically. """
+
+        self._out.flush()
+        covered = self._out.tell()
+        with open(self.output_path, 'rb') as f:
+            crc = _tail_crc(f, covered)
+        body = zlib.compress('\n'.join(sorted(self.gathered)).encode(), 6)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as idx:
+            idx.write(_IDX_HEADER.pack(_IDX_MAGIC, covered, crc, len(self.gathered)))
+            idx.write(body)
+            idx.flush()
+            os.fsync(idx.fileno())
+        os.replace(tmp_path, self.index_path)
+        self._indexed_bytes = covered
+
+    def commit(self, lines):
+        """ Durably append a batch of output lines (each "ip,<API CSV response>", ending in a newline) to
+        the CSV. When this returns, the batch survives a crash.
+
+        Returns
+        -------
+        int, the number of lines committed.
+        """
+
+        if not lines:
+            return 0
+        payload = ''.join(line if line.endswith('\n') else line + '\n' for line in lines).encode()
+
+        size_before = self._out.tell()
+        with open(self.wal_path, 'wb') as wal:
+            wal.write(_WAL_HEADER.pack(_WAL_MAGIC, size_before, len(payload), zlib.crc32(payload)))
+            wal.write(payload)
+            wal.flush()
+            os.fsync(wal.fileno())
+
+        self._out.write(payload)
+        self._out.flush()
+        os.fsync(self._out.fileno())
+        os.remove(self.wal_path)
+
+        self.gathered.update(line.split(',', 1)[0] for line in lines)
+        self.n_commits += 1
+        if self.index_interval and self.n_commits % self.index_interval == 0:
+            self.save_index()
+        return len(lines)
+
+    def close(self):
+        """ Save the sidecar index and close the CSV. """
+
+        if self._out.closed:
+            return
+        self.save_index()
+        self._out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
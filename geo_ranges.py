@@ -0,0 +1,229 @@
+import bisect
+import csv
+import heapq
+import io
+import ipaddress
+
+import numpy as np
+import pandas as pd
+
+import ip_utils
+
+# the geolocation fields of a freegeoip.app response, after the IP address
+GEO_FIELDS = ['country_code', 'country_name', 'region_code', 'region_name', 'city', 'zip_code',
+              'time_zone', 'latitude', 'longitude', 'metro_code']
+
+
+class GeoRangeIndex(object):
+    """ An offline IP geolocation engine. It builds a sorted table of non-overlapping address ranges from
+    the geolocations we have already paid for (the `geo_ips` output CSV) and from any imported range
+    database, merging neighbouring ranges with the same location. Lookups are a binary search over the
+    integer-encoded addresses, so only real misses need to go to the API.
+
+    Where ranges overlap, the most specific (smallest) range wins, so an individually geolocated IP
+    overrides the range database it falls in.
+
+    Example
+    -------
+    idx = GeoRangeIndex()
+    idx.add_geo_csv('data/ip_geos.csv', generalize_prefix=24)
+    idx.add_range_csv('ranges.csv')
+    idx.build()
+    idx.lookup('185.40.4.65')
+    """
+
+    def __init__(self):
+        self._ranges = {ip_utils.IPV4: [], ip_utils.IPV6: []} # (start, end, geo) before `build`
+        self._geos = []
+        self._built = False
+
+    def add_range(self, start, end, geo):
+        """ Add the address range [start, end] (IP strings or ints of the same family) with location `geo`,
+        a tuple of the `GEO_FIELDS` values.
+        """
+
+        start, end = ipaddress.ip_address(start), ipaddress.ip_address(end)
+        if start.version != end.version or int(end) < int(start):
+            raise ValueError('Invalid range: {} - {}'.format(start, end))
+        self._ranges[start.version].append((int(start), int(end), tuple(geo)))
+        self._built = False
+
+    def add_geo_csv(self, path, generalize_prefix=None):
+        """ Add the individual IP geolocations from a `geo_ips` output CSV.
+
+        Parameters
+        ----------
+        path: str
+          Path to the CSV (original IP, then the freegeoip.app CSV response). Only pass files of API answers:
+          the estimates that `GeolocateIPs` writes to its `_offline` file would be taken for exact locations.
+        generalize_prefix: int or None, default None
+          If given (e.g. 24), every IPv4 network of this prefix length in which all of the geolocated IPs
+          share one location is also added as a range with that location, so other IPs in the network
+          can be answered offline.
+
+        Returns
+        -------
+        int, the number of geolocations added.
+        """
+
+        points = {}
+        with open(path, newline='') as geod:
+            for row in csv.reader(geod):
+                if len(row) < 2 + len(GEO_FIELDS):
+                    continue
+                parsed = ip_utils.ip_to_int(row[0].strip())
+                if parsed is not None:
+                    points[parsed] = tuple(row[2:2 + len(GEO_FIELDS)])
+
+        networks = {}
+        if generalize_prefix is not None:
+            host_bits = 32 - generalize_prefix
+        for (value, family), geo in points.items():
+            self._ranges[family].append((value, value, geo))
+            if generalize_prefix is not None and family == ip_utils.IPV4:
+                networks.setdefault(value >> host_bits, set()).add(geo)
+        for net, geos in networks.items():
+            if len(geos) == 1:
+                start = net << host_bits
+                self._ranges[ip_utils.IPV4].append((start, start + (1 << host_bits) - 1, geos.pop()))
+
+        self._built = False
+        return len(points)
+
+    def add_range_csv(self, path):
+        """ Import a range database: a CSV with a header, either a `network` column (CIDR notation) or
+        `start_ip` and `end_ip` columns, and the `GEO_FIELDS` columns (missing ones are left empty).
+        Returns the number of ranges added.
+        """
+
+        ranges = pd.read_csv(path, dtype=str, keep_default_na=False)
+        geos = ranges.reindex(columns=GEO_FIELDS, fill_value='').itertuples(index=False, name=None)
+        if 'network' in ranges.columns:
+            bounds = (ipaddress.ip_network(n.strip(), strict=False) for n in ranges['network'])
+            bounds = ((n.network_address, n.broadcast_address) for n in bounds)
+        else:
+            bounds = zip(ranges['start_ip'].str.strip(), ranges['end_ip'].str.strip())
+        for (start, end), geo in zip(bounds, geos):
+            self.add_range(start, end, geo)
+
+        return len(ranges)
+
+    @staticmethod
+    def _flatten(ranges, geo_ids):
+        # sweep over the range boundaries, keeping the most specific range that covers each segment,
+        # then merge neighbouring segments with the same location
+        opens = sorted(((s, e) + (i,) for i, (s, e, _) in enumerate(ranges)))
+        points = sorted(set([s for s, _, _ in ranges] + [e + 1 for _, e, _ in ranges]))
+        starts, ends, ids = [], [], []
+        active = []
+        j = 0
+        for k, point in enumerate(points[:-1]):
+            while j < len(opens) and opens[j][0] == point:
+                s, e, i = opens[j]
+                heapq.heappush(active, (e - s, i, e))
+                j += 1
+            while active and active[0][2] < point:
+                heapq.heappop(active)
+            if not active:
+                continue
+            seg_end = points[k + 1] - 1
+            geo_id = geo_ids[active[0][1]]
+            if ends and ends[-1] == point - 1 and ids[-1] == geo_id:
+                ends[-1] = seg_end
+            else:
+                starts.append(point)
+                ends.append(seg_end)
+                ids.append(geo_id)
+
+        return starts, ends, ids
+
+    def build(self):
+        """ Build the sorted, merged lookup tables. Called automatically by the lookups if needed. """
+
+        geo_lookup = {}
+        self._tables = {}
+        for family, ranges in self._ranges.items():
+            geo_ids = [geo_lookup.setdefault(geo, len(geo_lookup)) for _, _, geo in ranges]
+            starts, ends, ids = self._flatten(ranges, geo_ids)
+            if family == ip_utils.IPV4:
+                self._tables[family] = (np.array(starts, dtype=np.uint64), np.array(ends, dtype=np.uint64),
+                                        np.array(ids, dtype=np.int64))
+            else:
+                self._tables[family] = (starts, ends, ids)
+        self._geos = list(geo_lookup)
+        self._geo_table = pd.DataFrame(self._geos, columns=GEO_FIELDS)
+        self._built = True
+
+    def __len__(self):
+        if not self._built:
+            self.build()
+        return sum(len(t[0]) for t in self._tables.values())
+
+    def _find(self, addr):
+        starts, ends, ids = self._tables[addr.version]
+        value = int(addr)
+        i = bisect.bisect_right(starts, value) - 1
+        if i >= 0 and value <= ends[i]:
+            return int(ids[i])
+        return None
+
+    def lookup(self, ip):
+        """ Return the location of `ip` as a dict of the `GEO_FIELDS`, or None if it is not covered. """
+
+        if not self._built:
+            self.build()
+        addr = ip_utils.parse_ip(ip)
+        geo_id = None if addr is None else self._find(addr)
+        return None if geo_id is None else dict(zip(GEO_FIELDS, self._geos[geo_id]))
+
+    def lookup_many(self, ips):
+        """ Vectorized lookup of many IPs. IPv4 addresses are searched with `np.searchsorted`.
+
+        Parameters
+        ----------
+        ips: array-like of str
+          IP addresses to look up.
+
+        Returns
+        -------
+        pd DataFrame
+          One row per IP (with the index of `ips` if it is a Series) with the `GEO_FIELDS` columns,
+          which are empty for IPs that are not covered, and a boolean `found` column.
+        """
+
+        if not self._built:
+            self.build()
+        ips = ips if isinstance(ips, pd.Series) else pd.Series(ips)
+        hi, lo, family = ip_utils.pack_ips(ips)
+        geo_ids = np.full(len(ips), -1, dtype=np.int64)
+
+        is_v4 = (family == ip_utils.IPV4).fillna(False).to_numpy(dtype=bool)
+        starts, ends, ids = self._tables[ip_utils.IPV4]
+        if is_v4.any() and len(starts):
+            values = lo[is_v4].to_numpy(dtype=np.uint64)
+            pos = np.searchsorted(starts, values, side='right') - 1
+            hit = (pos >= 0) & (values <= ends[np.maximum(pos, 0)])
+            v4_ids = np.where(hit, ids[np.maximum(pos, 0)], -1)
+            geo_ids[is_v4] = v4_ids
+
+        is_v6 = (family == ip_utils.IPV6).fillna(False).to_numpy(dtype=bool)
+        for i in np.flatnonzero(is_v6):
+            geo_id = self._find(ip_utils.parse_ip(ips.iloc[i]))
+            geo_ids[i] = -1 if geo_id is None else geo_id
+
+        result = self._geo_table.reindex(geo_ids)
+        result.index = ips.index
+        result['found'] = geo_ids >= 0
+        return result
+
+    def geo_text(self, ip):
+        """ Return the location of `ip` in the same CSV format as a freegeoip.app response (including the
+        trailing newline), or None if it is not covered.
+        """
+
+        geo = self.lookup(ip)
+        if geo is None:
+            return None
+        buf = io.StringIO()
+        csv.writer(buf, lineterminator='\r\n').writerow([ip_utils.canonical_ip(ip)] + [geo[f] for f in GEO_FIELDS])
+        return buf.getvalue()
@@ -1,6 +1,58 @@
+import asyncio
+import collections
+import datetime
+import email.utils
+import os
+import random
 import requests
+import threading
 import time
-import datetime
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+import ip_utils
+from geo_journal import GeoJournal
+
+# HTTP statuses worth retrying after a backoff; a 403 is the hourly quota and is handled separately
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def offline_path(output_path):
+    """ Return the path of the file that the offline index's answers for `output_path` are written to,
+    e.g. "data/ip_geos_offline.csv" for "data/ip_geos.csv" (see `GeolocateIPs`).
+    """
+
+    root, ext = os.path.splitext(output_path)
+    return root + '_offline' + ext
+
+class TokenBucket(object):
+    """ An asyncio token-bucket rate limiter: tokens refill at `rate` per second, up to `capacity`,
+    and each call to `acquire` waits for and takes one token.
+
+    Parameters
+    ----------
+    rate: float
+      Tokens added per second.
+    capacity: int
+      Maximum number of tokens that can build up, i.e. the largest burst allowed.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
 class GeolocateIPs(object):
     """ Using a list of IPs, retrieves IP geolocation information 
@@ -9,13 +61,70 @@ class GeolocateIPs(object):
     5 minutes before trying again. If an output path is supplied,
     the methods will scan that file for previously geolocated IPs,
     so as not to repeat the geolocations, to save API calls. 
+
+    Parameters
+    ----------
+    cache: geo_cache.GeoCache or None, default None
+      If given, every new geolocation is added to it, IPs with a fresh entry are
+      not geolocated again, and IPs already in the output file are only geolocated
+      again once their entry has expired. The newer line is appended to the file;
+      `parse_data.ip_geo_to_df` keeps the last line of each IP.
+    offline_index: geo_ranges.GeoRangeIndex or None, default None
+      If given, IPs the offline index can answer are not sent to the API. Its
+      answers are estimates, so they are written to their own file (see
+      `offline_path`) instead of the output file and the cache, and are never
+      read back into an index as exact geolocations. Load both files with
+      `parse_data.ip_geo_to_df(output_path, offline_filename=...)`.
+    max_retries: int, default 3
+      Number of times a call is retried after a connection error or a
+      retryable status (429 or 5xx), with jittered exponential backoff.
+    backoff_factor: float, default 0.5
+      Base of the backoff, in seconds: retry `n` waits about
+      `backoff_factor * 2**n` seconds, unless the API sends a `Retry-After`.
+    max_backoff: float, default 60
+      Longest wait between retries, in seconds.
+    pool_size: int, default 10
+      Number of keep-alive connections kept open to the API. `geo_ips_async` raises
+      it to its `concurrency`, so every call in flight keeps its connection.
+    timeout: float, default 10
+      Seconds to wait for each API response.
     """
 
-    def __init__(self):
+    def __init__(self, cache=None, offline_index=None, max_retries=3, backoff_factor=0.5,
+                 max_backoff=60, pool_size=10, timeout=10):
 
         self.ip_set = set()
         self.output_lines = []
-        self.failed_ips = [] # IPs that failed, for whatever reason
+        self.retry_queue = collections.deque() # IPs to try again at the end of the run
+        self.failed_ips = [] # IPs that failed, for whatever reason, even after retrying
+        self.cache = cache
+        self.offline_index = offline_index
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+        self._journal = None # the `GeoJournal` of the current run, if any
+
+        # one session for the whole run, so connections (and their TLS handshakes) are reused
+        self.session = requests.Session()
+        self.session.headers.update({
+            'accept': "application/csv",
+            'content-type': "application/csv"
+        })
+        self.pool_size = 0
+        self._size_pool(pool_size)
+
+    def _size_pool(self, pool_size):
+        # urllib3 closes the connections returned beyond `pool_maxsize`, so a pool smaller than the number of
+        # calls in flight would open new connections (and TLS handshakes) all the time
+        if pool_size > self.pool_size:
+            self.pool_size = pool_size
+            old_adapter = self.session.adapters.get('https://')
+            self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+            if old_adapter is not None:
+                old_adapter.close()
 
     def _query_api(self, ip_addr):
         """ Given an ip_addr as a string, query the freegeoip API and return the response
@@ -32,16 +141,150 @@ class GeolocateIPs(object):
 
         url_ip = "https://freegeoip.app/csv/{}".format(ip_addr)
 
-        headers = {
-            'accept': "application/csv",
-            'content-type': "application/csv"
-        }
+        response = self.session.get(url_ip, timeout=self.timeout)
+
+        return response
+
+    def _count(self, stat, n=1):
+        with self._stats_lock:
+            self.stats[stat] = self.stats.get(stat, 0) + n
+
+    @staticmethod
+    def _retry_after(response):
+        """ Return the `Retry-After` header of `response` in seconds, or None if there isn't a valid one. """
+
+        value = response.headers.get('Retry-After') if response is not None else None
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        try:
+            retry_at = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, (retry_at - datetime.datetime.now(retry_at.tzinfo)).total_seconds())
+
+    def _backoff(self, attempt, response=None):
+        """ Seconds to wait before retry number `attempt` (from 0): the server's `Retry-After` if it sent
+        one, otherwise exponential backoff with jitter, so parallel clients don't retry in lockstep.
+        """
+
+        retry_after = self._retry_after(response)
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        delay = min(self.max_backoff, self.backoff_factor * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def _query_with_retries(self, ip_addr, acquire=None):
+        """ Query the API for `ip_addr`, retrying connection errors and retryable statuses up to
+        `max_retries` times.
+
+        Parameters
+        ----------
+        ip_addr: str
+          The IP address to geolocate.
+        acquire: callable or None, default None
+          Called before every HTTP attempt, retries included, e.g. to take a token from a rate limiter.
+
+        Returns
+        -------
+        requests response, or None if every attempt failed with a connection error.
+        """
 
-        response = requests.request("GET", url_ip, headers=headers)
+        response = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                self._count('retries')
+                time.sleep(self._backoff(attempt - 1, response))
+            if acquire is not None:
+                acquire()
+            self._count('requests')
+            try:
+                response = self._query_api(ip_addr)
+            except requests.exceptions.SSLError:
+                self._count('ssl_errors')
+                response = None
+                continue
+            except requests.exceptions.RequestException:
+                self._count('connection_errors')
+                response = None
+                continue
+            if response.status_code not in RETRY_STATUSES:
+                return response
+            self._count('retryable_statuses')
 
         return response
 
-    def load_ip_list(self, ip_list_path):
+    def _reset_stats(self):
+        self.stats = {'requests': 0, 'retries': 0, 'succeeded': 0, 'rate_limited': 0, 'retryable_statuses': 0,
+                      'ssl_errors': 0, 'connection_errors': 0, 'queued_for_retry': 0, 'recovered': 0, 'failed': 0}
+        self._run_start = time.monotonic()
+
+    def print_stats(self):
+        """ Print the summary of the last `geo_ips` or `geo_ips_async` run (also kept in the `stats` attribute). """
+
+        elapsed = self.stats.get('elapsed_s') or 0
+        print('{}: {} geolocations in {}s from {} API requests ({} retries, {} rate limited, {} SSL errors, '
+              '{} connection errors). {} IPs retried at the end, {} recovered, {} failed.'.\
+              format(datetime.datetime.now(), self.stats.get('succeeded', 0), elapsed, self.stats.get('requests', 0),
+                     self.stats.get('retries', 0), self.stats.get('rate_limited', 0), self.stats.get('ssl_errors', 0),
+                     self.stats.get('connection_errors', 0), self.stats.get('queued_for_retry', 0),
+                     self.stats.get('recovered', 0), self.stats.get('failed', 0)))
+
+    def _finish_stats(self):
+        self.stats['elapsed_s'] = round(time.monotonic() - self._run_start, 1)
+        self.print_stats()
+
+    def _queue_retry(self, ip):
+        self.retry_queue.append(ip)
+        self._count('queued_for_retry')
+
+    def retry_failed(self, output_path, acquire=None):
+        """ Try each IP in the `retry_queue` once more (with the usual retries and backoff), appending the
+        geolocations to `output_path`. IPs that still fail are moved to the `failed_ips` list. `acquire` is
+        called before every HTTP attempt (see `_query_with_retries`).
+
+        Returns
+        -------
+        int, the number of IPs recovered.
+        """
+
+        recovered = []
+        while self.retry_queue:
+            ip = self.retry_queue.popleft()
+            response = self._query_with_retries(ip, acquire)
+            if response is not None and response.status_code == 200:
+                recovered.append(','.join((ip, response.text)))
+                if self.cache is not None:
+                    self.cache.put(ip, response.text)
+            else:
+                self.failed_ips.append(ip)
+                self._count('failed')
+
+        self._write(output_path, recovered)
+        self._count('recovered', len(recovered))
+        self._count('succeeded', len(recovered))
+        return len(recovered)
+
+    def _open_journal(self, output_path, journal):
+        if journal:
+            self._journal = GeoJournal(output_path)
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _write(self, output_path, lines):
+        """ Append output lines to `output_path`, through the run's journal if it has one. """
+
+        if self._journal is not None:
+            self._journal.commit(lines)
+        else:
+            with open(output_path, 'a') as outfile:
+                outfile.writelines(lines)
+
+    def load_ip_list(self, ip_list_path, normalize=True):
         """  Load the IP list from a file. This function assumes the 
         file is a list of IPs, one IP per line. It returns a set
         of the IPs (i.e. removes duplicates). 
@@ -50,6 +293,10 @@ class GeolocateIPs(object):
         ----------
         ip_list_path: str
             Path to IP list. List should be a text file with one IP address per row. 
+        normalize: bool, default True
+            Normalize the IPs with `ip_utils.normalize_ip`, so that different forms of one address
+            (e.g. "::ffff:185.40.4.65" and "185.40.4.65") are only geolocated once, and private,
+            bogon, and invalid addresses, which can't be geolocated, are dropped.
 
         Returns
         -------
@@ -61,11 +308,73 @@ class GeolocateIPs(object):
             ips = ipf.readlines()
             ips = [ip.strip() for ip in ips] # remove newlines
 
-        self.ip_set = set(ips)
+        if normalize:
+            raw_set = set(ip for ip in ips if ip)
+            normalized, stats = ip_utils.normalize_ips(list(raw_set))
+            self.ip_set = set(normalized.dropna())
+            print('Normalized {} distinct IP strings: merged {} duplicate forms and dropped {} invalid or '
+                  'non-public addresses, saving {} API calls.'.format(
+                      len(raw_set), stats['merged'], stats['rejected'], len(raw_set) - len(self.ip_set)))
+        else:
+            self.ip_set = set(ips)
         print('Found {} unique IP addresses.'.format(len(self.ip_set)))
         return self.ip_set
 
-    def geo_ips(self, ip_set, output_path, write_interval=1000, sleep_interval=300):
+    def _need_geos(self, ip_set, output_path, calls_per_hour=15000):
+        """ Return the IPs in `ip_set` that have not already been geolocated in `output_path`
+        and have no fresh entry in the cache, if the object has one. IPs in `output_path` whose
+        cache entry has expired are returned too. If the object has an offline index, the IPs
+        it can answer are written to `offline_path(output_path)` here and are not returned, nor
+        are the IPs it answered in earlier runs.
+        """
+
+        # make sure `ip_set` is the right type:
+        if not isinstance(ip_set, set):
+            # try to force ip_set to be a set
+            if isinstance(ip_set, list):
+                ip_set = set(ip_set)
+            else:
+                raise TypeError('`ip_set` parameter must be of type set or list.')
+
+        # first find unique IPs
+        if self._journal is not None:
+            gathered = self._journal.gathered.intersection(ip_set)
+        else:
+            gathered = set()
+            if os.path.exists(output_path):
+                with open(output_path, 'r') as geod:
+                    gathered = set(g.split(',')[0] for g in geod)
+        if self.cache is not None:
+            # IPs in the file but not in the cache (e.g. from a run without one) aren't fetched again
+            fresh = set(self.cache.get_many(ip_set))
+            gathered = fresh.union(gathered.difference(self.cache.expired(ip_set.difference(fresh))))
+        print('Previously geolocated {} IP addresses.'.format(len(gathered)))
+
+        need_geos = ip_set.difference(gathered)
+
+        if self.offline_index is not None:
+            # kept apart from the API's answers, so an estimate is never taken for a real geolocation (and
+            # used to estimate its neighbours) by a later `GeoRangeIndex.add_geo_csv`
+            with GeoJournal(offline_path(output_path)) as offline:
+                need_geos = need_geos.difference(offline.gathered)
+                offline_lines = []
+                for ip in need_geos:
+                    geo = self.offline_index.geo_text(ip)
+                    if geo is not None:
+                        offline_lines.append(','.join((ip, geo)))
+                offline.commit(offline_lines)
+            need_geos = need_geos.difference(line.split(',', 1)[0] for line in offline_lines)
+            print('Geolocated {} IP addresses from the offline index, in {}.'.format(
+                len(offline_lines), offline.output_path))
+
+        time_needed = round(len(need_geos) / calls_per_hour, 1) # this is the hourly rate limit
+        msg = (len(need_geos), time_needed)
+        # actual time may differ depending on API fetch speed
+        print('Fetching {} new geolocations. This will take at least {} hours.'.format(msg[0], msg[1]))
+
+        return need_geos
+
+    def geo_ips(self, ip_set, output_path, write_interval=100, sleep_interval=300, journal=True):
         """ Geolocate IP addresses using the freegeoip.app API. This function takes
         a list or set of the IP addresses you wish to geolocate and an output file path. 
         The function queries the freegeoip.app api, obtaining a CSV of the possible 
@@ -79,7 +388,7 @@ class GeolocateIPs(object):
           The list of IP addresses to geolocate. 
         output_path: str
           The path to the output file to write geolocations
-        write_interval: int, default 1000
+        write_interval: int, default 100
           When calling a large number of IP addresses, you will periodically want to save
           the geolocations to a file, in case the program crashes. The `write_interval` 
           specifies how often to save the CSVs to a file. For example if `write_interval = 100`, 
@@ -88,6 +397,9 @@ class GeolocateIPs(object):
           API calls to the freegeoip.app are limited to 15,000 per hour. If you happen to exceed 
           that rate limit (indicated by a `403` http message), this program will sleep for
           `sleep_interval` seconds before trying again. 
+        journal: bool, default True
+          Write through a `geo_journal.GeoJournal`, so each batch is committed atomically and a
+          run interrupted part way can be resumed without torn lines or re-reading the whole file.
 
         Returns
         -------
@@ -96,76 +408,189 @@ class GeolocateIPs(object):
         """
 
         self.output_lines = []
+        self._reset_stats()
         # write to file every 5000 geolocated IPs
         prev_write_record = 0
         record_count = 0
 
-        # first find unique IPs
-        with open(output_path, 'r') as geod:
-            gathered = [g.split(',')[0] for g in geod]
-            gathered = set(gathered)
-        print('Previously geolocated {} IP addresses.'.format(len(gathered)))
+        try:
+            self._open_journal(output_path, journal)
+            need_geos = self._need_geos(ip_set, output_path)
 
-        # make sure `ip_set` is the right type:
-        if not isinstance(ip_set, set):
-            # try to force ip_set to be a set
-            if isinstance(ip_set, list):
-                ip_set = set(ip_set)
-            else:
-                raise TypeError('`ip_set` parameter must be of type set or list.')
+            failures_in_row = 0
+            for ip in need_geos:
+                record_count += 1
+                response = self._query_with_retries(ip)
+                if response is not None and response.status_code == 403:
+                    # print a sleep message; a `Retry-After` of 0 is valid, and means no wait
+                    wait = self._retry_after(response)
+                    if wait is None:
+                        wait = sleep_interval
+                    print('{}: Reached hourly query limit. Sleeping for {} seconds.'.\
+                        format(datetime.datetime.now(), wait))
+                    self._count('rate_limited')
+                    time.sleep(wait)
+                    response = self._query_with_retries(ip)
 
-        need_geos = ip_set.difference(gathered)
+                if response is not None and response.status_code == 200:
+                    failures_in_row = 0
+                    newline = ','.join((ip, response.text))
+                    self.output_lines.append(newline)
+                    self._count('succeeded')
+                    if self.cache is not None:
+                        self.cache.put(ip, response.text)
+                else:
+                    failures_in_row += 1
+                    reason = 'Connection failed' if response is None else 'Return code: {}'.format(response.status_code)
+                    print('{}: {} for IP {} at record {}. Adding IP to `retry_queue`.'.\
+                        format(datetime.datetime.now(), reason, ip, record_count))
+                    self._queue_retry(ip)
+                    if failures_in_row >= 10: # too many failures in a row, let's rest awhile
+                        print('{}: 10 failures in a row. Sleeping for {} seconds.'.\
+                            format(datetime.datetime.now(), sleep_interval))
+                        time.sleep(sleep_interval)
+                        failures_in_row = 0
+                if record_count % 1000 == 0:
+                    print('{}: Completed {} IP pulls.'.format(datetime.datetime.now(), record_count))
 
-        time_needed = round(len(need_geos) / 15000, 1) # this is the hourly rate limit
-        msg = (len(need_geos), time_needed)
-        # actual time may differ depending on API fetch speed
-        print('Fetching {} new geolocations. This will take at least {} hours.'.format(msg[0], msg[1]))
+                # at the write interval, write file
+                if record_count % write_interval == 0:
+                    print('{}: Writing IP geolocations for IPs {}-{} to file.'.\
+                        format(datetime.datetime.now(), prev_write_record, record_count))
+                    self._write(output_path, self.output_lines)
+                    self.output_lines = [] # reset output lines
+                    prev_write_record = record_count
+
+            # write at the end too
+            print('{}: Writing IP geolocations for IPs {}-{} to file.'.\
+                format(datetime.datetime.now(), prev_write_record, record_count))
+            self._write(output_path, self.output_lines)
+
+            if self.retry_queue:
+                print('{}: Retrying {} failed IPs.'.format(datetime.datetime.now(), len(self.retry_queue)))
+                self.retry_failed(output_path)
+        finally:
+            self._close_journal()
+
+        self._finish_stats()
+        if len(self.failed_ips) > 0:
+            print('Failed to write {} IPs. See `failed_ips` attribute of object.'.\
+                    format(len(self.failed_ips)))
+
+    async def geo_ips_async(self, ip_set, output_path, concurrency=10, calls_per_hour=15000, sleep_interval=300,
+                            write_interval=100, journal=True):
+        """ Geolocate IP addresses like `geo_ips`, but with up to `concurrency` API calls in flight at once,
+        so the run is no longer bound by the round-trip time of each call. A client-side token bucket
+        keeps the calls under the API's hourly quota, so the `403` limit should never be hit; every attempt,
+        retries and the final `retry_failed` pass included, takes a token. Each 
+        geolocations are appended to the output file in batches of `write_interval`, written on a background
+        thread so the event loop never waits on the disk.
+
+        This is a coroutine: run it with `asyncio.run(geo.geo_ips_async(...))`, or `await` it from a
+        Jupyter notebook.
+
+        Parameters
+        ----------
+        ip_set: set or list
+          The list of IP addresses to geolocate. 
+        output_path: str
+          The path to the output file to write geolocations
+        concurrency: int, default 10
+          Maximum number of API calls in flight at once.
+        calls_per_hour: int, default 15000
+          The API's published hourly quota. 
+        sleep_interval: int, default 300
+          If a `403` is returned anyway (e.g. the quota is shared with another client), all calls pause
+          for `sleep_interval` seconds and the IP is retried.
+        write_interval: int, default 100
+          Number of geolocations written to the file (one journal commit) at a time. See `geo_ips`.
+        journal: bool, default True
+          Commit each batch of geolocations through a `geo_journal.GeoJournal`. See `geo_ips`.
+
+        Returns
+        -------
+        None. All output is written to the `output_path` file. 
+        """
+
+        self._reset_stats()
+        self._size_pool(concurrency)
+        # leave room for a full burst within the hour, so the quota can't be exceeded in any hour
+        bucket = TokenBucket(rate=(calls_per_hour - concurrency) / 3600.0, capacity=concurrency)
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        # one writer thread, so the batches are committed in order and off the event loop
+        writer = ThreadPoolExecutor(max_workers=1)
+        queue = asyncio.Queue()
+        pending = []
+        paused_until = [0.0]
+        counts = {'done': 0}
 
-        ssl_errors = []
-        for ip in need_geos:
-            record_count += 1
-            try: 
-                response = self._query_api(ip)
-                ssl_errors = []
+        async def flush():
+            if pending:
+                lines = pending[:]
+                del pending[:]
+                await loop.run_in_executor(writer, self._write, output_path, lines)
+
+        def acquire():
+            # every HTTP attempt, retries included, takes a token; runs in the executor threads
+            asyncio.run_coroutine_threadsafe(bucket.acquire(), loop).result()
+
+        async def worker():
+            while True:
+                try:
+                    ip = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                await asyncio.sleep(max(0.0, paused_until[0] - time.monotonic()))
+                response = await loop.run_in_executor(executor, self._query_with_retries, ip, acquire)
+                if response is None:
+                    print('{}: Connection failed for IP {}. Adding IP to `retry_queue`.'.format(datetime.datetime.now(), ip))
+                    self._queue_retry(ip)
+                    continue
                 if response.status_code == 200:
-                    newline = ','.join((ip, response.text))
-                    self.output_lines.append(newline)
+                    pending.append(','.join((ip, response.text)))
+                    if len(pending) >= write_interval:
+                        await flush()
+                    if self.cache is not None:
+                        self.cache.put(ip, response.text)
+                    self._count('succeeded')
+                    counts['done'] += 1
+                    if counts['done'] % 1000 == 0:
+                        print('{}: Completed {} IP pulls.'.format(datetime.datetime.now(), counts['done']))
                 elif response.status_code == 403:
-                    # print a sleep message
-                    print('{}: Reached hourly query limit. Sleeping for {} seconds.'.\
-                        format(datetime.datetime.now(), sleep_interval))
-                    time.sleep(sleep_interval)
+                    # a `Retry-After` of 0 is valid, and means no wait
+                    wait = self._retry_after(response)
+                    if wait is None:
+                        wait = sleep_interval
+                    print('{}: Reached hourly query limit. Pausing for {} seconds.'.\
+                        format(datetime.datetime.now(), wait))
+                    self._count('rate_limited')
+                    paused_until[0] = time.monotonic() + wait
+                    queue.put_nowait(ip)
                 else:
-                    print('{}: Return code: {} for IP {}. Adding IP to `failed_ips` list.'.\
+                    print('{}: Return code: {} for IP {}. Adding IP to `retry_queue`.'.\
                         format(datetime.datetime.now(), response.status_code, ip))
-                    self.failed_ips.append(ip)
-            except requests.exceptions.SSLError as e:
-                print('{}: SSL Error at record {}, IP {}'.\
-                    format(datetime.datetime.now(), record_count, ip)) 
-                self.failed_ips.append(ip)
-                if len(ssl_errors) > 10: # too many failures in a row, let's rest awhile
-                    print('{}: 10 SSL Errors in a row. Sleeping for awhile.'.\
-                        format(datetime.datetime.now()))
-                    time.sleep(sleep_interval)
-                    ssl_errors = []
-            if record_count % 1000 == 0:
-                print('{}: Completed {} IP pulls.'.format(datetime.datetime.now(), record_count))
-
-            # at the write interval, write file
-            if record_count % write_interval == 0:
-                print('{}: Writing IP geolocations for IPs {}-{} to file.'.\
-                    format(datetime.datetime.now(), prev_write_record, record_count))
-                with open(output_path, 'a') as outfile:
-                    outfile.writelines(self.output_lines)
-                self.output_lines = [] # reset output lines
-                prev_write_record = record_count
-
-        # write at the end too
-        print('{}: Writing IP geolocations for IPs {}-{} to file.'.\
-            format(datetime.datetime.now(), prev_write_record, record_count))
-        with open(output_path, 'a') as outfile:
-            outfile.writelines(self.output_lines)
+                    self._queue_retry(ip)
+
+        try:
+            self._open_journal(output_path, journal)
+            for ip in self._need_geos(ip_set, output_path, calls_per_hour):
+                queue.put_nowait(ip)
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            await flush()
+            print('{}: Wrote {} IP geolocations to file.'.format(datetime.datetime.now(), counts['done']))
+            if self.retry_queue:
+                print('{}: Retrying {} failed IPs.'.format(datetime.datetime.now(), len(self.retry_queue)))
+                await loop.run_in_executor(writer, self.retry_failed, output_path, acquire)
+        finally:
+            executor.shutdown(wait=False)
+            writer.shutdown(wait=True)
+            # keep what was fetched before an error
+            if pending:
+                self._write(output_path, pending)
+            self._close_journal()
 
+        self._finish_stats()
         if len(self.failed_ips) > 0:
             print('Failed to write {} IPs. See `failed_ips` attribute of object.'.\
-                    format(len(self.failed_ips)))
\ No newline at end of file
+                    format(len(self.failed_ips)))
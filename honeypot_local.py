@@ -0,0 +1,270 @@
+# A local stand-in for the honeypot data warehouse: `honeypot_local` runs the same `table_commands` (the
+# DDL, COPY from local files, and INSERT statements) in an embedded DuckDB database, translating the
+# Redshift-only syntax, so the ETL and the data checks can run on a laptop, or in tests, without a cluster.
+import configparser
+import contextlib
+import json
+import re
+import threading
+import uuid
+
+from honeypot_redshift import honeypot_redshift
+from sql_queries import honeypot_sql as SQL_QUERIES
+from sql_queries import schema_tuning
+
+_COPY_RE = re.compile(r"^\s*COPY\s+(\w+)\s+FROM\s+'([^']*)'(.*?);?\s*$", re.IGNORECASE | re.DOTALL)
+_CREATE_RE = re.compile(r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', re.IGNORECASE)
+_DROP_RE = re.compile(r'^\s*DROP\s+TABLE\s+(?:IF\s+EXISTS\s+)?(\w+)', re.IGNORECASE)
+_IDENTITY_RE = re.compile(r'\bIDENTITY\s*\(\s*(-?\d+)\s*,\s*(-?\d+)\s*\)', re.IGNORECASE)
+# table and column attributes that only mean something to Redshift; constraints are dropped too, since
+# Redshift doesn't enforce them and the loads rely on that
+_REDSHIFT_ONLY_RE = re.compile(r'\s+ENCODE\s+\w+|\s+PRIMARY\s+KEY\b|\s*\bDISTSTYLE\s+\w+|\s*\bDISTKEY\s*\([^)]*\)'
+                               r'|\s*\b(?:COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)', re.IGNORECASE)
+_ROWCOUNT_RE = re.compile(r'^\s*(INSERT|DELETE|UPDATE|COPY)\b', re.IGNORECASE)
+
+
+class _DuckDBCursor(object):
+    # the part of the psycopg2 cursor interface that `honeypot_redshift` and `data_checks` use
+
+    def __init__(self, conn):
+        self.connection = conn
+        self.rowcount = -1
+        self._result = None
+
+    def execute(self, sql):
+        conn = self.connection
+        if not conn.autocommit and not conn.in_transaction:
+            conn.db.execute('BEGIN TRANSACTION;')
+            conn.in_transaction = True
+        self._result = conn.db.execute(sql)
+        # DuckDB returns the number of rows changed as the result of the statement
+        self.rowcount = self._result.fetchone()[0] if _ROWCOUNT_RE.match(sql) else -1
+
+    def fetchone(self):
+        return self._result.fetchone()
+
+    def fetchall(self):
+        return self._result.fetchall()
+
+    def close(self):
+        self._result = None
+
+
+class _DuckDBConnection(object):
+    # a psycopg2-style connection over a DuckDB connection: statements run in a transaction that is opened
+    # implicitly and ended by `commit` or `rollback`, unless `autocommit` is set
+
+    def __init__(self, db):
+        self.db = db
+        self.autocommit = False
+        self.in_transaction = False
+        self.closed = 0
+
+    def cursor(self):
+        return _DuckDBCursor(self)
+
+    def commit(self):
+        if self.in_transaction:
+            self.db.execute('COMMIT;')
+            self.in_transaction = False
+
+    def rollback(self):
+        if self.in_transaction:
+            self.db.execute('ROLLBACK;')
+            self.in_transaction = False
+
+    def close(self):
+        self.db.close()
+        self.closed = 1
+
+
+class honeypot_local(honeypot_redshift):
+    """ This class runs the honeypot data warehouse in a local DuckDB database instead of a Redshift cluster,
+    with the same methods as `honeypot_redshift` (`create_tables`, `copy_into_tables`, `parallel_load`,
+    `rebuild`, ...) and the same SQL queries. The statements are translated on the way to DuckDB: COPY reads
+    local CSV or Parquet files (or the files in a local manifest) without the AWS options, the distribution,
+    sort key, encoding, and primary key parts of the DDL are dropped, `IDENTITY` columns use sequences,
+    `VARCHAR(MAX)` becomes `VARCHAR`, and `GETDATE()` becomes the current UTC time.
+
+    No AWS credentials, boto3, or psycopg2 are needed. `analyze_compression` and `stage_sliced_files` raise a
+    RuntimeError, and the load metrics (see `write_load_metrics`) have no bytes scanned or STL_LOAD_ERRORS rows;
+    DuckDB's COPY errors name the bad line themselves.
+
+    Parameters
+    ----------
+    config_file: str or None, default None
+      Path to a configuration file with a `LOCAL` section holding `DATABASE` and the local staging files
+      `HONEYPOT_DATA`, `REPUTATION_DATA`, `IP_GEO_DATA`, and optionally `HONEYPOT_PARQUET_DATA` (see
+      "aws_example.cfg").
+    database: str or None, default None
+      Path of the DuckDB database file, or ":memory:". Overrides `DATABASE` in the config; defaults to ":memory:".
+    data_paths: dict or None, default None
+      Local staging files, keyed by staging table (e.g. {"staging_honeypot": "data/honeypot.csv"}). Override
+      the paths in the config.
+
+    Example
+    -------
+    hl = honeypot_local(database=':memory:', data_paths={'staging_honeypot': 'honeypot.csv',
+                        'staging_reputation': 'reputation.csv', 'staging_ipgeo': 'ip_geos.csv'})
+    hl.db_connect()
+    hl.create_tables()
+    hl.parallel_load()
+    """
+
+    def __init__(self, config_file=None, database=None, data_paths=None):
+        # the `redshift` setup reads the AWS section of the config and makes boto3 clients, so it is skipped
+        config = configparser.ConfigParser()
+        if config_file is not None:
+            with open(config_file) as cf:
+                config.read_file(cf)
+        if not config.has_section('LOCAL'):
+            config.add_section('LOCAL')
+
+        self.database = database or config.get('LOCAL', 'DATABASE', fallback=':memory:')
+        paths = {
+            'staging_honeypot': config.get('LOCAL', 'HONEYPOT_DATA', fallback=None),
+            'staging_reputation': config.get('LOCAL', 'REPUTATION_DATA', fallback=None),
+            'staging_ipgeo': config.get('LOCAL', 'IP_GEO_DATA', fallback=None)
+        }
+        paths.update(data_paths or {})
+        # the COPY commands take the paths quoted, as they are in the S3 section of the config
+        self.data_paths = {table: self._quote(path) for table, path in paths.items()}
+        self.parquet_paths = {
+            'staging_honeypot': self._quote(config.get('LOCAL', 'HONEYPOT_PARQUET_DATA', fallback=None))
+        }
+        self.manifest_paths = {}
+        self.s3_sliced = None
+        self.encodings_file = None
+        self.table_cmds = schema_tuning.tuned_table_commands(SQL_QUERIES.table_commands)
+        self.load_concurrency = config.getint('LOCAL', 'LOAD_CONCURRENCY', fallback=4)
+        self.IAM_ROLE = ''
+        self.collect_query_stats = False
+        self.load_metrics = []
+        self._metrics_lock = threading.Lock()
+        self.db = None
+        self.conn = None
+
+    @staticmethod
+    def _quote(path):
+        if path is None or path[:1] in ('"', "'"):
+            return path
+        return "'{}'".format(path)
+
+    def db_connect(self):
+        """ Open the DuckDB database, creating the file if needed, and keep a connection to it as `conn`.
+
+        Returns
+        -------
+        None
+        """
+
+        try:
+            import duckdb
+        except ImportError:
+            raise ImportError('The local backend requires the `duckdb` package.')
+
+        self.close()
+        self.db = duckdb.connect(self.database)
+        self.conn = _DuckDBConnection(self.db)
+
+    def close(self):
+        """ Close the database. """
+
+        if self.db is not None:
+            self.db.close()
+        self.db = None
+        self.conn = None
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ Open a connection to the database for the duration of a `with` block. Each one has its own
+        transaction, so parallel loads work as they do on Redshift.
+        """
+
+        if self.db is None:
+            self.db_connect()
+        conn = _DuckDBConnection(self.db.cursor())
+        try:
+            yield conn
+        finally:
+            conn.rollback()
+            conn.close()
+
+    def _run_statement(self, cur, sql):
+        rows = -1
+        for statement in self._translate(sql):
+            drop = _DROP_RE.match(statement)
+            sequences = self._sequences(cur, drop.group(1)) if drop else []
+            cur.execute(statement)
+            # a manifest is copied one file at a time
+            rows = cur.rowcount + max(rows, 0) if cur.rowcount >= 0 else rows
+            # the sequences of dropped IDENTITY columns aren't dropped with their table
+            for sequence in sequences:
+                cur.execute('DROP SEQUENCE IF EXISTS {};'.format(sequence))
+        cur.rowcount = rows
+
+    def _load_errors(self, cur, limit=20):
+        return []
+
+    def _sequences(self, cur, table):
+        cur.execute("SELECT column_default FROM information_schema.columns "
+                    "WHERE table_schema = current_schema() AND table_name = '{}';".format(table))
+        return [m.group(1) for (default,) in cur.fetchall()
+                for m in [re.match(r"nextval\('([^']+)'", default or '')] if m]
+
+    def _translate(self, sql):
+        """ Translate a Redshift statement into DuckDB statements.
+
+        Parameters
+        ----------
+        sql: str
+          A statement from `sql_queries`.
+
+        Returns
+        -------
+        list of str
+        """
+
+        copy = _COPY_RE.match(sql)
+        if copy:
+            return self._translate_copy(*copy.groups())
+
+        statements = []
+        sql = re.sub(r'\bVARCHAR\s*\(\s*MAX\s*\)', 'VARCHAR', sql, flags=re.IGNORECASE)
+        sql = re.sub(r'\bGETDATE\s*\(\s*\)', "(NOW() AT TIME ZONE 'UTC')", sql, flags=re.IGNORECASE)
+        create = _CREATE_RE.search(sql)
+        if create:
+            sql = _REDSHIFT_ONLY_RE.sub('', sql)
+            if _IDENTITY_RE.search(sql):
+                # a new sequence name each time, since a renamed table (see `rebuild`) keeps its sequence
+                sequence = '{}_id_seq_{}'.format(create.group(1), uuid.uuid4().hex[:8])
+                start, step = _IDENTITY_RE.search(sql).groups()
+                statements.append('CREATE SEQUENCE {} START {} INCREMENT {} MINVALUE {};'.format(
+                    sequence, start, step, min(int(start), 0)))
+                sql = _IDENTITY_RE.sub("DEFAULT nextval('{}')".format(sequence), sql)
+        statements.append(sql)
+        return statements
+
+    def _translate_copy(self, table, path, options):
+        options = ' '.join(options.split()).upper()
+        header = re.search(r'\bIGNOREHEADER\s+(\d+)', options)
+        if 'PARQUET' in options:
+            copy_options = '(FORMAT PARQUET)'
+        else:
+            copy_options = '(FORMAT CSV, HEADER false, SKIP {})'.format(header.group(1) if header else 0)
+
+        if 'MANIFEST' in options:
+            with open(path) as mf:
+                paths = [entry['url'] for entry in json.load(mf)['entries']]
+        else:
+            paths = [path]
+        # TIMEFORMAT 'auto' is DuckDB's default; GZIP files are read by their extension
+        return ["COPY {} FROM '{}' {};".format(table, p, copy_options) for p in paths]
+
+    def analyze_compression(self, tables='all', output_path=None):
+        raise RuntimeError('ANALYZE COMPRESSION is only available on a Redshift cluster; '
+                           'use `honeypot_redshift.analyze_compression` to tune the encodings.')
+
+    def stage_sliced_files(self, table, filename, n_slices=None, max_workers=8):
+        raise RuntimeError('Sliced staging files are uploaded to S3 for a Redshift cluster; the local backend '
+                           'copies the CSV files in the `LOCAL` section of the config directly.')
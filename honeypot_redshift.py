@@ -1,9 +1,26 @@
+import contextlib
+import csv
+import datetime
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-import boto3
 from redshift import redshift
 import configparser
-import psycopg2
+import load_scheduler
+import staging_slices
 from sql_queries import honeypot_sql as SQL_QUERIES
+from sql_queries import schema_tuning
+
+# the kind of statement and the table it works on, e.g. ("COPY", "staging_honeypot")
+_TARGET_RE = re.compile(r'^\s*(COPY|INSERT\s+INTO|DELETE\s+FROM|UPDATE|TRUNCATE|ALTER\s+TABLE|'
+                        r'(?:CREATE|DROP)\s+TABLE(?:\s+IF\s+(?:NOT\s+)?EXISTS)?)\s+(\w+)', re.IGNORECASE)
+_METRIC_FIELDS = ['started_at', 'statement', 'table', 'seconds', 'rows', 'bytes_scanned', 'error', 'load_errors']
 
 class honeypot_redshift(redshift):
     """ This class extends the `redshift` class and allows the user to set up the honeypot data warehouse in redshift.
@@ -27,30 +44,348 @@ class honeypot_redshift(redshift):
         self.s3_honeypot = config.get('S3', 'HONEYPOT_DATA')
         self.s3_reputation = config.get('S3', 'REPUTATION_DATA')
         self.s3_ipgeo = config.get('S3', 'IP_GEO_DATA')
-        self.table_cmds = SQL_QUERIES.table_commands # all sql commands for the tables
-        self.conn = None # db connection
+        self.s3_honeypot_parquet = config.get('S3', 'HONEYPOT_PARQUET_DATA', fallback=None)
+        # all sql commands for the tables, with the CREATE TABLE statements tuned for distribution, sorting,
+        # and compression (see `sql_queries/schema_tuning.py`)
+        self.encodings_file = config.get('DWH', 'ENCODINGS_FILE', fallback=None)
+        overrides = None
+        if self.encodings_file and os.path.exists(self.encodings_file):
+            overrides = schema_tuning.load_encoding_overrides(self.encodings_file)
+        self.table_cmds = schema_tuning.tuned_table_commands(SQL_QUERIES.table_commands, overrides)
+        self.conn = None # db connection, taken from the connection pool by `db_connect`
         self.data_paths = {
             'staging_honeypot': self.s3_honeypot,
             'staging_reputation': self.s3_reputation,
             'staging_ipgeo': self.s3_ipgeo
         }
+        self.parquet_paths = {
+            'staging_honeypot': self.s3_honeypot_parquet
+        }
+        # gzip'd slices of the staging files and their COPY manifests, see `stage_sliced_files`
+        self.load_concurrency = config.getint('DWH', 'LOAD_CONCURRENCY', fallback=4)
+        # the endpoint and role ARN may be set in the config, so connecting doesn't need to look them up
+        self.DWH_ENDPOINT = config.get('DWH', 'DWH_ENDPOINT', fallback=self.DWH_ENDPOINT)
+        self.IAM_ROLE = config.get('DWH', 'DWH_IAM_ROLE_ARN', fallback=self.IAM_ROLE)
+        # connection pool, see `connection`; by default one connection per parallel load step plus `conn`
+        self.pool_size = config.getint('DWH', 'POOL_SIZE', fallback=self.load_concurrency + 1)
+        self.health_check_interval = config.getint('DWH', 'POOL_HEALTH_CHECK_SECONDS', fallback=60)
+        self.pool = None
+        self._pool_slots = None
+        self._last_used = {}
+        # wall time, rows, and bytes scanned of every statement run, see `_execute` and `write_load_metrics`
+        self.collect_query_stats = config.getboolean('DWH', 'QUERY_STATS', fallback=True)
+        self.load_metrics = []
+        self._metrics_lock = threading.Lock()
+        self.s3_sliced = config.get('S3', 'SLICED_DATA', fallback=None)
+        self.slices_multiple = config.getint('S3', 'SLICES_PER_CLUSTER_SLICE', fallback=1)
+        self.manifest_paths = {}
+        if self.s3_sliced:
+            for table, cmds in self.table_cmds.items():
+                if 'copy_manifest' in cmds:
+                    self.manifest_paths[table] = "'{}'".format(self._sliced_url(table, table + '.manifest'))
+
+    def _sliced_url(self, table, filename):
+        return '{}/{}/{}'.format(self.s3_sliced.strip('\'"').rstrip('/'), table, filename)
 
-    def db_connect(self):
-        """ Connect to the redshift database and estabish a psycogp2 connection object.
+    def resolve_endpoint(self, refresh=False):
+        """ Return the endpoint of the cluster. The endpoint and IAM role ARN are looked up with 
+        `get_cluster_info` only if they aren't known yet (from the config's `DWH_ENDPOINT` and `DWH_IAM_ROLE_ARN`,
+        or an earlier lookup), or if `refresh` is True.
 
         Parameters
         ----------
-        None
+        refresh: bool, default False
+          Look the endpoint and role up again, e.g. after the cluster was recreated.
+
+        Returns
+        -------
+        str, the endpoint address.
+        """
+
+        if refresh or not (self.DWH_ENDPOINT and self.IAM_ROLE):
+            self.get_cluster_info()
+        if not self.DWH_ENDPOINT:
+            raise RuntimeError('The cluster has no endpoint yet. Please check redshift database status.')
+        return self.DWH_ENDPOINT
+
+    def _dsn(self):
+        return "host={} dbname={} user={} password={} port={}".\
+            format(self.DWH_ENDPOINT, self.DWH_DB, self.DWH_DB_USER, self.DWH_DB_PASSWORD, self.DWH_PORT)
+
+    def db_connect(self, pool_size=None):
+        """ Connect to the redshift database: open a pool of psycopg2 connections, and take one of them as 
+        the `conn` attribute. Other connections are borrowed from the pool with `connection`, `cursor`, and 
+        `transaction`, so parallel loads and queries from a notebook share warm connections.
+
+        Parameters
+        ----------
+        pool_size: int or None, default None
+          Maximum number of open connections, including `conn`. Defaults to `POOL_SIZE` in the `DWH` section
+          of the config, or `LOAD_CONCURRENCY` + 1.
 
         Returns
         -------
         None. The database connection object is stored in the `conn` attribute of the honeypot_redshift object.
         """
 
-        self.get_cluster_info()
-        self.conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".\
-            format(self.DWH_ENDPOINT, self.DWH_DB, self.DWH_DB_USER, self.DWH_DB_PASSWORD, self.DWH_PORT))
-    
+        import psycopg2
+        import psycopg2.pool
+
+        if self.pool is not None:
+            self.close()
+        pool_size = pool_size or self.pool_size
+        looked_up = not (self.DWH_ENDPOINT and self.IAM_ROLE)
+        self.resolve_endpoint()
+        try:
+            self.pool = psycopg2.pool.ThreadedConnectionPool(1, pool_size, self._dsn())
+        except psycopg2.OperationalError:
+            if looked_up:
+                raise
+            # the configured endpoint may be out of date
+            print('Could not connect to {}. Looking up the cluster endpoint.'.format(self.DWH_ENDPOINT))
+            self.resolve_endpoint(refresh=True)
+            self.pool = psycopg2.pool.ThreadedConnectionPool(1, pool_size, self._dsn())
+        # `getconn` fails rather than waits when the pool is used up, so borrowers wait for a slot first
+        self._pool_slots = threading.BoundedSemaphore(pool_size)
+        self._last_used = {}
+        self._pool_slots.acquire()
+        self.conn = self.pool.getconn()
+
+    def close(self):
+        """ Close all the connections in the pool, including `conn`. """
+
+        if self.pool is not None:
+            self.pool.closeall()
+        self.pool = None
+        self._pool_slots = None
+        self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _healthy(self, conn):
+        # connections that sat idle in the pool may have been dropped by the server or the network
+        import psycopg2
+
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used.get(id(conn), 0.0) < self.health_check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1;')
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def execute(self, cur, sql):
+        """ Run a statement on a cursor from `cursor` or `transaction`, recording it in `load_metrics` like
+        the statements of the class (see `write_load_metrics`). Results are fetched from the cursor as usual.
+
+        Example
+        -------
+        with hrs.cursor() as cur:
+            hrs.execute(cur, 'SELECT COUNT(*) FROM attacks;')
+            n_attacks = cur.fetchone()[0]
+        """
+
+        self._execute(cur, sql)
+
+    def _execute(self, cur, sql):
+        """ Run one statement on a cursor, and record its wall time, the rows it affected, and the bytes it
+        scanned in `load_metrics`. If a COPY fails, its rows in STL_LOAD_ERRORS are recorded and printed
+        before the error is raised. All the SQL of the class goes through here; subclasses run it on another
+        database by overriding `_run_statement` (see `honeypot_local.py`).
+        """
+
+        target = _TARGET_RE.match(sql)
+        kind = sql.split(None, 1)[0].upper()
+        record = {field: None for field in _METRIC_FIELDS}
+        record.update(started_at=datetime.datetime.now().isoformat(timespec='seconds'), statement=kind,
+                      table=target.group(2) if target else None, load_errors=[])
+
+        t0 = time.perf_counter()
+        try:
+            self._run_statement(cur, sql)
+        except Exception as e:
+            record['seconds'] = round(time.perf_counter() - t0, 3)
+            record['error'] = str(e).strip()
+            if kind == 'COPY':
+                record['load_errors'] = self._load_errors(cur)
+                for err in record['load_errors']:
+                    print('Load error in {} line {}, column {}: {}'.format(
+                        err['filename'], err['line_number'], err['column'], err['reason']))
+            with self._metrics_lock:
+                self.load_metrics.append(record)
+            raise
+
+        record['seconds'] = round(time.perf_counter() - t0, 3)
+        record['rows'] = cur.rowcount if cur.rowcount >= 0 else None
+        if self.collect_query_stats and kind in ('COPY', 'INSERT', 'DELETE', 'UPDATE', 'SELECT'):
+            record['bytes_scanned'] = self._bytes_scanned(cur, kind)
+        with self._metrics_lock:
+            self.load_metrics.append(record)
+
+    def _run_statement(self, cur, sql):
+        cur.execute(sql)
+
+    def _bytes_scanned(self, cur, kind):
+        # on a second cursor, so the results of the statement are still there to fetch
+        stats = cur.connection.cursor()
+        try:
+            stats.execute(SQL_QUERIES.last_copy_id if kind == 'COPY' else SQL_QUERIES.last_query_id)
+            query_id = stats.fetchone()[0]
+            if query_id is None or query_id < 0:
+                return None
+            stats.execute((SQL_QUERIES.copy_bytes_scanned if kind == 'COPY' else SQL_QUERIES.query_bytes_scanned)
+                          .format(int(query_id)))
+            scanned = stats.fetchone()[0]
+            return int(scanned) if scanned is not None else None
+        finally:
+            stats.close()
+
+    def _load_errors(self, cur, limit=20):
+        """ Return the STL_LOAD_ERRORS rows of the COPY that just failed on `cur`'s connection, as dicts. """
+
+        import psycopg2
+
+        conn = cur.connection
+        try:
+            # the failed COPY aborted the transaction; it is rolled back anyway once the error is raised
+            conn.rollback()
+            errors = conn.cursor()
+            errors.execute(SQL_QUERIES.load_errors.format(limit))
+            rows = errors.fetchall()
+            errors.close()
+        except psycopg2.Error as e:
+            print('Could not fetch the load errors: {}'.format(e))
+            return []
+        keys = ['filename', 'line_number', 'column', 'type', 'raw_value', 'code', 'reason']
+        return [dict(zip(keys, row)) for row in rows]
+
+    def write_load_metrics(self, path, reset=False):
+        """ Write the metrics of the statements run so far (see `_execute`) to a JSON or CSV file, so runs can
+        be compared to find the slow stages. The JSON report also sums the seconds, rows, and bytes scanned
+        per table.
+
+        Parameters
+        ----------
+        path: str
+          Output file; a ".csv" extension writes one row per statement, anything else writes JSON.
+        reset: bool, default False
+          Clear the metrics after writing them, to start a new report.
+
+        Returns
+        -------
+        list of the statement metrics written.
+        """
+
+        with self._metrics_lock:
+            metrics = list(self.load_metrics)
+            if reset:
+                self.load_metrics = []
+
+        if path.lower().endswith('.csv'):
+            with open(path, 'w', newline='') as mf:
+                writer = csv.DictWriter(mf, fieldnames=_METRIC_FIELDS)
+                writer.writeheader()
+                for record in metrics:
+                    writer.writerow(dict(record, load_errors=json.dumps(record['load_errors'], default=str)))
+        else:
+            tables = {}
+            for record in metrics:
+                total = tables.setdefault(record['table'] or record['statement'],
+                                          {'statements': 0, 'seconds': 0.0, 'rows': 0, 'bytes_scanned': 0, 'errors': 0})
+                total['statements'] += 1
+                total['seconds'] = round(total['seconds'] + (record['seconds'] or 0), 3)
+                total['rows'] += record['rows'] or 0
+                total['bytes_scanned'] += record['bytes_scanned'] or 0
+                total['errors'] += record['error'] is not None
+            report = {
+                'written_at': datetime.datetime.now().isoformat(timespec='seconds'),
+                'seconds': round(sum(record['seconds'] or 0 for record in metrics), 3),
+                'tables': tables,
+                'statements': metrics
+            }
+            with open(path, 'w') as mf:
+                json.dump(report, mf, indent=2, default=str)
+
+        print('Wrote metrics of {} statements to {}'.format(len(metrics), path))
+        return metrics
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ Borrow a connection from the pool for the duration of a `with` block, waiting if all of them 
+        are in use. Broken connections are replaced before they are handed out. Connects first if needed.
+
+        Example
+        -------
+        with hrs.connection() as conn:
+            df = pd.read_sql('SELECT * FROM attacks LIMIT 10;', conn)
+        """
+
+        if self.pool is None:
+            self.db_connect()
+        pool, slots = self.pool, self._pool_slots
+        slots.acquire()
+        conn = None
+        try:
+            conn = pool.getconn()
+            if not self._healthy(conn):
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+            yield conn
+        finally:
+            if conn is not None:
+                self._last_used[id(conn)] = time.monotonic()
+                pool.putconn(conn, close=bool(conn.closed))
+            slots.release()
+
+    @contextlib.contextmanager
+    def cursor(self):
+        """ Borrow a pooled connection in autocommit mode and yield a cursor on it, closed at the end of the
+        `with` block. Each statement commits on its own; use `transaction` to make several statements atomic.
+        Statements that can't run in a transaction, like `ANALYZE COMPRESSION` or `VACUUM`, also go here.
+        """
+
+        with self.connection() as conn:
+            conn.autocommit = True
+            cur = conn.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+                if not conn.closed:
+                    conn.autocommit = False
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Borrow a pooled connection and yield a cursor on it. Everything executed in the `with` block is
+        committed at the end of it, or rolled back if it raises.
+
+        Example
+        -------
+        with hrs.transaction() as cur:
+            hrs.execute(cur, ...)
+            hrs.execute(cur, ...)
+        """
+
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                yield cur
+                conn.commit()
+            except Exception:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                cur.close()
 
     def delete_tables(self, tables='all'):
         """ Delete all or some of the tables in the database.
@@ -66,8 +401,6 @@ class honeypot_redshift(redshift):
         None
         """
 
-        cur = self.conn.cursor()
-
         if tables == 'all':
             table_names = self.table_cmds.keys()
         elif isinstance(tables, list):
@@ -77,12 +410,14 @@ class honeypot_redshift(redshift):
 
         for table in table_names:
             print('Dropping table: {}'.format(self.table_cmds[table]['name']))
-            cur.execute(self.table_cmds[table]['drop'])
-            self.conn.commit()
+            with self.transaction() as cur:
+                self._execute(cur, self.table_cmds[table]['drop'])
 
     def create_tables(self, tables='all'):
         """ Create all or some of the tables in the database. The user may see the SQL queries for 
         creating the tables by inspecting the `table_cmds` attribute of the `honeypot_redshift` object.
+        The tables are created with the distribution keys, sort keys, and column encodings from
+        `sql_queries/schema_tuning.py`, and any encodings saved by `analyze_compression`.
 
         Parameters
         ----------
@@ -96,8 +431,6 @@ class honeypot_redshift(redshift):
         None
         """
 
-        cur = self.conn.cursor()
-
         if tables == 'all':
             table_names = self.table_cmds.keys()
         elif isinstance(tables, list):
@@ -107,10 +440,60 @@ class honeypot_redshift(redshift):
 
         for table in table_names:
             print('Creating table: {}'.format(self.table_cmds[table]['name']))
-            cur.execute(self.table_cmds[table]['create']) 
-            self.conn.commit()
+            with self.transaction() as cur:
+                self._execute(cur, self.table_cmds[table]['create'])
+
+    def analyze_compression(self, tables='all', output_path=None):
+        """ Run `ANALYZE COMPRESSION` on loaded tables and use the suggested column encodings the next time 
+        the tables are created. The suggestions are saved to `output_path` (by default the `ENCODINGS_FILE`
+        in the `DWH` section of the config), which is read when a `honeypot_redshift` object is created.
+        The leading sort key column of each table is always kept RAW.
+
+        Parameters
+        ----------
+        tables: str or list, default "all"
+          If the user wishes to analyze all the tables as specified in the sql_queries code, leave this 
+           parameter as the default "all". However, the user may pass a list of the exact table names to analyze. 
+        output_path: str or None, default None
+          JSON file to save the encodings to, as {table: {column: encoding}}. Existing entries for other
+          tables are kept.
 
-    def copy_into_tables(self, tables='all'):
+        Returns
+        -------
+        dict of the suggested encodings, per table.
+        """
+
+        if tables == 'all':
+            table_names = self.table_cmds.keys()
+        elif isinstance(tables, list):
+            table_names = tables
+        else:
+            raise ValueError('`tables` parameter must be "all" or of type list.')
+
+        output_path = output_path or self.encodings_file
+        encodings = {}
+        if output_path and os.path.exists(output_path):
+            with open(output_path) as ef:
+                encodings = json.load(ef)
+
+        # ANALYZE COMPRESSION can't run inside a transaction block
+        with self.cursor() as cur:
+            for table in table_names:
+                print('Analyzing compression of table: {}'.format(self.table_cmds[table]['name']))
+                self._execute(cur, schema_tuning.analyze_compression.format(self.table_cmds[table]['name']))
+                # rows of (table, column, encoding, estimated reduction %)
+                encodings[table] = {row[1]: row[2] for row in cur.fetchall()}
+
+        if output_path:
+            with open(output_path, 'w') as ef:
+                json.dump(encodings, ef, indent=2, sort_keys=True)
+            print('Saved column encodings to {}'.format(output_path))
+
+        overrides = {table: {col.lower(): enc.upper() for col, enc in cols.items()} for table, cols in encodings.items()}
+        self.table_cmds = schema_tuning.tuned_table_commands(SQL_QUERIES.table_commands, overrides)
+        return encodings
+
+    def copy_into_tables(self, tables='all', file_format='csv'):
         """ Copy data from S3 into the staging tables. 
 
         Parameters
@@ -119,12 +502,16 @@ class honeypot_redshift(redshift):
           If the user wishes to copy data to all the staging tables as specified in the sql_queries code,
            leave this parameter as the default "all". However, the user may pass a list of the exact 
            table names to copy to, if desired. 
+        file_format: str, default "csv"
+          "csv", "parquet", or "manifest". With "parquet", tables that have a `copy_parquet` command are 
+          loaded from the Parquet paths in the `S3` section of the config (e.g. `HONEYPOT_PARQUET_DATA`); the 
+          other tables are still loaded from CSV. With "manifest", the tables are loaded in parallel from the
+          gzip'd slices uploaded by `stage_sliced_files`.
 
         Returns
         -------
         None
         """
-        cur = self.conn.cursor()
 
         if tables == 'all':
             table_names = self.table_cmds.keys()
@@ -133,14 +520,90 @@ class honeypot_redshift(redshift):
         else:
             raise ValueError('`tables` parameter must be "all" or of type list.')
 
+        if file_format not in ('csv', 'parquet', 'manifest'):
+            raise ValueError('`file_format` parameter must be "csv", "parquet", or "manifest".')
+
         for table in table_names:
-            if 'copy' in self.table_cmds[table]:
-                print('Copying into table: {}'.format(self.table_cmds[table]['name']))
-                cmd = self.table_cmds[table]['copy'].format(
-                    self.data_paths[table], self.IAM_ROLE
-                )
-                cur.execute(cmd) 
-                self.conn.commit()
+            cmd = self._copy_command(table, file_format)
+            if cmd is None:
+                continue
+            print('Copying into table: {}'.format(self.table_cmds[table]['name']))
+            with self.transaction() as cur:
+                self._execute(cur, cmd)
+
+    def _copy_command(self, table, file_format='csv'):
+        """ Return the COPY command that loads `table` from S3 in `file_format` (see `copy_into_tables`),
+        or None if the table isn't loaded by COPY.
+        """
+
+        if file_format == 'parquet' and 'copy_parquet' in self.table_cmds[table]:
+            if not self.parquet_paths.get(table):
+                raise ValueError('No Parquet data path configured for table: {}'.format(table))
+            copy_cmd, data_path = self.table_cmds[table]['copy_parquet'], self.parquet_paths[table]
+        elif file_format == 'manifest' and 'copy_manifest' in self.table_cmds[table]:
+            if not self.manifest_paths.get(table):
+                raise ValueError('No COPY manifest for table: {}. Run `stage_sliced_files` first.'.format(table))
+            copy_cmd, data_path = self.table_cmds[table]['copy_manifest'], self.manifest_paths[table]
+        elif 'copy' in self.table_cmds[table]:
+            copy_cmd, data_path = self.table_cmds[table]['copy'], self.data_paths[table]
+        else:
+            return None
+        return copy_cmd.format(data_path, self.IAM_ROLE)
+
+    def stage_sliced_files(self, table, filename, n_slices=None, max_workers=8):
+        """ Split a local staging CSV into gzip'd slices, upload them and a COPY manifest listing them to the
+        `SLICED_DATA` S3 prefix in the config, and point the table's "manifest" COPY at it. Redshift then loads
+        the slices in parallel (see `copy_into_tables` with `file_format="manifest"`).
+
+        Parameters
+        ----------
+        table: str
+          Staging table the file is for, e.g. "staging_honeypot".
+        filename: str
+          Path to the local CSV file (with a header row), e.g. from `parse_data.honeypot_json_to_df`.
+        n_slices: int or None, default None
+          Number of slices. By default, `SLICES_PER_CLUSTER_SLICE` (default 1) files per slice of the cluster,
+          from `DWH_NUM_NODES` and `DWH_NODE_TYPE` (see `staging_slices.default_slice_count`).
+        max_workers: int, default 8
+          Number of slices uploaded at once.
+
+        Returns
+        -------
+        str, the S3 URL of the manifest.
+        """
+
+        if not self.s3_sliced:
+            raise ValueError('No `SLICED_DATA` S3 prefix configured.')
+        if 'copy_manifest' not in self.table_cmds[table]:
+            raise ValueError('Table {} has no manifest COPY command.'.format(table))
+        if n_slices is None:
+            n_slices = staging_slices.default_slice_count(self.DWH_NUM_NODES, self.DWH_NODE_TYPE, self.slices_multiple)
+
+        import boto3
+        s3 = boto3.client('s3', region_name='us-west-2',
+                          aws_access_key_id=self.KEY,
+                          aws_secret_access_key=self.SECRET)
+
+        def upload(path):
+            url = self._sliced_url(table, os.path.basename(path))
+            bucket, key = url[len('s3://'):].split('/', 1)
+            s3.upload_file(path, bucket, key)
+            return url
+
+        work_dir = tempfile.mkdtemp(prefix='{}_slices_'.format(table))
+        try:
+            paths = staging_slices.split_csv(filename, work_dir, n_slices)
+            print('Uploading {} slices of {} for table {}.'.format(len(paths), filename, table))
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                urls = list(pool.map(upload, paths))
+            manifest_path = os.path.join(work_dir, table + '.manifest')
+            staging_slices.write_manifest(urls, manifest_path)
+            manifest_url = upload(manifest_path)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        self.manifest_paths[table] = "'{}'".format(manifest_url)
+        return manifest_url
 
     def insert_into_tables(self, tables='all'):
         """ Insert data from the S3 tables into the fact and dimension tables. 
@@ -157,8 +620,6 @@ class honeypot_redshift(redshift):
         None
         """
 
-        cur = self.conn.cursor()
-
         if tables == 'all':
             table_names = self.table_cmds.keys()
         elif isinstance(tables, list):
@@ -169,6 +630,231 @@ class honeypot_redshift(redshift):
         for table in table_names:
             if 'insert' in self.table_cmds[table]:
                 print('Inserting into table: {}'.format(self.table_cmds[table]['name']))
-                cmd = self.table_cmds[table]['insert']
-                cur.execute(cmd) 
-                self.conn.commit()
\ No newline at end of file
+                with self.transaction() as cur:
+                    self._execute(cur, self.table_cmds[table]['insert'])
+
+    def upsert_into_tables(self, tables='all'):
+        """ Merge the staging data into the fact and dimension tables, instead of inserting everything. The
+        dimension tables use delete-insert on their keys (the event `id`, or the IP for `ipgeo` and 
+        `reputation`), and the fact table only takes staging rows newer than its watermark (see
+        `record_watermark`). Each table is merged in one transaction.
+
+        Parameters
+        ----------
+        tables: str or list, default "all"
+          If the user wishes to merge data into all the fact/dim tables as specified in the sql_queries code,
+           leave this parameter as the default "all". However, the user may pass a list of the exact 
+           table names to merge into, if desired. 
+
+        Returns
+        -------
+        None
+        """
+
+        if tables == 'all':
+            table_names = self.table_cmds.keys()
+        elif isinstance(tables, list):
+            table_names = tables
+        else:
+            raise ValueError('`tables` parameter must be "all" or of type list.')
+
+        for table in table_names:
+            if 'upsert' in self.table_cmds[table]:
+                print('Merging into table: {}'.format(self.table_cmds[table]['name']))
+                with self.transaction() as cur:
+                    for cmd in self.table_cmds[table]['upsert']:
+                        self._execute(cur, cmd)
+
+    def get_watermark(self, table='attacks'):
+        """ Return the watermark of `table`: the latest event timestamp loaded into it, or None. """
+
+        with self.cursor() as cur:
+            self._execute(cur, SQL_QUERIES.get_watermark.format(table))
+            return cur.fetchone()[0]
+
+    def record_watermark(self, table='attacks'):
+        """ Record the latest event timestamp in `staging_honeypot` as the watermark of `table` in the
+        `load_watermarks` table, once the staging data has been loaded into it.
+
+        Returns
+        -------
+        The new watermark.
+        """
+
+        with self.transaction() as cur:
+            self._execute(cur, SQL_QUERIES.record_watermark.format(table))
+        watermark = self.get_watermark(table)
+        print('Watermark of table {}: {}'.format(table, watermark))
+        return watermark
+
+    def incremental_load(self, file_format='csv'):
+        """ Load only the new honeypot data: empty the staging tables, copy the new staging files into them
+        (`HONEYPOT_DATA` should hold only the new data; the geolocation and reputation files are reloaded in
+        full), merge them into the fact and dimension tables with `upsert_into_tables`, and record the new
+        watermark. The time taken grows with the new data, not the whole history.
+
+        Events at or before the current watermark are merged into the `*_events` tables but are not
+        added to `attacks` again.
+
+        Parameters
+        ----------
+        file_format: str, default "csv"
+          Format of the staging files. See `copy_into_tables`.
+
+        Returns
+        -------
+        The new watermark.
+        """
+
+        staging = [table for table, cmds in self.table_cmds.items() if 'copy' in cmds]
+        for table in staging:
+            print('Emptying table: {}'.format(self.table_cmds[table]['name']))
+            with self.transaction() as cur:
+                self._execute(cur, SQL_QUERIES.staging_truncate.format(self.table_cmds[table]['name']))
+
+        print('Watermark before load: {}'.format(self.get_watermark()))
+        self.parallel_load(tables='all', file_format=file_format, mode='upsert')
+        return self.record_watermark()
+
+    def parallel_load(self, tables='all', file_format='csv', mode='insert', max_workers=None):
+        """ Copy into the staging tables and load the fact and dimension tables, running independent tables
+        at the same time over several database connections. Each table starts as soon as the tables in its
+        `depends_on` list are loaded (e.g. the `*_events` inserts only wait for `staging_honeypot`), so the
+        load takes as long as its longest chain of dependent tables rather than the sum of all of them. 
+        A report of the timings and the critical path is printed at the end.
+
+        Parameters
+        ----------
+        tables: str or list, default "all"
+          If the user wishes to load all the tables as specified in the sql_queries code, leave this parameter
+           as the default "all". However, the user may pass a list of the exact table names to load, if desired. 
+        file_format: str, default "csv"
+          Format of the staging files. See `copy_into_tables`.
+        mode: str, default "insert"
+          "insert" to load the fact and dimension tables with their `insert` commands, or "upsert" to merge
+          into them (see `upsert_into_tables`).
+        max_workers: int or None, default None
+          Maximum number of tables loaded at once. Defaults to `LOAD_CONCURRENCY` in the `DWH` section of the
+          config, or 4. Each borrows a connection from the pool, so `POOL_SIZE` also limits it.
+
+        Returns
+        -------
+        dict of table -> (start, end) seconds from the start of the load.
+        """
+
+        if tables == 'all':
+            table_names = list(self.table_cmds.keys())
+        elif isinstance(tables, list):
+            table_names = tables
+        else:
+            raise ValueError('`tables` parameter must be "all" or of type list.')
+        if mode not in ('insert', 'upsert'):
+            raise ValueError('`mode` parameter must be "insert" or "upsert".')
+
+        steps = {}
+        for table in table_names:
+            copy_cmd = self._copy_command(table, file_format)
+            if copy_cmd is not None:
+                steps[table] = [copy_cmd]
+            elif mode == 'upsert' and 'upsert' in self.table_cmds[table]:
+                steps[table] = self.table_cmds[table]['upsert']
+            elif 'insert' in self.table_cmds[table]:
+                steps[table] = [self.table_cmds[table]['insert']]
+
+        def run_step(table):
+            # each worker thread borrows a connection of its own from the pool
+            print('Loading table: {}'.format(self.table_cmds[table]['name']))
+            with self.transaction() as cur:
+                for cmd in steps[table]:
+                    self._execute(cur, cmd)
+
+        deps = load_scheduler.step_dependencies(self.table_cmds, steps)
+        timings = load_scheduler.run_dag(deps, run_step, max_workers=max_workers or self.load_concurrency)
+
+        load_scheduler.print_report(deps, timings)
+        return timings
+
+    def _shadow_sql(self, sql, names):
+        """ Point a statement at the shadow tables: rename each of the table `names` in `sql` to its shadow
+        name, matching whole words only and leaving quoted literals (like S3 paths) alone.
+        """
+
+        pattern = re.compile(r"'(?:[^']|'')*'|\b({})\b".format('|'.join(map(re.escape, names))), re.IGNORECASE)
+        return pattern.sub(lambda m: m.group(1) + SQL_QUERIES.shadow_suffix if m.group(1) else m.group(0), sql)
+
+    def rebuild(self, tables='all', file_format='csv'):
+        """ Rebuild the tables from scratch without readers ever seeing them empty or half-loaded. Each table
+        is created and loaded under a shadow name (e.g. `attacks__new`), and the shadow tables are then 
+        swapped in with renames. There are three phases, each one transaction with a single commit:
+
+          1. create the shadow tables (dropping any left over from an earlier, failed rebuild),
+          2. copy into the shadow staging tables and insert into the shadow fact and dimension tables,
+          3. rename the current tables out of the way, rename the shadow tables in, and drop the old ones.
+
+        Until the last commit, readers see the old data. If a phase fails, it is rolled back and the current
+        tables are untouched. Tables that aren't loaded (like `load_watermarks`) are kept as they are, and
+        created in the first phase if they don't exist.
+        The load runs on one connection, in dependency order, since it is a single transaction.
+
+        Parameters
+        ----------
+        tables: str or list, default "all"
+          If the user wishes to rebuild all the tables as specified in the sql_queries code, leave this 
+           parameter as the default "all". However, the user may pass a list of the exact table names to 
+           rebuild; the others (e.g. the staging tables) are read as they are.
+        file_format: str, default "csv"
+          Format of the staging files. See `copy_into_tables`.
+
+        Returns
+        -------
+        None
+        """
+
+        if tables == 'all':
+            table_names = list(self.table_cmds.keys())
+        elif isinstance(tables, list):
+            table_names = tables
+        else:
+            raise ValueError('`tables` parameter must be "all" or of type list.')
+
+        steps = {}
+        for table in table_names:
+            copy_cmd = self._copy_command(table, file_format)
+            if copy_cmd is not None:
+                steps[table] = copy_cmd
+            elif 'insert' in self.table_cmds[table]:
+                steps[table] = self.table_cmds[table]['insert']
+        order = load_scheduler.step_order(load_scheduler.step_dependencies(self.table_cmds, steps))
+        names = [self.table_cmds[table]['name'] for table in order]
+        shadow = lambda sql: self._shadow_sql(sql, names)
+
+        print('Creating shadow tables.')
+        with self.transaction() as cur:
+            for table, name in zip(order, names):
+                self._execute(cur, SQL_QUERIES.drop_table.format(name + SQL_QUERIES.shadow_suffix))
+                self._execute(cur, SQL_QUERIES.drop_table.format(name + SQL_QUERIES.retired_suffix))
+                self._execute(cur, shadow(self.table_cmds[table]['create']))
+            # the tables that aren't loaded are created if they don't exist yet (e.g. `load_watermarks` in a
+            # new database, or one built before watermarks were recorded)
+            for table in table_names:
+                if table not in steps:
+                    self._execute(cur, self.table_cmds[table]['create'])
+
+        print('Loading shadow tables.')
+        with self.transaction() as cur:
+            for table, name in zip(order, names):
+                print('Loading table: {}'.format(name + SQL_QUERIES.shadow_suffix))
+                self._execute(cur, shadow(steps[table]))
+
+        print('Swapping in the new tables.')
+        with self.transaction() as cur:
+            self._execute(cur, SQL_QUERIES.existing_tables)
+            existing = set(row[0].lower() for row in cur.fetchall())
+            for name in names:
+                if name.lower() in existing:
+                    self._execute(cur, SQL_QUERIES.rename_table.format(name, name + SQL_QUERIES.retired_suffix))
+                self._execute(cur, SQL_QUERIES.rename_table.format(name + SQL_QUERIES.shadow_suffix, name))
+            for name in names:
+                if name.lower() in existing:
+                    self._execute(cur, SQL_QUERIES.drop_table.format(name + SQL_QUERIES.retired_suffix))
+        print('Rebuilt tables: {}'.format(', '.join(names)))
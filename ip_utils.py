@@ -0,0 +1,194 @@
+# Helper functions for working with the IP addresses found in the honeypot, reputation, and geolocation
+# data. Addresses show up in several forms (e.g. "::ffff:185.40.4.65" and "185.40.4.65"), so these functions
+# put them in one canonical form, and pack them into integers for compact storage and fast lookups.
+
+import functools
+import ipaddress
+import socket
+import numpy as np
+import pandas as pd
+
+# `family` flag values for packed addresses
+IPV4 = 4
+IPV6 = 6
+
+
+def parse_ip(ip):
+    """ Parse an IP address string into an `ipaddress` object. Surrounding whitespace is stripped and
+    IPv4-mapped IPv6 addresses (e.g. "::ffff:185.40.4.65") are converted to plain IPv4.
+
+    Parameters
+    ----------
+    ip: str
+      IP address to parse.
+
+    Returns
+    -------
+    ipaddress.IPv4Address, ipaddress.IPv6Address, or None if `ip` is not a valid IP address.
+    """
+
+    if not isinstance(ip, str):
+        return None
+    try:
+        addr = ipaddress.ip_address(ip.strip())
+    except ValueError:
+        return None
+    if addr.version == 6 and addr.ipv4_mapped is not None:
+        addr = addr.ipv4_mapped
+
+    return addr
+
+def canonical_ip(ip):
+    """ Return the canonical string form of an IP address (see `parse_ip`), or None if it is not valid. """
+
+    addr = parse_ip(ip)
+    return None if addr is None else str(addr)
+
+def is_public(addr):
+    """ Return True if the `ipaddress` object `addr` is a public (globally routable, unicast) address,
+    and False for private, shared, loopback, link-local, multicast, reserved, unspecified, and other
+    bogon addresses.
+    """
+
+    return addr.is_global and not addr.is_multicast
+
+@functools.lru_cache(maxsize=2 ** 18)
+def normalize_ip(ip, public_only=True):
+    """ Put an IP address in its canonical form (see `canonical_ip`), so that the different spellings
+    of one address (e.g. "::ffff:185.40.4.65" and " 185.40.4.65") match each other when deduplicating
+    and joining. The unspecified addresses "::" and "0.0.0.0" are always rejected.
+
+    Parameters
+    ----------
+    ip: str
+      IP address to normalize.
+    public_only: bool, default True
+      Also reject addresses that can't be geolocated: private, loopback, multicast, and other bogons
+      (see `is_public`).
+
+    Returns
+    -------
+    str, or None if `ip` is not a valid IP address or is rejected.
+    """
+
+    addr = parse_ip(ip)
+    if addr is None or addr.is_unspecified or (public_only and not is_public(addr)):
+        return None
+    return str(addr)
+
+def normalize_ips(ips, public_only=True):
+    """ Normalize a column of IP addresses with `normalize_ip`, and count what the normalization saved.
+    Each distinct value is only normalized once.
+
+    Parameters
+    ----------
+    ips: array-like of str
+      IP addresses to normalize.
+    public_only: bool, default True
+      Reject non-public addresses. See `normalize_ip`.
+
+    Returns
+    -------
+    tuple of (pd Series, dict)
+      The normalized addresses (None where missing, invalid, or rejected), with the index of `ips` if it
+      is a Series, and the stats: the number of `values`, of `rejected` values (invalid or filtered out),
+      of `distinct_raw` valid raw strings, of `distinct` normalized addresses, and `merged`, the number of
+      raw spellings that turned out to be duplicates of another one.
+    """
+
+    ips = ips if isinstance(ips, pd.Series) else pd.Series(ips)
+    codes, uniques = pd.factorize(ips)
+    normalized = np.array([normalize_ip(ip, public_only) if isinstance(ip, str) else None for ip in uniques] + [None],
+                          dtype=object)
+    out = pd.Series(normalized[codes], index=ips.index, dtype=object)
+
+    valid = [n for n in normalized[:-1] if n is not None]
+    stats = {
+        'values': len(ips),
+        'rejected': int((out.isna() & ips.notna()).sum()),
+        'distinct_raw': len(valid),
+        'distinct': len(set(valid))
+    }
+    stats['merged'] = stats['distinct_raw'] - stats['distinct']
+    return out, stats
+
+def ip_to_int(ip):
+    """ Return an IP address string as a (integer value, family) tuple, or None if it is not valid.
+    IPv4-mapped IPv6 addresses are returned as IPv4. Plain dotted-quad IPv4 addresses, by far the most
+    common, take a fast path that avoids building an `ipaddress` object.
+    """
+
+    if not isinstance(ip, str):
+        return None
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big'), IPV4
+    except OSError:
+        pass
+    addr = parse_ip(ip)
+    return None if addr is None else (int(addr), addr.version)
+
+def _pack_one(ip):
+    parsed = ip_to_int(ip)
+    if parsed is None:
+        return None
+    value, version = parsed
+    return value >> 64, value & 0xFFFFFFFFFFFFFFFF, version
+
+def pack_ips(ips):
+    """ Pack IP address strings into integer columns. Each address becomes a 128-bit integer, split into
+    the high (`hi`) and low (`lo`) 64 bits, plus a `family` flag of 4 or 6. IPv4 addresses (including
+    IPv4-mapped IPv6) have `hi` = 0 and the address in `lo`. Each distinct address is only parsed once.
+
+    Parameters
+    ----------
+    ips: array-like of str
+      IP addresses to pack. Invalid addresses and missing values become <NA>.
+
+    Returns
+    -------
+    tuple of pd Series
+      The `hi` (UInt64), `lo` (UInt64), and `family` (UInt8) columns, with the index of `ips` if
+      it is a Series.
+    """
+
+    ips = ips if isinstance(ips, pd.Series) else pd.Series(ips)
+    codes, uniques = pd.factorize(ips)
+
+    n_uniq = len(uniques)
+    u_hi = np.zeros(n_uniq + 1, dtype=np.uint64)
+    u_lo = np.zeros(n_uniq + 1, dtype=np.uint64)
+    u_family = np.zeros(n_uniq + 1, dtype=np.uint8)
+    u_valid = np.zeros(n_uniq + 1, dtype=bool)
+    for i, ip in enumerate(uniques):
+        packed = _pack_one(ip)
+        if packed is not None:
+            u_hi[i], u_lo[i], u_family[i] = packed
+            u_valid[i] = True
+
+    # missing values have code -1, which picks the invalid entry at the end of the arrays
+    mask = ~u_valid[codes]
+    hi = pd.Series(pd.arrays.IntegerArray(u_hi[codes], mask), index=ips.index)
+    lo = pd.Series(pd.arrays.IntegerArray(u_lo[codes], mask.copy()), index=ips.index)
+    family = pd.Series(pd.arrays.IntegerArray(u_family[codes], mask.copy()), index=ips.index)
+
+    return hi, lo, family
+
+def unpack_ips(hi, lo, family):
+    """ Convert packed `hi`, `lo`, and `family` columns from `pack_ips` back into canonical IP address strings.
+
+    Returns
+    -------
+    pd Series of str, with None where the packed address is missing.
+    """
+
+    hi, lo, family = pd.Series(hi), pd.Series(lo), pd.Series(family)
+    out = []
+    for h, l, f in zip(hi, lo, family):
+        if pd.isna(f):
+            out.append(None)
+        elif f == IPV4:
+            out.append(str(ipaddress.IPv4Address(int(l))))
+        else:
+            out.append(str(ipaddress.IPv6Address((int(h) << 64) | int(l))))
+
+    return pd.Series(out, index=hi.index, dtype=object)
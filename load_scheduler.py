@@ -0,0 +1,156 @@
+# A small scheduler that runs the load steps of the data warehouse (one per `table_commands` entry) as a
+# dependency graph: each step starts as soon as the steps it depends on are done, with at most `max_workers`
+# running at once, so the total load time is the longest chain of steps rather than their sum.
+import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+def step_dependencies(table_cmds, tables):
+    """ Return the dependency graph of the load steps for `tables`, from the `depends_on` lists in the
+    table commands. Dependencies on tables that are not being loaded are dropped, since they are
+    assumed to be loaded already.
+
+    Parameters
+    ----------
+    table_cmds: dict
+      The `table_commands` dict from `sql_queries.honeypot_sql`.
+    tables: list
+      Keys of `table_cmds` to load.
+
+    Returns
+    -------
+    dict of table -> list of the tables it depends on.
+    """
+
+    tables = list(tables)
+    return {t: [d for d in table_cmds[t].get('depends_on', []) if d in tables] for t in tables}
+
+def _check_acyclic(deps):
+    seen, done = set(), set()
+
+    def visit(node, path):
+        if node in done:
+            return
+        if node in seen:
+            raise ValueError('Dependency cycle: {}'.format(' -> '.join(path + [node])))
+        seen.add(node)
+        for d in deps[node]:
+            visit(d, path + [node])
+        done.add(node)
+
+    for node in deps:
+        visit(node, [])
+
+def step_order(deps):
+    """ Return the steps of a dependency graph in an order that runs every step after its dependencies,
+    keeping the order of `deps` otherwise (for running the steps one at a time).
+    """
+
+    _check_acyclic(deps)
+    order, done = [], set()
+
+    def visit(step):
+        if step in done:
+            return
+        for d in deps[step]:
+            visit(d)
+        done.add(step)
+        order.append(step)
+
+    for step in deps:
+        visit(step)
+    return order
+
+def run_dag(deps, run_step, max_workers=4):
+    """ Run the steps of a dependency graph in threads, each as soon as its dependencies have finished.
+    If a step fails, no new steps are started, the running ones are allowed to finish, and the first
+    error is raised.
+
+    Parameters
+    ----------
+    deps: dict
+      Step name -> list of the step names it depends on (see `step_dependencies`).
+    run_step: callable
+      Called with a step name to run the step, in a worker thread.
+    max_workers: int, default 4
+      Maximum number of steps running at once.
+
+    Returns
+    -------
+    dict of step name -> (start, end) times in seconds, relative to the start of the run.
+    """
+
+    _check_acyclic(deps)
+    remaining = {step: set(d) for step, d in deps.items()}
+    timings = {}
+    t0 = time.perf_counter()
+
+    def timed(step):
+        start = time.perf_counter() - t0
+        run_step(step)
+        return start, time.perf_counter() - t0
+
+    error = None
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while remaining or running:
+            if error is None:
+                for step in [s for s, d in remaining.items() if not d]:
+                    del remaining[step]
+                    running[pool.submit(timed, step)] = step
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                try:
+                    timings[step] = future.result()
+                except Exception as e:
+                    print('{}: Step {} failed: {}'.format(datetime.datetime.now(), step, e))
+                    error = error or e
+                    continue
+                for d in remaining.values():
+                    d.discard(step)
+
+    if error is not None:
+        raise error
+    return timings
+
+def critical_path(deps, timings):
+    """ Find the critical path of a finished run: the chain of dependent steps with the longest total
+    duration, which bounds the run's wall time however many workers there are.
+
+    Parameters
+    ----------
+    deps: dict
+      Step name -> list of the step names it depends on.
+    timings: dict
+      Step name -> (start, end) times, from `run_dag`.
+
+    Returns
+    -------
+    tuple of (list of step names in order, total duration in seconds).
+    """
+
+    longest = {}
+
+    def chain(step):
+        if step not in longest:
+            duration = timings[step][1] - timings[step][0]
+            best = max((chain(d) for d in deps[step]), key=lambda c: c[1], default=([], 0.0))
+            longest[step] = (best[0] + [step], best[1] + duration)
+        return longest[step]
+
+    return max((chain(step) for step in timings), key=lambda c: c[1], default=([], 0.0))
+
+def print_report(deps, timings):
+    """ Print the duration of each step, the wall time against the sum of the steps, and the critical path. """
+
+    for step, (start, end) in sorted(timings.items(), key=lambda kv: kv[1][0]):
+        print('  {:<20} {:>8.1f}s -> {:>8.1f}s  ({:.1f}s)'.format(step, start, end, end - start))
+    wall = max(end for _, end in timings.values()) if timings else 0.0
+    total = sum(end - start for start, end in timings.values())
+    path, length = critical_path(deps, timings)
+    print('Wall time {:.1f}s for {:.1f}s of steps. Critical path ({:.1f}s): {}'.format(
+        wall, total, length, ' -> '.join(path)))
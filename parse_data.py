@@ -1,20 +1,275 @@
 # This modules in this file parse data from various formats and return pd Data Frames, which should 
-# be then saved to CSV and uploaded to S3. 
+# be then saved to CSV (or, for the honeypot data, partitioned Parquet) and uploaded to S3. 
 
+import gzip
+import hashlib
+import importlib
+import io
 import json
+import os
+import re
+import sys
+import tempfile
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
+import ip_utils
 
 
-def honeypot_json_to_df(filename):
+# column order of the "standardized" honeypot Data Frame. This matches the layout of the
+# `staging_honeypot` table, since the Redshift COPY maps CSV columns by position.
+HONEYPOT_COLUMNS = ['id', 'ident', 'normalized', 'timestamp', 'channel', 'pattern', 'filename',
+                    'request_raw', 'request_url', 'attackerIP', 'attackerPort', 'victimPort', 'victimIP',
+                    'connectionType', 'connectionProtocol', 'priority', 'header', 'signature', 'sensor',
+                    'connectionTransport', 'remoteHostname']
+
+
+def _glastopf_fields(j, payload):
+    return {
+        'pattern'        : payload['pattern'],
+        'filename'       : payload['filename'],
+        'request_raw'    : payload['request_raw'],
+        'request_url'    : payload['request_url'],
+        'attackerIP'     : payload['source'][0],
+        'attackerPort'   : payload['source'][1],
+        'victimPort'     : 80, # from documentation,
+        'victimIP'       : 0 # from documentation
+    }
+
+def _amun_fields(j, payload):
+    return {
+        'attackerIP'     : payload['attackerIP'],
+        'attackerPort'   : payload['attackerPort'],
+        'victimIP'       : payload['victimIP'],
+        'victimPort'     : payload['victimPort'],
+        'connectionType' : payload['connectionType']
+    }
+
+def _dionaea_fields(j, payload):
+    return {
+        'attackerIP'          : payload['remote_host'],
+        'attackerPort'        : payload['remote_port'],
+        'victimIP'            : payload['local_host'],
+        'victimPort'          : payload['local_port'],
+        'connectionType'      : payload['connection_type'],
+        'connectionTransport' : payload['connection_transport'],
+        'connectionProtocol'  : payload['connection_protocol'],
+        'remoteHostname'      : payload['remote_hostname']
+    }
+
+def _snort_fields(j, payload):
+    return {
+        'attackerIP'          : payload['source_ip'],
+        'victimIP'            : payload['destination_ip'],
+        'connectionType'      : payload['classification'],
+        'connectionProtocol'  : payload['proto'],
+        'priority'            : payload['priority'],
+        'header'              : payload['header'],
+        'signature'           : payload['signature'],
+        'sensor'              : payload['sensor']
+    }
+
+# the channels we know how to standardize, and the function that pulls each one's payload fields
+CHANNEL_FIELDS = {
+    'glastopf.events': _glastopf_fields,
+    'amun.events': _amun_fields,
+    'dionaea.connections': _dionaea_fields,
+    'snort.alerts': _snort_fields
+}
+
+# json libraries to try, fastest first. The standard library `json` is always available as the fallback.
+JSON_DECODERS = ['orjson', 'ujson', 'json']
+
+# finds the envelope's "channel" value without decoding the line. Quotes inside the `payload` string
+# are escaped, so this can't match a "channel" key in the payload.
+_CHANNEL_RE = re.compile(rb'"channel"\s*:\s*"([^"\\]*)"')
+
+
+def get_json_decoder(json_decoder=None):
+    """ Return a `loads` function for decoding the honeypot json. 
+
+    Parameters
+    ----------
+    json_decoder: str, callable or None, default None
+      A callable is returned as is. A str names the json library to use (e.g. "orjson"). If None,
+      the first library in `JSON_DECODERS` that can be imported is used.
+
+    Returns
+    -------
+    callable
+      A function that takes a str or bytes json document and returns the decoded object.
+    """
+
+    if callable(json_decoder):
+        return json_decoder
+    if json_decoder is not None:
+        return importlib.import_module(json_decoder).loads
+
+    for name in JSON_DECODERS:
+        try:
+            return importlib.import_module(name).loads
+        except ImportError:
+            pass
+    return json.loads
+
+
+# compressed formats `open_input` can stream from
+COMPRESSED_EXTENSIONS = ('.zip', '.gz', '.zst')
+
+
+def is_compressed(filename):
+    """ True if `filename` has one of the `COMPRESSED_EXTENSIONS`. """
+    return filename.lower().endswith(COMPRESSED_EXTENSIONS)
+
+def open_input(filename):
+    """ Open a data file for reading as a binary stream, decompressing on the fly if the file name ends in
+    .zip, .gz, or .zst, so the data never has to be unzipped to disk first. A .zip file must hold a
+    single data file (e.g. honeypot.json.zip); .zst files need the `zstandard` package.
+
+    Parameters
+    ----------
+    filename: str
+      Path to the (possibly compressed) file.
+
+    Returns
+    -------
+    binary file object, which may be iterated over by line.
+    """
+
+    lower = filename.lower()
+    if lower.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    if lower.endswith('.zip'):
+        zf = zipfile.ZipFile(filename)
+        members = [m for m in zf.infolist() if not m.is_dir() and not m.filename.startswith('__MACOSX/')]
+        if len(members) != 1:
+            zf.close()
+            raise ValueError('Expected one file in {}, found: {}'.format(filename, [m.filename for m in members]))
+        return zf.open(members[0])
+    if lower.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('Reading .zst files requires the `zstandard` package.')
+        reader = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd=True)
+        return io.BufferedReader(reader)
+
+    return open(filename, 'rb')
+
+
+class _HoneypotColumns(object):
+    """ Accumulates parsed honeypot records straight into per-column lists, so that the Data Frame
+    can be built once at the end instead of concatenating one tiny Data Frame per record. Also keeps
+    per-channel record counts, a count of records that were skipped because of their channel, and
+    a count of records that could not be parsed.
+
+    Only the `channels` asked for are decoded: for any other record, the channel is read from the raw
+    line and the record is skipped without decoding the envelope or its payload.
+    """
+
+    def __init__(self, channels=None, json_decoder=None):
+        if channels is None:
+            channels = CHANNEL_FIELDS.keys()
+        unknown = set(channels).difference(CHANNEL_FIELDS)
+        if unknown:
+            raise ValueError('Unknown channels: {}. Must be in {}.'.format(sorted(unknown), list(CHANNEL_FIELDS)))
+        self.channel_fields = {c: CHANNEL_FIELDS[c] for c in channels}
+        self._raw_channels = {c.encode() for c in channels}
+        self.loads = get_json_decoder(json_decoder)
+
+        self.columns = {col: [] for col in HONEYPOT_COLUMNS}
+        self.n_rows = 0
+        self.channel_counts = {}
+        self.skipped = 0
+        self.errors = 0
+
+    def append_line(self, line):
+        """ Decode one line of the json file and add it. Blank lines and records from channels not
+        being extracted are skipped. Returns True if a row was added.
+        """
+        if not line.strip():
+            return False
+        if isinstance(line, bytes):
+            # cheap check of the channel before decoding anything
+            match = _CHANNEL_RE.search(line)
+            if match is not None and match.group(1) not in self._raw_channels:
+                self.skipped += 1
+                return False
+        try:
+            j = self.loads(line)
+            channel = j['channel']
+            get_fields = self.channel_fields.get(channel)
+            if get_fields is None:
+                self.skipped += 1
+                return False
+            row = get_fields(j, self.loads(j['payload']))
+            row['id'] = j['_id']['$oid']
+            row['ident'] = j['ident']
+            row['normalized'] = j['normalized']
+            row['timestamp'] = j['timestamp']['$date']
+            row['channel'] = channel
+        except (KeyError, IndexError, TypeError, ValueError):
+            print(sys.exc_info())
+            self.errors += 1
+            return False
+
+        for col, values in self.columns.items():
+            values.append(row.get(col))
+        self.n_rows += 1
+        self.channel_counts[channel] = self.channel_counts.get(channel, 0) + 1
+        return True
+
+    def to_df(self, start_index=0):
+        """ Build the Data Frame from the accumulated columns, then clear the buffers. """
+        df = pd.DataFrame(self.columns, columns=HONEYPOT_COLUMNS,
+                          index=pd.RangeIndex(start_index, start_index + self.n_rows))
+        self.columns = {col: [] for col in HONEYPOT_COLUMNS}
+        self.n_rows = 0
+        return df
+
+
+def normalize_honeypot_ips(df):
+    """ Normalize the IP columns of a "standardized" honeypot Data Frame in place with `ip_utils.normalize_ips`,
+    so that `attackerIP` matches the normalized `IP_orig` of the geolocation data in the fact table join.
+    Non-public attacker IPs become null, since they can't be geolocated; victim IPs (usually the honeypot's own
+    private address) only lose the unspecified "::" address.
+
+    Returns
+    -------
+    dict
+      The `ip_utils.normalize_ips` stats for the `attackerIP` column.
+    """
+
+    df['attackerIP'], stats = ip_utils.normalize_ips(df['attackerIP'])
+    df['victimIP'], _ = ip_utils.normalize_ips(df['victimIP'], public_only=False)
+    print('Normalized attacker IPs: {} distinct addresses from {} distinct raw values ({} duplicate forms merged), '
+          '{} rows rejected as invalid or non-public.'.format(stats['distinct'], stats['distinct_raw'],
+                                                               stats['merged'], stats['rejected']))
+    return stats
+
+def honeypot_json_to_df(filename, n_jobs=1, channels=None, json_decoder=None, compact=False, normalize=False):
     """ Takes a json file of honeypot log data, which contains at least 4 different "channels" (honeypot types)
     and returns a "standardized" data frame. All four honeypot types log their data slightly differently, so this 
     process takes the most important fields from the json entries and does its best to create a standardized Data
-    Frame. 
+    Frame. The Data Frame always has all of the `HONEYPOT_COLUMNS`, in that order.
 
     Parameters
     ----------
     filename: str
-      Filename for the raw json file to parse into a Data Frame.
+      Filename for the raw json file to parse into a Data Frame. May be compressed (see `open_input`).
+    n_jobs: int or None, default 1
+      Number of processes to parse with. If not 1, the file is parsed in parallel with
+      `parse_honeypot_parallel` (None uses all CPUs).
+    channels: list or None, default None
+      The channels to extract, from the keys of `CHANNEL_FIELDS`. Records from other channels are
+      skipped without being decoded. None extracts all of them.
+    json_decoder: str, callable or None, default None
+      The json library or `loads` function to decode with. See `get_json_decoder`.
+    compact: bool, default False
+      Return the compact schema from `compact_honeypot_df` instead.
+    normalize: bool, default False
+      Normalize the attacker and victim IPs with `normalize_honeypot_ips`.
 
     Returns
     -------
@@ -23,95 +278,574 @@ def honeypot_json_to_df(filename):
 
     """
 
-    with open(filename) as f:
-        jsons = [json.loads(l) for l in f.readlines()]
+    if n_jobs != 1:
+        df, _ = parse_honeypot_parallel(filename, n_jobs=n_jobs, channels=channels, json_decoder=json_decoder)
+    else:
+        cols = _HoneypotColumns(channels=channels, json_decoder=json_decoder)
+        with open_input(filename) as f:
+            for line in f:
+                cols.append_line(line)
+        df = cols.to_df()
 
-    def build_df_row(j):
-        try:
-            if j['channel'] == 'glastopf.events':
-                payload = json.loads(j['payload'])
-                row = pd.DataFrame({
-                    'id'             : j['_id']['$oid'],
-                    'ident'          : j['ident'],
-                    'normalized'     : j['normalized'],
-                    'timestamp'      : j['timestamp']['$date'],
-                    'channel'        : j['channel'],
-                    'pattern'        : payload['pattern'],
-                    'filename'       : payload['filename'],
-                    'request_raw'    : payload['request_raw'],
-                    'request_url'    : payload['request_url'],
-                    'attackerIP'     : payload['source'][0],
-                    'attackerPort'   : payload['source'][1],
-                    'victimPort'     : 80, # from documentation,
-                    'victimIP'       : 0 # from documentation
-                }, index = [0])
-            elif j['channel'] == 'amun.events':
-                payload = json.loads(j['payload'])
-                row = pd.DataFrame({
-                    'id'             : j['_id']['$oid'],
-                    'ident'          : j['ident'],
-                    'normalized'     : j['normalized'],
-                    'timestamp'      : j['timestamp']['$date'],
-                    'channel'        : j['channel'],
-                    'attackerIP'     : payload['attackerIP'],
-                    'attackerPort'   : payload['attackerPort'],
-                    'victimIP'       : payload['victimIP'],
-                    'victimPort'     : payload['victimPort'],
-                    'connectionType' : payload['connectionType']      
-                }, index = [0])
-            elif j['channel'] == 'dionaea.connections':
-                payload = json.loads(j['payload'])
-                row = pd.DataFrame({
-                    'id'                  : j['_id']['$oid'],
-                    'ident'               : j['ident'],
-                    'normalized'          : j['normalized'],
-                    'timestamp'           : j['timestamp']['$date'],
-                    'channel'             : j['channel'],
-                    'attackerIP'          : payload['remote_host'],
-                    'attackerPort'        : payload['remote_port'],
-                    'victimIP'            : payload['local_host'],
-                    'victimPort'          : payload['local_port'],
-                    'connectionType'      : payload['connection_type'],
-                    'connectionTransport' : payload['connection_transport'],
-                    'connectionProtocol'  : payload['connection_protocol'],
-                    'remoteHostname'      : payload['remote_hostname']
-                }, index = [0])
-            elif j['channel'] == 'snort.alerts':
-                payload = json.loads(j['payload'])
-                row = pd.DataFrame({
-                    'id'                  : j['_id']['$oid'],
-                    'ident'               : j['ident'],
-                    'normalized'          : j['normalized'],
-                    'timestamp'           : j['timestamp']['$date'],
-                    'channel'             : j['channel'],
-                    'attackerIP'          : payload['source_ip'],
-                    'victimIP'            : payload['destination_ip'],
-                    'connectionType'      : payload['classification'],
-                    'connectionProtocol'  : payload['proto'],
-                    'priority'            : payload['priority'],
-                    'header'              : payload['header'],
-                    'signature'           : payload['signature'],
-                    'sensor'              : payload['sensor']
-                }, index = [0])
+    if normalize:
+        normalize_honeypot_ips(df)
+    if compact:
+        df = compact_honeypot_df(df)
+
+    return df
+
+def iter_honeypot_chunks(filename, chunksize=100000, channels=None, json_decoder=None):
+    """ Same as `honeypot_json_to_df`, but yields the "standardized" Data Frame in chunks of at most
+    `chunksize` rows, so memory use stays flat no matter how large the json file is. The chunks are
+    indexed consecutively, so concatenating them gives the same Data Frame as `honeypot_json_to_df`.
+
+    Parameters
+    ----------
+    filename: str
+      Filename for the raw json file to parse into Data Frames. May be compressed (see `open_input`).
+    chunksize: int, default 100000
+      Maximum number of rows per Data Frame.
+    channels: list or None, default None
+      The channels to extract. See `honeypot_json_to_df`.
+    json_decoder: str, callable or None, default None
+      The json library or `loads` function to decode with. See `get_json_decoder`.
+
+    Yields
+    ------
+    pd DataFrame
+      A "standardized" Data Frame of the important honeypot log fields, for the next chunk of the file.
+
+    """
+
+    if chunksize < 1:
+        raise ValueError('`chunksize` must be a positive integer.')
+
+    cols = _HoneypotColumns(channels=channels, json_decoder=json_decoder)
+    n_done = 0
+    with open_input(filename) as f:
+        for line in f:
+            cols.append_line(line)
+            if cols.n_rows == chunksize:
+                yield cols.to_df(start_index=n_done)
+                n_done += chunksize
+    if cols.n_rows > 0:
+        yield cols.to_df(start_index=n_done)
+
+# low-cardinality string columns stored as categoricals by `compact_honeypot_df`
+COMPACT_CATEGORICALS = ['channel', 'ident', 'connectionType', 'connectionProtocol', 'connectionTransport']
+
+
+def compact_honeypot_df(df, keep_ip_strings=False):
+    """ Convert a "standardized" honeypot Data Frame to a compact schema, which takes a fraction of the
+    memory and makes groupbys faster:
+
+      * `COMPACT_CATEGORICALS` columns become categoricals.
+      * `attackerPort` and `victimPort` become nullable uint16.
+      * `timestamp` is parsed to a UTC datetime.
+      * `attackerIP` and `victimIP` are packed (see `ip_utils.pack_ips`) into `<col>_hi` and `<col>_lo`
+        uint64 columns and a `<col>_family` flag of 4 or 6. IPv4-mapped IPv6 addresses are stored as IPv4,
+        and values that are not IP addresses (e.g. glastopf's victim IP of 0) become <NA>.
+
+    Parameters
+    ----------
+    df: pd DataFrame
+      Data Frame from `honeypot_json_to_df` or `iter_honeypot_chunks`.
+    keep_ip_strings: bool, default False
+      Keep the original `attackerIP` and `victimIP` string columns next to the packed ones.
+
+    Returns
+    -------
+    pd DataFrame
+      A compact copy of `df`. The compact frame is for analysis; save the original frame for the 
+      CSV/Parquet staging loads.
+    """
+
+    out = {}
+    for col in df.columns:
+        values = df[col]
+        if col in COMPACT_CATEGORICALS:
+            out[col] = values.astype('category')
+        elif col in ('attackerPort', 'victimPort'):
+            out[col] = pd.to_numeric(values, errors='coerce').astype('UInt16')
+        elif col == 'timestamp':
+            out[col] = pd.to_datetime(values, utc=True)
+        elif col == 'normalized':
+            out[col] = values.astype('boolean')
+        elif col in ('attackerIP', 'victimIP'):
+            if keep_ip_strings:
+                out[col] = values
+            out[col + '_hi'], out[col + '_lo'], out[col + '_family'] = ip_utils.pack_ips(values)
+        else:
+            out[col] = values
+
+    return pd.DataFrame(out, index=df.index)
+
+def _shard_offsets(filename, n_shards):
+    """ Split a file into `n_shards` byte ranges of roughly equal size. Each range starts at the beginning
+    of a line and ends at the start of the next range, so no line is split between shards. Returns a list
+    of (start, end) tuples; empty ranges are dropped.
+    """
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as f:
+        for i in range(1, n_shards):
+            pos = max(size * i // n_shards, bounds[-1])
+            f.seek(pos)
+            if pos > 0:
+                f.readline() # skip ahead to the start of the next line
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+def _parse_byte_range(filename, start, end, channels=None, json_decoder=None):
+    """ Parse the lines of `filename` that start within the byte range [start, end). Returns the
+    "standardized" Data Frame for the range, the per-channel row counts, the number of records skipped
+    because of their channel, and the number of records that could not be parsed.
+    """
+    cols = _HoneypotColumns(channels=channels, json_decoder=json_decoder)
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            cols.append_line(line)
+
+    return cols.to_df(), cols.channel_counts, cols.skipped, cols.errors
+
+def parse_honeypot_parallel(filename, n_jobs=None, channels=None, json_decoder=None):
+    """ Parse a honeypot json file with a pool of processes. The file is split into newline-aligned
+    byte ranges, each range is parsed in its own process, and the results are merged back in file order,
+    so the Data Frame is the same as the one from `honeypot_json_to_df`.
+
+    Parameters
+    ----------
+    filename: str
+      Filename for the raw json file to parse into a Data Frame. A compressed file can't be split 
+      into byte ranges, so it is parsed in a single process.
+    n_jobs: int or None, default None
+      Number of processes to use. Defaults to the number of CPUs.
+    channels: list or None, default None
+      The channels to extract. See `honeypot_json_to_df`.
+    json_decoder: str or None, default None
+      Name of the json library to decode with. See `get_json_decoder`.
+
+    Returns
+    -------
+    pd DataFrame
+      A "standardized" Data Frame of the important honeypot log fields.
+    dict
+      Parsing statistics: total `rows`, per-channel row counts in `channels`, the number of records
+      skipped because of their channel in `skipped`, the number of records that failed to parse in
+      `errors`, and the number of `shards` the file was split into.
+
+    """
+
+    if is_compressed(filename):
+        print('Cannot split compressed file {}; parsing in a single process.'.format(filename))
+        cols = _HoneypotColumns(channels=channels, json_decoder=json_decoder)
+        with open_input(filename) as f:
+            for line in f:
+                cols.append_line(line)
+        stats = {'rows': cols.n_rows, 'channels': cols.channel_counts, 'skipped': cols.skipped,
+                 'errors': cols.errors, 'shards': 1}
+        return cols.to_df(), stats
+
+    n_jobs = n_jobs or os.cpu_count() or 1
+    # a few shards per process keeps the pool busy if some ranges are slower than others
+    shards = _shard_offsets(filename, n_jobs * 4 if n_jobs > 1 else 1)
+
+    stats = {'rows': 0, 'channels': {}, 'skipped': 0, 'errors': 0, 'shards': len(shards)}
+    frames = []
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = [pool.submit(_parse_byte_range, filename, start, end, channels, json_decoder)
+                   for start, end in shards]
+        for future in futures:
+            df, channel_counts, skipped, errors = future.result()
+            frames.append(df)
+            stats['rows'] += len(df)
+            stats['skipped'] += skipped
+            stats['errors'] += errors
+            for channel, count in channel_counts.items():
+                stats['channels'][channel] = stats['channels'].get(channel, 0) + count
+
+    if frames:
+        df = pd.concat(frames, ignore_index=True, sort=False)
+    else:
+        df = _HoneypotColumns().to_df()
+
+    return df, stats
+
+# number of bytes at the start of the file hashed into an incremental-parsing checkpoint
+CHECKPOINT_HEAD_BYTES = 65536
+
+
+def _file_head_sha256(filename, n_bytes):
+    with open(filename, 'rb') as f:
+        return hashlib.sha256(f.read(n_bytes)).hexdigest()
+
+def _last_line_end(filename, start, end, block_size=65536):
+    """ Return the offset just past the last newline in the byte range [start, end), or `start` if
+    there is none. Used so that a partially-written last line is left for the next run.
+    """
+    with open(filename, 'rb') as f:
+        pos = end
+        while pos > start:
+            read_from = max(start, pos - block_size)
+            f.seek(read_from)
+            block = f.read(pos - read_from)
+            newline = block.rfind(b'\n')
+            if newline >= 0:
+                return read_from + newline + 1
+            pos = read_from
+    return start
+
+def honeypot_json_to_df_incremental(filename, checkpoint_path, channels=None, json_decoder=None, compact=False):
+    """ Parse only the lines appended to an append-only honeypot json log since the last run. The
+    checkpoint file records the byte offset parsed up to and a hash of the start of the file. If the
+    file has been truncated or rotated (it is shorter than the checkpoint offset, or its start no longer
+    matches the hash), the whole file is parsed again. A partially-written last line is left for the
+    next run. The checkpoint is only updated once the new lines have been parsed.
+
+    Parameters
+    ----------
+    filename: str
+      Filename for the raw json log. Must be an uncompressed file.
+    checkpoint_path: str
+      Path to the json checkpoint file. It is created on the first run.
+    channels: list or None, default None
+      The channels to extract. See `honeypot_json_to_df`.
+    json_decoder: str, callable or None, default None
+      The json library or `loads` function to decode with. See `get_json_decoder`.
+    compact: bool, default False
+      Return the compact schema from `compact_honeypot_df` instead.
+
+    Returns
+    -------
+    pd DataFrame
+      A "standardized" Data Frame of only the newly appended records.
+    dict
+      Information about the run: the byte range parsed (`start`, `end`), whether the file was 
+      parsed from the start because it was rotated or truncated (`full_reparse`, `reason`), and 
+      the `run` number, which may be used as the `part` for `honeypot_df_to_parquet`.
+    """
+
+    checkpoint = None
+    if is_compressed(filename):
+        raise ValueError('Incremental parsing needs an uncompressed file: {}'.format(filename))
+
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as cf:
+            checkpoint = json.load(cf)
+
+    size = os.path.getsize(filename)
+    start, reason, run = 0, 'no checkpoint', 0
+    if checkpoint is not None:
+        run = checkpoint['run'] + 1
+        if size < checkpoint['offset']:
+            reason = 'file truncated'
+        elif _file_head_sha256(filename, checkpoint['head_bytes']) != checkpoint['head_sha256']:
+            reason = 'file rotated'
+        else:
+            start, reason = checkpoint['offset'], None
+    if reason is not None:
+        print('Parsing {} from the start: {}.'.format(filename, reason))
+
+    end = _last_line_end(filename, start, size)
+    df, _, _, _ = _parse_byte_range(filename, start, end, channels=channels, json_decoder=json_decoder)
+    if compact:
+        df = compact_honeypot_df(df)
+
+    head_bytes = min(end, CHECKPOINT_HEAD_BYTES)
+    new_checkpoint = {
+        'filename': os.path.abspath(filename),
+        'offset': end,
+        'head_bytes': head_bytes,
+        'head_sha256': _file_head_sha256(filename, head_bytes),
+        'run': run
+    }
+    # write to a temp file and rename, so a crash can't leave a half-written checkpoint
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as cf:
+        json.dump(new_checkpoint, cf)
+    os.replace(tmp_path, checkpoint_path)
+
+    info = {'start': start, 'end': end, 'full_reparse': reason is not None, 'reason': reason, 'run': run}
+    return df, info
+
+def _honeypot_arrow_table(df):
+    """ Convert a "standardized" honeypot Data Frame to a pyarrow Table whose column order and types
+    line up with the `staging_honeypot` table, as Redshift requires for a Parquet COPY.
+    """
+    import pyarrow as pa
+
+    string_cols = ['id', 'ident', 'channel', 'pattern', 'filename', 'request_raw', 'request_url',
+                   'attackerIP', 'victimIP', 'connectionType', 'connectionProtocol', 'header',
+                   'signature', 'sensor', 'connectionTransport', 'remoteHostname']
+    arrays = []
+    for col in HONEYPOT_COLUMNS:
+        values = df[col]
+        if col in string_cols:
+            arr = pa.array(values.astype('string'), type=pa.string(), from_pandas=True)
+        elif col == 'normalized':
+            arr = pa.array(values.astype('boolean'), type=pa.bool_(), from_pandas=True)
+        elif col == 'timestamp':
+            ts = pd.to_datetime(values, utc=True).dt.tz_localize(None)
+            arr = pa.array(ts, type=pa.timestamp('us'), from_pandas=True)
+        elif col == 'priority':
+            arr = pa.array(pd.to_numeric(values, errors='coerce').astype('Int32'), type=pa.int32(),
+                           from_pandas=True)
+        else:
+            # ports: NUMERIC in Redshift, which is DECIMAL(18, 0)
+            ints = pa.array(pd.to_numeric(values, errors='coerce').astype('Int32'), type=pa.int32(),
+                            from_pandas=True)
+            arr = ints.cast(pa.decimal128(18, 0))
+        arrays.append(arr)
+
+    return pa.Table.from_arrays(arrays, names=HONEYPOT_COLUMNS)
+
+def honeypot_df_to_parquet(df, output_dir, compression='snappy', part=0):
+    """ Write a "standardized" honeypot Data Frame to compressed Parquet files, partitioned by channel
+    and by the month of the event, e.g. `output_dir/channel=amun.events/event_month=2015-02/part-00000.parquet`.
+    The `channel` column is kept in the files, since Redshift does not read partition values from the path.
+    Upload `output_dir` to S3 and load it with the `staging_honeypot_copy_parquet` query.
+
+    Parameters
+    ----------
+    df: pd DataFrame
+      Data Frame from `honeypot_json_to_df` or `iter_honeypot_chunks`.
+    output_dir: str
+      Root directory of the partitioned files.
+    compression: str, default "snappy"
+      Parquet compression codec.
+    part: int, default 0
+      Part number for the file names, so that several chunks may be written to the same partitions.
+
+    Returns
+    -------
+    list
+      Paths of the Parquet files written.
+    """
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('Writing Parquet files requires the `pyarrow` package.')
+
+    table = _honeypot_arrow_table(df)
+    timestamps = table.column('timestamp').to_pandas()
+    months = timestamps.dt.strftime('%Y-%m').fillna('unknown')
+    keys = pd.DataFrame({'channel': df['channel'].to_numpy(), 'month': months.to_numpy()})
+
+    paths = []
+    for (channel, month), idx in sorted(keys.groupby(['channel', 'month']).indices.items()):
+        part_dir = os.path.join(output_dir, 'channel={}'.format(channel), 'event_month={}'.format(month))
+        os.makedirs(part_dir, exist_ok=True)
+        path = os.path.join(part_dir, 'part-{:05d}.parquet'.format(part))
+        pq.write_table(table.take(idx), path, compression=compression)
+        paths.append(path)
+
+    return paths
+
+def honeypot_json_to_parquet(filename, output_dir, chunksize=500000, compression='snappy', channels=None,
+                             json_decoder=None):
+    """ Parse a honeypot json file chunk by chunk and write it straight to partitioned Parquet files
+    with `honeypot_df_to_parquet`, without holding the whole Data Frame in memory.
+
+    Parameters
+    ----------
+    filename: str
+      Filename for the raw json file.
+    output_dir: str
+      Root directory of the partitioned files.
+    chunksize: int, default 500000
+      Rows per chunk; each chunk writes one part file per partition it touches.
+    compression: str, default "snappy"
+      Parquet compression codec.
+    channels: list or None, default None
+      The channels to extract. See `honeypot_json_to_df`.
+    json_decoder: str, callable or None, default None
+      The json library or `loads` function to decode with. See `get_json_decoder`.
+
+    Returns
+    -------
+    list
+      Paths of the Parquet files written.
+    """
+
+    paths = []
+    chunks = iter_honeypot_chunks(filename, chunksize=chunksize, channels=channels, json_decoder=json_decoder)
+    for part, df in enumerate(chunks):
+        paths.extend(honeypot_df_to_parquet(df, output_dir, compression=compression, part=part))
+
+    return paths
+
+def iter_attacker_ips(filename, json_decoder=None):
+    """ Stream the attacker IP address of every event, without building a Data Frame. The input may be
+    a raw honeypot json file (possibly compressed), a parsed honeypot CSV file with an `attackerIP` column,
+    or a directory of Parquet files from `honeypot_df_to_parquet`.
+
+    Parameters
+    ----------
+    filename: str
+      The raw json file, parsed CSV file, or Parquet directory.
+    json_decoder: str, callable or None, default None
+      The json library or `loads` function to decode raw json with. See `get_json_decoder`.
+
+    Yields
+    ------
+    str
+      The attacker IP address, as found in the data.
+    """
+
+    if os.path.isdir(filename):
+        import pyarrow.dataset as ds
+        for batch in ds.dataset(filename, format='parquet', partitioning='hive').to_batches(columns=['attackerIP']):
+            yield from batch.column(0).to_pylist()
+        return
+
+    name = filename.lower()
+    for ext in COMPRESSED_EXTENSIONS:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    if name.endswith('.csv'):
+        with open_input(filename) as f:
+            for chunk in pd.read_csv(f, usecols=['attackerIP'], dtype=str, chunksize=500000):
+                yield from chunk['attackerIP']
+        return
+
+    loads = get_json_decoder(json_decoder)
+    raw_channels = {c.encode() for c in CHANNEL_FIELDS}
+    with open_input(filename) as f:
+        for line in f:
+            match = _CHANNEL_RE.search(line)
+            if match is not None and match.group(1) not in raw_channels:
+                continue
+            try:
+                j = loads(line)
+                get_fields = CHANNEL_FIELDS.get(j['channel'])
+                if get_fields is not None:
+                    yield get_fields(j, loads(j['payload']))['attackerIP']
+            except (KeyError, IndexError, TypeError, ValueError):
+                continue
+
+def _bucket_path(spill_dir, bucket):
+    return os.path.join(spill_dir, 'bucket_{:04d}.txt'.format(bucket))
+
+def _spill(ips, spill_dir, n_buckets):
+    # append each IP to the bucket file its hash points to, so each distinct IP is only ever in one bucket
+    buckets = {}
+    for ip in ips:
+        buckets.setdefault(zlib.crc32(ip.encode()) % n_buckets, []).append(ip)
+    for bucket, bucket_ips in buckets.items():
+        with open(_bucket_path(spill_dir, bucket), 'a') as bf:
+            bf.write('\n'.join(bucket_ips) + '\n')
+
+def extract_attacker_ips(filename, output_path, max_in_memory=None, n_buckets=64, spill_dir=None,
+                         json_decoder=None):
+    """ Write the distinct attacker IP addresses in a honeypot data set to a file, one IP per line (the 
+    format of `data/honeypot_all_attackerips.csv`), in a single streaming pass. IPs are normalized with
+    `ip_utils.canonical_ip`, so e.g. "::ffff:185.40.4.65" and "185.40.4.65" count once. Values that are
+    not IP addresses are dropped.
+
+    By default the distinct IPs are held in memory, and written in the order first seen. For data sets 
+    with tens of millions of events, set `max_in_memory`: whenever that many distinct IPs have been 
+    collected they are spilled to `n_buckets` hashed files on disk, and each bucket is then de-duplicated
+    on its own, so memory is bounded by the larger of `max_in_memory` and the largest bucket. In that
+    mode the IPs are written sorted within each bucket.
+
+    Parameters
+    ----------
+    filename: str
+      The raw json file, parsed CSV file, or Parquet directory (see `iter_attacker_ips`).
+    output_path: str
+      Path to write the IP list to.
+    max_in_memory: int or None, default None
+      Maximum number of distinct IPs to hold in memory before spilling to disk. None never spills.
+    n_buckets: int, default 64
+      Number of spill files.
+    spill_dir: str or None, default None
+      Directory for the temporary spill files. Defaults to the system temp directory.
+    json_decoder: str, callable or None, default None
+      The json library or `loads` function to decode raw json with. See `get_json_decoder`.
+
+    Returns
+    -------
+    dict
+      Counts of the `events` read, the `invalid` IPs dropped, the `unique` IPs written, and whether
+      the IPs were `spilled` to disk.
+    """
+
+    stats = {'events': 0, 'invalid': 0, 'unique': 0, 'spilled': False}
+    seen = {} # dict, to keep the order first seen
+    with tempfile.TemporaryDirectory(dir=spill_dir) as tmp_dir:
+        for ip in iter_attacker_ips(filename, json_decoder=json_decoder):
+            stats['events'] += 1
+            ip = ip_utils.canonical_ip(ip)
+            if ip is None:
+                stats['invalid'] += 1
+                continue
+            seen[ip] = None
+            if max_in_memory is not None and len(seen) >= max_in_memory:
+                _spill(seen, tmp_dir, n_buckets)
+                seen = {}
+                stats['spilled'] = True
+
+        with open(output_path, 'w') as out:
+            if not stats['spilled']:
+                out.writelines(ip + '\n' for ip in seen)
+                stats['unique'] = len(seen)
             else:
-                row = pd.DataFrame()
-            return row
-        except:
-            print(sys.exc_info())
+                _spill(seen, tmp_dir, n_buckets)
+                for bucket in range(n_buckets):
+                    path = _bucket_path(tmp_dir, bucket)
+                    if not os.path.exists(path):
+                        continue
+                    with open(path) as bf:
+                        bucket_ips = sorted(set(bf.read().split()))
+                    out.writelines(ip + '\n' for ip in bucket_ips)
+                    stats['unique'] += len(bucket_ips)
 
-    df = pd.concat([build_df_row(j) for j in jsons], sort=False)
-    df.reset_index(inplace=True, drop=True)
+    print('Wrote {} unique attacker IPs from {} events to {}.'.format(stats['unique'], stats['events'], output_path))
+    return stats
 
-    return df
+# columns of the raw AlienVault reputation file, and the dtypes to read them with
+REPUTATION_COLUMNS = ['IP', 'Reliability', 'Risk', 'Type', 'Country', 'Locale', 'Coords', 'x']
+REPUTATION_DTYPES = {
+    'IP': str,
+    'Reliability': 'UInt8',
+    'Risk': 'UInt8',
+    'Type': 'category',
+    'Country': 'category',
+    'Locale': str,
+    'Coords': str
+}
+
+
+def _read_reputation(f, chunksize=None):
+    return pd.read_csv(f, sep='#', header=None, names=REPUTATION_COLUMNS, usecols=REPUTATION_COLUMNS[:-1],
+                       dtype=REPUTATION_DTYPES, engine='c', chunksize=chunksize)
+
+def _split_reputation_coords(rep):
+    # split "coords" column, e.g. "51.0,9.0", into float32 lat/long
+    # (`expand` gives fewer than two columns when no value in a chunk has a comma, so both are reindexed in)
+    coords = rep['Coords'].str.split(',', n=1, expand=True).reindex(columns=[0, 1])
+    rep['Latitude'] = pd.to_numeric(coords[0], errors='coerce').astype('float32')
+    rep['Longitude'] = pd.to_numeric(coords[1], errors='coerce').astype('float32')
+    rep.drop('Coords', axis=1, inplace=True)
+    return rep
 
 def reputation_raw_to_df(filename):
     """ Takes a raw AlienVault Reputation Data file and conducts a few mild parsing steps to allow it 
-    to be saved to CSV.
+    to be saved to CSV. `Reliability` and `Risk` are read as small integers, `Type` and `Country` as 
+    categoricals, and the coordinates are split into float32 `Latitude` and `Longitude` columns.
 
     Parameters
     ----------
     filename: str
-      Filename for the raw #-delimted file to parse into a Data Frame.
+      Filename for the raw #-delimted file to parse into a Data Frame. May be compressed (see `open_input`).
 
     Returns
     -------
@@ -120,18 +854,33 @@ def reputation_raw_to_df(filename):
 
     """
 
-    colnames = ['IP', 'Reliability', 'Risk', 'Type', 'Country', 'Locale', 'Coords', 'x']
-    rep = pd.read_csv(filename, sep='#', header=None, names=colnames)
-    def get_lat_long(coords):
-        # split "coords" column into lat/long
-        coords = coords.split(',')
-        return coords[0], coords[1]
-    rep["Latitude"], rep["Longitude"] = rep["Coords"].str.split(',', 1).str
-    rep.drop(['Coords', 'x'], axis=1, inplace=True)
+    with open_input(filename) as f:
+        rep = _read_reputation(f)
 
-    return rep
+    return _split_reputation_coords(rep)
 
-def ip_geo_to_df(filename):
+def iter_reputation_chunks(filename, chunksize=50000):
+    """ Same as `reputation_raw_to_df`, but yields the Data Frame in chunks of at most `chunksize` rows.
+
+    Parameters
+    ----------
+    filename: str
+      Filename for the raw #-delimted file. May be compressed (see `open_input`).
+    chunksize: int, default 50000
+      Maximum number of rows per Data Frame.
+
+    Yields
+    ------
+    pd Data Frame
+      The next chunk of the reputation data.
+
+    """
+
+    with open_input(filename) as f:
+        for rep in _read_reputation(f, chunksize=chunksize):
+            yield _split_reputation_coords(rep)
+
+def ip_geo_to_df(filename, normalize=False, offline_filename=None):
     """ Takes a CSV file of geolocations obtained via the `geolocate_ips` modules, 
     slaps the appropriate column names on it, and returns a Data Frame. Userful so you may then save
     to CSV and upload to S3.
@@ -139,18 +888,41 @@ def ip_geo_to_df(filename):
     Parameters
     ----------
     filename: str
-      Filename for CSV file from geolocate_ips functions
+      Filename for CSV file from geolocate_ips functions. May be compressed (see `open_input`).
+    normalize: bool, default False
+      Normalize `IP_orig` with `ip_utils.normalize_ips` and keep one row per normalized address, so each
+      honeypot row joins to exactly one geolocation. Rows with invalid or non-public addresses are dropped.
+    offline_filename: str or None, default None
+      A CSV of the geolocations estimated by an offline index (see `geolocate_ips.offline_path`), in the same
+      format. Its rows are included for the IPs that `filename` doesn't have.
 
     Returns
     -------
     pd DataFrame 
       The original geolocations, but with proper headers for saving to S3 and later working with Redshift. 
+      Only the last row of each IP is kept.
 
     """
     colnames = ['IP_orig', 'IP', 'country_code', 'country_name', 'region_code',
                 'region_name', 'city', 'zip_code', 'time_zone', 'latitude', 
                 'longitude', 'metro_code']
-    geos = pd.read_csv(filename, header=None, names=colnames)
+    with open_input(filename) as f:
+        geos = pd.read_csv(f, header=None, names=colnames)
+    if offline_filename is not None and os.path.exists(offline_filename):
+        # first, so the API's answer for an IP wins over an estimate
+        with open_input(offline_filename) as f:
+            geos = pd.concat([pd.read_csv(f, header=None, names=colnames), geos], ignore_index=True)
+
+    # an IP geolocated again after its cache entry expired has a newer line further down the file
+    n_rows = len(geos)
+    geos = geos.drop_duplicates(subset='IP_orig', keep='last').reset_index(drop=True)
+
+    if normalize:
+        geos['IP_orig'], stats = ip_utils.normalize_ips(geos['IP_orig'])
+        geos = geos.dropna(subset=['IP_orig']).drop_duplicates(subset='IP_orig', keep='last').reset_index(drop=True)
+        print('Normalized geolocations: kept {} of {} rows. Dropped {} duplicate rows, each of which would have '
+              'duplicated every fact row of its IP in the join, and {} invalid or non-public rows.'.format(
+                  len(geos), n_rows, n_rows - stats['rejected'] - len(geos), stats['rejected']))
 
     return geos
 
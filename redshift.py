@@ -1,5 +1,4 @@
 import pandas as pd
-import boto3
 import json
 import configparser
 
@@ -37,6 +36,8 @@ class redshift(object):
         self.IAM_ROLE_NAME = config.get('DWH', 'DWH_IAM_ROLE_NAME')
         self.IAM_ROLE = ''
 
+        # imported here so that subclasses that don't talk to AWS (see `honeypot_local`) don't need boto3
+        import boto3
         self.redshiftdb = boto3.client('redshift', 
                                     region_name='us-west-2',
                                     aws_access_key_id=self.KEY,
@@ -10,6 +10,7 @@ dim_snort_drop = "DROP TABLE IF EXISTS snort_events;"
 dim_ipgeo_drop = "DROP TABLE IF EXISTS ipgeo;"
 dim_reputation_drop = "DROP TABLE IF EXISTS reputation;"
 fact_attacks_drop = "DROP TABLE IF EXISTS attacks;"
+load_watermarks_drop = "DROP TABLE IF EXISTS load_watermarks;"
 
 # CREATE TABLES
 staging_reputation_create = ("""
@@ -191,6 +192,16 @@ CREATE TABLE IF NOT EXISTS attacks
     attacker_reliability  INTEGER
 );""")
 
+# one row per load: the latest event timestamp loaded into `table_name` by then. The current watermark
+# of a table is its MAX(watermark)
+load_watermarks_create = ("""
+CREATE TABLE IF NOT EXISTS load_watermarks
+(
+    table_name    VARCHAR(255) NOT NULL,
+    watermark     TIMESTAMP,
+    loaded_at     TIMESTAMP
+);""")
+
 # COPY INTO TABLES
 staging_reputation_copy = ("""
 COPY staging_reputation 
@@ -220,6 +231,48 @@ TIMEFORMAT 'auto'
 CSV;
 """) #.format(HONEYPOT_DATA, IAM_ROLE)
 
+# Parquet files from `parse_data.honeypot_df_to_parquet`. Columns are matched by position, and the 
+# bucket must be in the cluster's region (COPY does not take a REGION for columnar formats).
+staging_honeypot_copy_parquet = ("""
+COPY staging_honeypot 
+FROM {}
+credentials 'aws_iam_role={}'
+FORMAT AS PARQUET;
+""") #.format(HONEYPOT_PARQUET_DATA, IAM_ROLE)
+
+# gzip'd slices of the staging CSVs listed in a manifest (see `staging_slices.py`), so the slices are
+# loaded in parallel. Every slice keeps the header row.
+staging_reputation_copy_manifest = ("""
+COPY staging_reputation 
+FROM {}
+IGNOREHEADER 1
+credentials 'aws_iam_role={}'
+region 'us-west-2' compupdate off
+MANIFEST GZIP
+CSV;
+""") #.format(REPUTATION_MANIFEST, IAM_ROLE)
+
+staging_ipgeo_copy_manifest = ("""
+COPY staging_ipgeo 
+FROM {}
+IGNOREHEADER 1
+credentials 'aws_iam_role={}'
+region 'us-west-2' compupdate off
+MANIFEST GZIP
+CSV;
+""") #.format(IPGEO_MANIFEST, IAM_ROLE)
+
+staging_honeypot_copy_manifest = ("""
+COPY staging_honeypot 
+FROM {}
+IGNOREHEADER 1
+credentials 'aws_iam_role={}'
+region 'us-west-2' compupdate off
+TIMEFORMAT 'auto'
+MANIFEST GZIP
+CSV;
+""") #.format(HONEYPOT_MANIFEST, IAM_ROLE)
+
 # INSERT INTO TABLES
 dim_glastopf_insert = ("""
 INSERT INTO glastopf_events (
@@ -292,66 +345,169 @@ INSERT INTO attacks (
    LEFT JOIN staging_reputation sr ON si.ip = sr.ip)
 ;""")
 
-# the following dict allows us to more easily control which drop/create/copy/insert functions we want to call
+# INCREMENTAL (UPSERT) LOADS
+# With incremental loads, staging_honeypot holds only the new honeypot data, while staging_ipgeo and
+# staging_reputation are reloaded in full (they are small and cumulative). The dimension tables are merged
+# with delete-insert on their keys, so reloading a day is harmless, and the fact table only takes staging
+# rows newer than its watermark.
+staging_truncate = "TRUNCATE {};"
+
+dim_events_delete = ("""
+DELETE FROM {0}
+USING staging_honeypot
+WHERE {0}.id = staging_honeypot.id
+  AND staging_honeypot.channel = '{1}'
+;""") #.format(table name, channel)
+
+dim_ipgeo_delete = ("""
+DELETE FROM ipgeo
+USING staging_ipgeo
+WHERE ipgeo.IP4 = staging_ipgeo.IP
+;""")
+
+dim_reputation_delete = ("""
+DELETE FROM reputation
+USING staging_reputation
+WHERE reputation.IP4 = staging_reputation.IP
+;""")
+
+fact_attacks_upsert = ("""
+INSERT INTO attacks (
+  timestamp, ident, channel, attacker_IP, attacker_port, victim_IP,
+  victim_port, attacker_city, attacker_region, attacker_country, attacker_timezone,
+  attacker_latitude, attacker_longitude, attacker_type, attacker_risk, attacker_reliability)
+  (SELECT sh.timestamp, sh.ident, sh.channel, si.ip, sh.attackerport, 
+   si.ip, sh.victimport, si.city, si.region_name, si.country_name, si.time_zone,
+   si.latitude, si.longitude, sr.type, sr.risk, sr.reliability
+   FROM staging_honeypot AS sh
+   JOIN staging_ipgeo AS si ON sh.attackerip = si.ip_orig
+   LEFT JOIN staging_reputation sr ON si.ip = sr.ip
+   WHERE sh.timestamp > (SELECT COALESCE(MAX(watermark), '1900-01-01'::TIMESTAMP)
+                         FROM load_watermarks WHERE table_name = 'attacks'))
+;""")
+
+record_watermark = ("""
+INSERT INTO load_watermarks (table_name, watermark, loaded_at)
+  (SELECT '{}', MAX("timestamp"), GETDATE()
+   FROM staging_honeypot
+   HAVING MAX("timestamp") IS NOT NULL)
+;""") #.format(table name)
+
+get_watermark = "SELECT MAX(watermark) FROM load_watermarks WHERE table_name = '{}';"
+
+# SHADOW-TABLE REBUILDS
+# A rebuild creates and loads a copy of each table under a shadow name (e.g. attacks__new), then swaps the
+# copies in with renames, so readers see the old tables until the new ones are complete.
+shadow_suffix = '__new'
+retired_suffix = '__old'
+existing_tables = "SELECT tablename FROM pg_tables WHERE schemaname = current_schema();"
+rename_table = "ALTER TABLE {} RENAME TO {};" #.format(old name, new name)
+drop_table = "DROP TABLE IF EXISTS {};"
+
+# LOAD METRICS
+# The query ID of the last statement (or COPY) in the session, and what it read: bytes scanned from tables
+# for queries, and bytes read from the files for COPY (see `honeypot_redshift._execute`)
+last_query_id = "SELECT pg_last_query_id();"
+last_copy_id = "SELECT pg_last_copy_id();"
+query_bytes_scanned = "SELECT SUM(bytes) FROM svl_query_summary WHERE query = {} AND label LIKE 'scan%';"
+copy_bytes_scanned = "SELECT SUM(bytes) FROM stl_file_scan WHERE query = {};"
+
+# the rows rejected by the last COPY in the session
+load_errors = ("""
+SELECT TRIM(filename), line_number, TRIM(colname), TRIM(type), TRIM(raw_field_value), err_code, TRIM(err_reason)
+FROM stl_load_errors
+WHERE query = pg_last_copy_id()
+ORDER BY line_number
+LIMIT {}
+;""") #.format(maximum number of rows)
+
+# the following dict allows us to more easily control which drop/create/copy/insert functions we want to call.
+# `depends_on` lists the tables that must be loaded before a table's copy/insert can run (see `load_scheduler.py`)
 table_commands = {
     'staging_honeypot': {
         'name': 'staging_honeypot',
         'drop': staging_honeypot_drop,
         'create': staging_honeypot_create,
-        'copy': staging_honeypot_copy
+        'copy': staging_honeypot_copy,
+        'copy_parquet': staging_honeypot_copy_parquet,
+        'copy_manifest': staging_honeypot_copy_manifest,
+        'depends_on': []
     },
     'staging_ipgeo': {
         'name': 'staging_ipgeo',
         'drop': staging_ipgeo_drop,
         'create': staging_ipgeo_create,
-        'copy': staging_ipgeo_copy
+        'copy': staging_ipgeo_copy,
+        'copy_manifest': staging_ipgeo_copy_manifest,
+        'depends_on': []
     },
     'staging_reputation': {
         'name': 'staging_reputation',
         'drop': staging_reputation_drop,
         'create': staging_reputation_create,
-        'copy': staging_reputation_copy
+        'copy': staging_reputation_copy,
+        'copy_manifest': staging_reputation_copy_manifest,
+        'depends_on': []
     },
     'dim_glastopf': {
         'name': 'glastopf_events',
         'drop': dim_glastopf_drop,
         'create': dim_glastopf_create,
-        'insert': dim_glastopf_insert
+        'insert': dim_glastopf_insert,
+        'upsert': [dim_events_delete.format('glastopf_events', 'glastopf.events'), dim_glastopf_insert],
+        'depends_on': ['staging_honeypot']
     },
     'dim_amun': {
         'name': 'amun_events',
         'drop': dim_amun_drop,
         'create': dim_amun_create,
-        'insert': dim_amun_insert
+        'insert': dim_amun_insert,
+        'upsert': [dim_events_delete.format('amun_events', 'amun.events'), dim_amun_insert],
+        'depends_on': ['staging_honeypot']
     },
     'dim_dionaea': {
         'name': 'dionaea_events',
         'drop': dim_dionaea_drop,
         'create': dim_dionaea_create,
-        'insert': dim_dionaea_insert
+        'insert': dim_dionaea_insert,
+        'upsert': [dim_events_delete.format('dionaea_events', 'dionaea.connections'), dim_dionaea_insert],
+        'depends_on': ['staging_honeypot']
     },
     'dim_snort': {
         'name': 'snort_events',
         'drop': dim_snort_drop,
         'create': dim_snort_create,
-        'insert': dim_snort_insert
+        'insert': dim_snort_insert,
+        'upsert': [dim_events_delete.format('snort_events', 'snort.alerts'), dim_snort_insert],
+        'depends_on': ['staging_honeypot']
     },
     'dim_ipgeo': {
         'name': 'ipgeo',
         'drop': dim_ipgeo_drop,
         'create': dim_ipgeo_create,
-        'insert': dim_ipgeo_insert
+        'insert': dim_ipgeo_insert,
+        'upsert': [dim_ipgeo_delete, dim_ipgeo_insert],
+        'depends_on': ['staging_ipgeo']
     },
     'dim_reputation': {
         'name': 'reputation',
         'drop': dim_reputation_drop,
         'create': dim_reputation_create,
-        'insert': dim_reputation_insert
+        'insert': dim_reputation_insert,
+        'upsert': [dim_reputation_delete, dim_reputation_insert],
+        'depends_on': ['staging_reputation']
     },
     'fact_attacks': {
         'name': 'attacks',
         'drop': fact_attacks_drop,
         'create': fact_attacks_create,
-        'insert': fact_attacks_insert
+        'insert': fact_attacks_insert,
+        'upsert': [fact_attacks_upsert],
+        'depends_on': ['staging_honeypot', 'staging_ipgeo', 'staging_reputation']
+    },
+    'load_watermarks': {
+        'name': 'load_watermarks',
+        'drop': load_watermarks_drop,
+        'create': load_watermarks_create
     }
 }
\ No newline at end of file
@@ -0,0 +1,136 @@
+# Physical layout of the warehouse tables: distribution style and key, sort key, and column compression
+# encodings. The CREATE TABLE statements in `honeypot_sql` only describe the columns; `tuned_table_commands`
+# rewrites them with the layout below. Encodings suggested by `ANALYZE COMPRESSION` on a loaded warehouse
+# (see `honeypot_redshift.analyze_compression`) can be saved to a JSON file and passed back in as overrides.
+import copy
+import json
+import re
+
+from . import honeypot_sql
+
+# Large tables are distributed on the attacker IP, so the fact-to-staging joins on it are collocated, and
+# sorted by timestamp, so time-range filters skip blocks. The small lookup tables are copied to every node.
+TABLE_LAYOUT = {
+    'staging_honeypot': {'diststyle': 'KEY', 'distkey': 'attackerIP', 'sortkey': ['timestamp']},
+    'staging_ipgeo': {'diststyle': 'ALL', 'sortkey': ['IP_orig']},
+    'staging_reputation': {'diststyle': 'ALL', 'sortkey': ['IP']},
+    'dim_glastopf': {'diststyle': 'KEY', 'distkey': 'attackerIP', 'sortkey': ['timestamp']},
+    'dim_amun': {'diststyle': 'KEY', 'distkey': 'attackerIP', 'sortkey': ['timestamp']},
+    'dim_dionaea': {'diststyle': 'KEY', 'distkey': 'attackerIP', 'sortkey': ['timestamp']},
+    'dim_snort': {'diststyle': 'KEY', 'distkey': 'attackerIP', 'sortkey': ['timestamp']},
+    'dim_ipgeo': {'diststyle': 'ALL', 'sortkey': ['IP4']},
+    'dim_reputation': {'diststyle': 'ALL', 'sortkey': ['IP4']},
+    'fact_attacks': {'diststyle': 'KEY', 'distkey': 'attacker_IP', 'sortkey': ['timestamp']},
+    'load_watermarks': {'diststyle': 'ALL', 'sortkey': ['table_name']}
+}
+
+# default encoding for each column type; the leading sort key column is always left RAW, so the zone maps
+# used to skip blocks stay precise
+TYPE_ENCODINGS = [
+    (r'^(SMALLINT|INT|INTEGER|BIGINT|NUMERIC|DECIMAL|DATE|TIMESTAMP)\b', 'AZ64'),
+    (r'^(FLOAT|FLOAT4|FLOAT8|REAL|DOUBLE)\b', 'ZSTD'),
+    (r'^BOOLEAN\b', 'ZSTD'),
+    (r'^(VARCHAR|CHAR)\b', 'ZSTD')
+]
+
+_COLUMN_RE = re.compile(r'^(\s+)(\w+)(\s+)(.*?)(,?)$')
+_CONSTRAINT_RE = re.compile(r'\s+(NOT NULL|NULL|PRIMARY KEY|UNIQUE)\b.*$', re.IGNORECASE)
+
+
+def default_encoding(col_type):
+    """ Return the default compression encoding for a column type, e.g. "AZ64" for "TIMESTAMP". """
+
+    for pattern, encoding in TYPE_ENCODINGS:
+        if re.match(pattern, col_type.strip(), re.IGNORECASE):
+            return encoding
+    return 'ZSTD'
+
+def load_encoding_overrides(path):
+    """ Load column encodings from a JSON file of {table: {column: encoding}}, where the tables are keys of
+    `table_commands` (e.g. "fact_attacks") or table names (e.g. "attacks"). Column names are case-insensitive.
+    """
+
+    with open(path) as ef:
+        overrides = json.load(ef)
+    names = {cmds['name']: key for key, cmds in honeypot_sql.table_commands.items()}
+    return {names.get(table, table): {col.lower(): enc.upper() for col, enc in cols.items()}
+            for table, cols in overrides.items()}
+
+def tune_create(create_sql, layout=None, encodings=None):
+    """ Add column encodings and the table's distribution and sort keys to a CREATE TABLE statement.
+
+    Parameters
+    ----------
+    create_sql: str
+      The CREATE TABLE statement, with one column per line, as in `honeypot_sql`.
+    layout: dict or None, default None
+      The table's entry in `TABLE_LAYOUT`. None leaves distribution and sorting to Redshift.
+    encodings: dict or None, default None
+      {column: encoding} overrides (lowercase column names); other columns get `default_encoding`.
+
+    Returns
+    -------
+    str, the tuned CREATE TABLE statement.
+    """
+
+    layout = layout or {}
+    encodings = encodings or {}
+    sortkey = [c.lower() for c in layout.get('sortkey', [])]
+
+    lines = create_sql.split('\n')
+    start = next(i for i, line in enumerate(lines) if line.strip() == '(') + 1
+    end = max(i for i, line in enumerate(lines) if line.strip().startswith(')'))
+    for i in range(start, end):
+        m = _COLUMN_RE.match(lines[i])
+        if m is None:
+            continue
+        indent, col, space, definition, comma = m.groups()
+        if sortkey and col.lower() == sortkey[0]:
+            encoding = 'RAW'
+        else:
+            encoding = encodings.get(col.lower()) or default_encoding(definition)
+        # ENCODE goes after the type (and IDENTITY), before any constraints
+        constraint = _CONSTRAINT_RE.search(definition)
+        if constraint:
+            definition = '{} ENCODE {}{}'.format(definition[:constraint.start()], encoding, definition[constraint.start():])
+        else:
+            definition = '{} ENCODE {}'.format(definition, encoding)
+        lines[i] = indent + col + space + definition + comma
+
+    attributes = []
+    if layout.get('diststyle'):
+        attributes.append('DISTSTYLE {}'.format(layout['diststyle']))
+    if layout.get('distkey'):
+        attributes.append('DISTKEY ("{}")'.format(layout['distkey'].lower()))
+    if layout.get('sortkey'):
+        attributes.append('COMPOUND SORTKEY ({})'.format(', '.join('"{}"'.format(c) for c in sortkey)))
+    if attributes:
+        closing = lines[end].strip()
+        lines[end] = ')\n' + '\n'.join(attributes) + closing[1:]
+
+    return '\n'.join(lines)
+
+def tuned_table_commands(table_cmds=None, overrides=None):
+    """ Return a copy of the table commands with the `create` statements tuned by `tune_create`.
+
+    Parameters
+    ----------
+    table_cmds: dict or None, default None
+      The table commands to tune. Defaults to `honeypot_sql.table_commands`.
+    overrides: dict or None, default None
+      Column encodings per table key, e.g. from `load_encoding_overrides`.
+
+    Returns
+    -------
+    dict
+    """
+
+    table_cmds = copy.deepcopy(table_cmds if table_cmds is not None else honeypot_sql.table_commands)
+    overrides = overrides or {}
+    for table, cmds in table_cmds.items():
+        if 'create' in cmds:
+            cmds['create'] = tune_create(cmds['create'], TABLE_LAYOUT.get(table), overrides.get(table))
+
+    return table_cmds
+
+analyze_compression = 'ANALYZE COMPRESSION {};'
@@ -0,0 +1,113 @@
+# Helpers to split the staging CSV files into gzip'd slices and write a COPY manifest for them, so that
+# Redshift loads the slices in parallel (one file per cluster slice) instead of reading a single file.
+import gzip
+import json
+import os
+
+# number of slices per node for each Redshift node type
+SLICES_PER_NODE = {
+    'dc2.large': 2,
+    'dc2.8xlarge': 16,
+    'ds2.xlarge': 2,
+    'ds2.8xlarge': 16,
+    'ra3.xlplus': 2,
+    'ra3.4xlarge': 4,
+    'ra3.16xlarge': 16
+}
+
+
+def default_slice_count(num_nodes, node_type, multiple=1):
+    """ Return the number of files to split a staging file into: a multiple of the number of slices in the
+    cluster, so every slice gets the same amount of work.
+
+    Parameters
+    ----------
+    num_nodes: int or str
+      Number of nodes in the cluster (`DWH_NUM_NODES` in the config).
+    node_type: str
+      Node type of the cluster (`DWH_NODE_TYPE` in the config). Unknown types count as 2 slices per node.
+    multiple: int, default 1
+      Files per slice.
+
+    Returns
+    -------
+    int
+    """
+
+    return max(1, int(num_nodes) * SLICES_PER_NODE.get(node_type.strip().lower(), 2) * int(multiple))
+
+def split_csv(filename, output_dir, n_slices, header=True, compresslevel=6):
+    """ Split a CSV file into `n_slices` gzip'd files of about the same size. Each slice starts with the
+    header row (if `header`), since the staging COPY commands skip the first line of every file. Splits only
+    happen between records, so quoted fields with newlines in them (like the glastopf `request_raw`) stay whole.
+
+    Parameters
+    ----------
+    filename: str
+      Path of the CSV file to split.
+    output_dir: str
+      Directory for the slices; created if needed. Slices are named "<name>.part-NNNN.csv.gz".
+    n_slices: int
+      Number of slices to write. Fewer are written if the file has fewer records.
+    header: bool, default True
+      Whether the CSV file has a header row.
+    compresslevel: int, default 6
+      gzip compression level.
+
+    Returns
+    -------
+    list of the paths written.
+    """
+
+    os.makedirs(output_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(filename))[0]
+    target = os.path.getsize(filename) / float(n_slices)
+
+    paths = []
+    out = None
+    with open(filename, 'rb') as f:
+        head = f.readline() if header else b''
+        written = 0
+        in_quotes = False
+        for line in f:
+            if out is None:
+                path = os.path.join(output_dir, '{}.part-{:04d}.csv.gz'.format(name, len(paths)))
+                out = gzip.open(path, 'wb', compresslevel=compresslevel)
+                out.write(head)
+                paths.append(path)
+                written = 0
+            out.write(line)
+            written += len(line)
+            # a record ends at a newline outside of quotes; escaped quotes ("") don't change the parity
+            if line.count(b'"') % 2:
+                in_quotes = not in_quotes
+            if not in_quotes and written >= target and len(paths) < n_slices:
+                out.close()
+                out = None
+    if out is not None:
+        out.close()
+
+    return paths
+
+def write_manifest(urls, path, mandatory=True):
+    """ Write a Redshift COPY manifest listing the S3 `urls` of the slices.
+
+    Parameters
+    ----------
+    urls: list of str
+      S3 URLs ("s3://bucket/key") of the files to load.
+    path: str
+      Local path of the manifest file to write.
+    mandatory: bool, default True
+      Make COPY fail if any of the files is missing.
+
+    Returns
+    -------
+    dict, the manifest.
+    """
+
+    manifest = {'entries': [{'url': url, 'mandatory': mandatory} for url in urls]}
+    with open(path, 'w') as mf:
+        json.dump(manifest, mf, indent=2)
+
+    return manifest
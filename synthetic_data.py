@@ -0,0 +1,229 @@
+# this script generates synthetic honeypot, reputation, and IP geolocation data files in the same formats
+# as the real data, so that the parsing and loading code can be tested and benchmarked at any scale.
+# Usage: python synthetic_data.py <output_dir> [--lines 1m] [--seed 0]
+import argparse
+import datetime
+import json
+import os
+import random
+import uuid
+
+# preset data set sizes, in honeypot json lines
+SIZES = {'10k': 10000, '1m': 1000000, '10m': 10000000}
+
+# share of the honeypot records from each channel; "other.events" stands in for the channels we don't ingest
+CHANNEL_MIX = {
+    'dionaea.connections': 0.55,
+    'snort.alerts': 0.20,
+    'amun.events': 0.14,
+    'glastopf.events': 0.09,
+    'other.events': 0.02
+}
+
+_GLASTOPF_URLS = [('/', 'unknown'), ('/style.css', 'style_css'), ('/index', 'unknown'),
+                  ('/phpMyAdmin/scripts/setup.php', 'phpmyadmin'), ('/cgi-bin/php?-d+allow_url_include=on', 'php_cgi_rce'),
+                  ('/index.php?page=../../../../etc/passwd', 'lfi'), ('/comments', 'comments')]
+_DIONAEA_PROTOCOLS = ['pcap', 'smbd', 'httpd', 'mssqld', 'epmapper', 'SipSession']
+_SNORT_SIGNATURES = [(29, 'ICMP', '1:486:4', 'ICMP Destination Unreachable Communication with Destination Host is Administratively Prohibited '),
+                     (3, 'TCP', '1:2010935:2', 'ET POLICY Suspicious inbound to MSSQL port 1433'),
+                     (3, 'TCP', '1:2001219:19', 'ET SCAN Potential SSH Scan'),
+                     (2, 'UDP', '1:2008578:6', 'ET SCAN Sipvicious Scan')]
+_REPUTATION_TYPES = ['Malicious Host', 'Scanning Host', 'Spamming', 'Malicious Host;Scanning Host']
+_GEO_PLACES = [('US', 'United States', 'TX', 'Texas', 'Austin', '78701', 'America/Chicago', 30.2672, -97.7431, 635),
+               ('CN', 'China', 'BJ', 'Beijing', 'Beijing', '', 'Asia/Shanghai', 39.9289, 116.3883, 0),
+               ('RU', 'Russia', 'MOW', 'Moscow', 'Moscow', '101000', 'Europe/Moscow', 55.7527, 37.6172, 0),
+               ('DE', 'Germany', 'HE', 'Hesse', 'Frankfurt am Main', '60313', 'Europe/Berlin', 50.1155, 8.6842, 0),
+               ('BR', 'Brazil', 'SP', 'Sao Paulo', 'Sao Paulo', '01000-000', 'America/Sao_Paulo', -23.5475, -46.6361, 0),
+               ('NL', 'Netherlands', '', '', '', '', 'Europe/Amsterdam', 52.3824, 4.8995, 0)]
+_VICTIM_IPS = ['172.31.13.124', '172.31.5.68', '162.244.30.100', '10.0.0.12']
+
+
+def _random_ip(rng):
+    return '{}.{}.{}.{}'.format(rng.randint(1, 223), rng.randint(0, 255), rng.randint(0, 255), rng.randint(1, 254))
+
+def attacker_ips(n_ips, seed=0):
+    """ Return a reproducible list of `n_ips` distinct, random IPv4 attacker addresses. """
+
+    rng = random.Random(seed)
+    ips = set()
+    while len(ips) < n_ips:
+        ips.add(_random_ip(rng))
+    # shuffle a sorted list, since the iteration order of a set of strings changes with PYTHONHASHSEED
+    ips = sorted(ips)
+    rng.shuffle(ips)
+    return ips
+
+def _payload(channel, rng, attacker, timestamp):
+    port = rng.randint(1024, 65535)
+    victim = rng.choice(_VICTIM_IPS)
+    if channel == 'glastopf.events':
+        url, pattern = rng.choice(_GLASTOPF_URLS)
+        return {'pattern': pattern, 'time': timestamp.strftime('%Y-%m-%d %H:%M:%S'), 'filename': None,
+                'source': [attacker, port],
+                'request_raw': 'GET {} HTTP/1.1\r\nAccept: */*\r\nHost: {}\r\nUser-Agent: Mozilla/5.0'.format(url, victim),
+                'request_url': url}
+    if channel == 'amun.events':
+        return {'attackerPort': port, 'victimPort': rng.choice([80, 135, 139, 445, 3389]), 'victimIP': victim,
+                'attackerIP': attacker, 'connectionType': rng.choice(['initial', 'exploit'])}
+    if channel == 'dionaea.connections':
+        # dionaea logs some addresses in IPv4-mapped IPv6 form
+        remote = '::ffff:' + attacker if rng.random() < 0.2 else attacker
+        return {'remote_host': remote, 'remote_port': port, 'local_host': victim,
+                'local_port': rng.choice([21, 42, 80, 135, 445, 1433, 3306, 5060]),
+                'connection_type': rng.choice(['accept', 'reject', 'connect']),
+                'connection_transport': rng.choice(['tcp', 'tcp', 'udp']),
+                'connection_protocol': rng.choice(_DIONAEA_PROTOCOLS), 'remote_hostname': ''}
+    if channel == 'snort.alerts':
+        classification, proto, header, signature = rng.choice(_SNORT_SIGNATURES)
+        return {'source_ip': attacker, 'destination_ip': victim, 'classification': classification, 'proto': proto,
+                'priority': str(rng.randint(1, 3)), 'header': header, 'signature': signature,
+                'date': timestamp.isoformat(), 'sensor': '139cfdf2-471e-11e4-9ee4-0a0b6e7c3e9e'}
+    return {'message': 'unparsed channel', 'source': attacker}
+
+def generate_honeypot_json(output_path, n_lines, seed=0, ips=None, channel_mix=None):
+    """ Write a synthetic honeypot json file, one mongoexport-style record per line, like the
+    honeypot.json data set. The file is written as it is generated, so any size can be produced.
+
+    Parameters
+    ----------
+    output_path: str
+      Path of the json file to write.
+    n_lines: int
+      Number of records to write.
+    seed: int, default 0
+      Random seed; the same seed always gives the same file.
+    ips: list or None, default None
+      Attacker IP addresses to draw from. By default, one address per 5 records is generated.
+    channel_mix: dict or None, default None
+      Share of the records from each channel. Defaults to `CHANNEL_MIX`.
+
+    Returns
+    -------
+    dict of the number of records written per channel.
+    """
+
+    rng = random.Random(seed)
+    ips = ips or attacker_ips(max(1, n_lines // 5), seed=seed)
+    channel_mix = channel_mix or CHANNEL_MIX
+    channels, weights = list(channel_mix), list(channel_mix.values())
+    idents = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(20)]
+
+    # spread the records over two years, in time order like the real log
+    timestamp = datetime.datetime(2014, 9, 1)
+    step = datetime.timedelta(days=730) / max(n_lines, 1)
+
+    counts = dict.fromkeys(channels, 0)
+    batch = 10000
+    with open(output_path, 'w') as f:
+        for start in range(0, n_lines, batch):
+            lines = []
+            for channel in rng.choices(channels, weights, k=min(batch, n_lines - start)):
+                # a few attackers generate most of the traffic
+                attacker = ips[min(int(rng.paretovariate(1.2)) - 1, len(ips) - 1)] if rng.random() < 0.5 \
+                    else rng.choice(ips)
+                timestamp += step * rng.uniform(0.5, 1.5)
+                payload = json.dumps(_payload(channel, rng, attacker, timestamp))
+                lines.append('{{ "_id" : {{ "$oid" : "{:024x}" }}, "ident" : "{}", "timestamp" : {{ "$date" : "{}" }}, '
+                             '"normalized" : true, "payload" : {}, "channel" : "{}" }}\n'.format(
+                                 rng.getrandbits(96), rng.choice(idents),
+                                 timestamp.strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}+0000'.format(timestamp.microsecond // 1000),
+                                 json.dumps(payload), channel))
+                counts[channel] += 1
+            f.writelines(lines)
+
+    return counts
+
+def generate_reputation(output_path, n_lines, seed=0, ips=None, overlap=0.3):
+    """ Write a synthetic #-delimited AlienVault reputation file.
+
+    Parameters
+    ----------
+    output_path: str
+      Path of the file to write.
+    n_lines: int
+      Number of records to write.
+    seed: int, default 0
+      Random seed.
+    ips: list or None, default None
+      Attacker IP addresses; a share (`overlap`) of the reputation records are for these, so that
+      they join to the honeypot data.
+    overlap: float, default 0.3
+      Share of the records drawn from `ips`.
+
+    Returns
+    -------
+    None
+    """
+
+    rng = random.Random(seed + 1)
+    known = rng.sample(ips, min(len(ips), int(n_lines * overlap))) if ips else []
+    rep_ips = set(known)
+    while len(rep_ips) < n_lines:
+        rep_ips.add(_random_ip(rng))
+
+    with open(output_path, 'w') as f:
+        for ip in sorted(rep_ips):
+            place = rng.choice(_GEO_PLACES)
+            f.write('{}#{}#{}#{}#{}#{}#{},{}#11\n'.format(
+                ip, rng.randint(1, 10), rng.randint(1, 7), rng.choice(_REPUTATION_TYPES), place[0], place[4],
+                round(place[7] + rng.uniform(-1, 1), 4), round(place[8] + rng.uniform(-1, 1), 4)))
+
+def generate_ip_geos(output_path, ips, seed=0):
+    """ Write a synthetic IP geolocation file for `ips`, in the format written by `GeolocateIPs.geo_ips`
+    (the original IP, followed by the freegeoip.app CSV response).
+
+    Returns
+    -------
+    None
+    """
+
+    rng = random.Random(seed + 2)
+    with open(output_path, 'w') as f:
+        for ip in ips:
+            place = rng.choice(_GEO_PLACES)
+            f.write('{},{},{}\r\n'.format(ip, ip, ','.join(str(v) for v in place)))
+
+def generate_dataset(output_dir, n_lines, seed=0):
+    """ Generate a matching set of honeypot, reputation, and geolocation files in `output_dir`. The
+    reputation file has about one record per 13 honeypot records, as in the real data.
+
+    Parameters
+    ----------
+    output_dir: str
+      Directory for the files; created if needed.
+    n_lines: int
+      Number of honeypot records.
+    seed: int, default 0
+      Random seed.
+
+    Returns
+    -------
+    dict of the paths written, keyed by "honeypot", "reputation", and "ip_geo".
+    """
+
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {
+        'honeypot': os.path.join(output_dir, 'honeypot_{}.json'.format(n_lines)),
+        'reputation': os.path.join(output_dir, 'reputation_{}.data'.format(n_lines)),
+        'ip_geo': os.path.join(output_dir, 'ip_geos_{}.csv'.format(n_lines))
+    }
+    ips = attacker_ips(max(1, n_lines // 5), seed=seed)
+    generate_honeypot_json(paths['honeypot'], n_lines, seed=seed, ips=ips)
+    generate_reputation(paths['reputation'], max(1, n_lines // 13), seed=seed, ips=ips)
+    generate_ip_geos(paths['ip_geo'], ips, seed=seed)
+
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic honeypot data files.')
+    parser.add_argument('output_dir')
+    parser.add_argument('--lines', default='10k', help='number of honeypot lines, or one of {}'.format(list(SIZES)))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    n_lines = SIZES.get(args.lines.lower()) or int(args.lines)
+    paths = generate_dataset(args.output_dir, n_lines, seed=args.seed)
+    print('Wrote: {}'.format(paths))
+
+if __name__ == '__main__':
+    main()
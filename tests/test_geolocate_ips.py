@@ -0,0 +1,96 @@
+import asyncio
+import time
+
+import parse_data
+from geo_cache import GeoCache
+from geo_ranges import GeoRangeIndex
+from geolocate_ips import GeolocateIPs, offline_path
+
+GEO = '{0},US,United States,TX,Texas,Austin,78701,America/Chicago,30.2672,-97.7431,635\r\n'
+
+
+def _line(ip, city='Austin'):
+    return '{},{}'.format(ip, GEO.format(ip).replace('Austin', city))
+
+
+def test_cache_keeps_ips_already_in_the_output_file(tmp_path):
+    output_path = str(tmp_path / 'ip_geos.csv')
+    with open(output_path, 'w') as out:
+        out.writelines([_line('8.8.8.8'), _line('9.9.9.9')])
+    cache = GeoCache(str(tmp_path / 'cache.db'), ttl_days=1)
+    cache.put('1.1.1.1', GEO.format('1.1.1.1'))
+    cache.put('9.9.9.9', GEO.format('9.9.9.9'), fetched_at=time.time() - 2 * 86400)
+
+    geo = GeolocateIPs(cache=cache)
+    need = geo._need_geos({'8.8.8.8', '9.9.9.9', '1.1.1.1', '4.4.4.4'}, output_path)
+
+    # 8.8.8.8 is only in the file, 1.1.1.1 only in the cache; 9.9.9.9 has expired
+    assert need == {'9.9.9.9', '4.4.4.4'}
+    cache.close()
+
+
+def test_ip_geo_to_df_keeps_the_last_row_of_an_ip(tmp_path):
+    path = tmp_path / 'ip_geos.csv'
+    path.write_text(_line('8.8.8.8', 'Austin') + _line('9.9.9.9') + _line('8.8.8.8', 'Dallas'))
+
+    geos = parse_data.ip_geo_to_df(str(path))
+
+    assert len(geos) == 2
+    assert geos.set_index('IP_orig').loc['8.8.8.8', 'city'] == 'Dallas'
+
+
+def test_offline_answers_are_kept_apart(tmp_path):
+    output_path = str(tmp_path / 'ip_geos.csv')
+    with open(output_path, 'w') as out:
+        out.writelines([_line('8.8.8.8'), _line('8.8.8.9')])
+    index = GeoRangeIndex()
+    index.add_geo_csv(output_path, generalize_prefix=24)
+    cache = GeoCache(str(tmp_path / 'cache.db'))
+
+    geo = GeolocateIPs(cache=cache, offline_index=index)
+    need = geo._need_geos({'8.8.8.8', '8.8.8.10', '4.4.4.4'}, output_path)
+
+    assert need == {'4.4.4.4'}
+    assert open(output_path).read().count('\n') == 2
+    assert cache.get('8.8.8.10') is None
+    # a later index built from the API answers doesn't take the estimate for a real point
+    rebuilt = GeoRangeIndex()
+    assert rebuilt.add_geo_csv(output_path) == 2
+    # the estimate isn't made again on the next run
+    assert geo._need_geos({'8.8.8.10'}, output_path) == set()
+
+    geos = parse_data.ip_geo_to_df(output_path, offline_filename=offline_path(output_path))
+    assert sorted(geos['IP_orig']) == ['8.8.8.10', '8.8.8.8', '8.8.8.9']
+    cache.close()
+
+
+class _Response(object):
+
+    def __init__(self, status_code, text='', headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+
+def test_retry_after_zero_is_not_the_default_sleep(tmp_path, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, 'sleep', sleeps.append)
+    responses = [_Response(403, headers={'Retry-After': '0'}), _Response(200, GEO.format('8.8.8.8'))]
+    geo = GeolocateIPs()
+    monkeypatch.setattr(geo, '_query_api', lambda ip: responses.pop(0))
+
+    geo.geo_ips({'8.8.8.8'}, str(tmp_path / 'ip_geos.csv'), journal=False)
+
+    assert sleeps == [0.0]
+    assert geo.stats['succeeded'] == 1
+
+
+def test_async_pool_holds_every_call_in_flight(tmp_path, monkeypatch):
+    geo = GeolocateIPs(pool_size=4)
+    monkeypatch.setattr(geo, '_query_api', lambda ip: _Response(200, GEO.format(ip)))
+    ips = {'8.8.8.{}'.format(i) for i in range(1, 17)}
+
+    asyncio.run(geo.geo_ips_async(ips, str(tmp_path / 'ip_geos.csv'), concurrency=16, journal=False))
+
+    assert geo.session.get_adapter('https://freegeoip.app')._pool_maxsize == 16
+    assert geo.stats['succeeded'] == len(ips)
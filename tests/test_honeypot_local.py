@@ -0,0 +1,55 @@
+import pytest
+
+import data_checks
+import parse_data
+import synthetic_data
+
+duckdb = pytest.importorskip('duckdb')
+from honeypot_local import honeypot_local
+
+
+@pytest.fixture(scope='module')
+def data_paths(tmp_path_factory):
+    # staging CSVs made from a small synthetic data set, the way they are made for S3
+    data_dir = tmp_path_factory.mktemp('data')
+    raw = synthetic_data.generate_dataset(str(data_dir / 'raw'), 2000, seed=3)
+    paths = {
+        'staging_honeypot': str(data_dir / 'honeypot.csv'),
+        'staging_reputation': str(data_dir / 'reputation.csv'),
+        'staging_ipgeo': str(data_dir / 'ip_geos.csv')
+    }
+    parse_data.honeypot_json_to_df(raw['honeypot']).to_csv(paths['staging_honeypot'], index=False)
+    parse_data.reputation_raw_to_df(raw['reputation']).to_csv(paths['staging_reputation'], index=False)
+    parse_data.ip_geo_to_df(raw['ip_geo']).to_csv(paths['staging_ipgeo'], index=False)
+    return paths
+
+
+def _count(hl, table):
+    with hl.cursor() as cur:
+        cur.execute('SELECT COUNT(*) FROM {};'.format(table))
+        return cur.fetchone()[0]
+
+
+def test_rebuild_fresh_database(data_paths):
+    with honeypot_local(database=':memory:', data_paths=data_paths) as hl:
+        hl.db_connect()
+        hl.rebuild(tables='all')
+        watermark = hl.record_watermark()
+
+        assert watermark is not None
+        assert _count(hl, 'attacks') > 0
+        assert _count(hl, 'load_watermarks') == 1
+
+
+def test_create_load_and_check(data_paths):
+    with honeypot_local(database=':memory:', data_paths=data_paths) as hl:
+        hl.db_connect()
+        hl.create_tables(tables='all')
+        hl.parallel_load(tables='all')
+        # as `etl.populate_tables` does; `load_watermarks` is one of the checked tables
+        hl.record_watermark()
+
+        data_checks.test_tables_populated(hl)
+        data_checks.test_reputation_fact(hl)
+        data_checks.test_more_total_fact_reputation(hl)
+        assert any(record['statement'] == 'COPY' and record['rows'] for record in hl.load_metrics)
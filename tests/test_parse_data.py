@@ -0,0 +1,16 @@
+import numpy as np
+
+import parse_data
+
+
+def test_reputation_chunk_with_no_coords(tmp_path):
+    path = tmp_path / 'reputation.data'
+    path.write_text('1.2.3.4#2#3#Scanning Host#DE#Berlin##11\n'
+                    '5.6.7.8#4#5#Malicious Host#DE#Berlin#52.5,13.4#11\n')
+
+    first, second = parse_data.iter_reputation_chunks(str(path), chunksize=1)
+
+    assert np.isnan(first['Latitude'].iloc[0]) and np.isnan(first['Longitude'].iloc[0])
+    assert second['Latitude'].iloc[0] == np.float32(52.5)
+    assert second['Longitude'].iloc[0] == np.float32(13.4)
+    assert 'Coords' not in first.columns
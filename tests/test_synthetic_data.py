@@ -0,0 +1,21 @@
+import hashlib
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _generate(output_dir, hash_seed):
+    env = dict(os.environ, PYTHONHASHSEED=str(hash_seed))
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, 'synthetic_data.py'), str(output_dir),
+                    '--lines', '2000', '--seed', '7'], check=True, env=env, cwd=REPO_DIR, stdout=subprocess.DEVNULL)
+    return {name: hashlib.md5(open(os.path.join(output_dir, name), 'rb').read()).hexdigest()
+            for name in sorted(os.listdir(output_dir))}
+
+
+def test_same_seed_same_files_across_hash_seeds(tmp_path):
+    first = _generate(tmp_path / 'a', 1)
+    second = _generate(tmp_path / 'b', 2)
+    assert len(first) == 3
+    assert first == second